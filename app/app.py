@@ -1,37 +1,398 @@
 from flask import Flask, request, render_template
 import flask
+import bundles
+import changes
+import compression
+import ingest
+import metrics
 import parser
-import csv
+import spatial
+import storage
+import track
 import json
 import os
+import time
+import hashlib
+import cProfile
+import threading
+from datetime import datetime
 from twilio.twiml.messaging_response import MessagingResponse
 
-app = Flask(__name__)
+# Static files are served by the nginx static service, not by Flask.
+app = Flask(__name__, static_folder=None)
 
+CONFIG_FILE = os.environ.get('CONFIG_FILE', '/config/config.json')
+# Seconds that browsers may use the page without asking again, it only
+# changes with the config file.
+INDEX_HTML_MAX_AGE = 300
+# Longest long poll on /api/updates, in seconds.
+UPDATES_MAX_WAIT = 30
+# An event stream of /api/updates ends after this many seconds, the browser
+# then reconnects where it left off. Comments are sent in between to keep
+# the connection open.
+UPDATES_STREAM_SECONDS = 300
+UPDATES_KEEPALIVE = 15
+# Every waiting /api/updates request holds a request thread of its worker
+# process. At most UPDATES_MAX_WAITING of them wait at once per process,
+# half of its THREADS by default, so the other requests and the webhook
+# always have threads left. Long polls beyond that are answered right away,
+# event streams with 503. Both tell the client to come back after
+# UPDATES_RETRY_SECONDS.
+UPDATES_MAX_WAITING = int(os.environ.get(
+    'UPDATES_MAX_WAITING', max(1, int(os.environ.get('THREADS', '4')) // 2)))
+UPDATES_WAITING = threading.BoundedSemaphore(UPDATES_MAX_WAITING)
+UPDATES_RETRY_SECONDS = 30
+# The worker processes of serve.py share their metrics through snapshot files
+# in this directory, so /metrics adds them all up. Without it, every process
+# reports only its own.
+METRICS_DIR = os.environ.get('METRICS_DIR')
+SHARED_METRICS = metrics.SharedMetrics(METRICS_DIR) if METRICS_DIR else None
+# Set PROFILE_SLOW_REQUESTS to a number of seconds to profile every request,
+# and write the profile of the requests taking longer to PROFILE_DIR. Read
+# them with "python -m pstats <file>". Profiling slows down all requests, so
+# this is off (0) by default.
+PROFILE_SLOW_REQUESTS = float(os.environ.get('PROFILE_SLOW_REQUESTS', '0'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/profiles')
 
-def load_config(filename):
-    ''' Return a config dict from given JSON filename
+REQUESTS = metrics.counter('app_requests_total',
+                           'Requests answered, by endpoint and status.',
+                           ['endpoint', 'status'])
+REQUEST_SECONDS = metrics.histogram(
+    'app_request_seconds',
+    'Seconds until the response was ready, by endpoint. Streamed bodies '
+    'are sent after that.', ['endpoint'])
+RENDER_SECONDS = metrics.histogram('app_render_seconds',
+                                   'Seconds spent rendering a template.',
+                                   ['template'])
+
+# The rendered index.html together with the signature of the config file it
+# was rendered from.
+INDEX_HTML_CACHE = {'signature': None}
+INDEX_HTML_LOCK = threading.Lock()
+# The rendered index.js together with the data signature it was rendered from.
+# It is only rebuilt when coordinates are added.
+INDEX_JS_CACHE = {'signature': None}
+INDEX_JS_LOCK = threading.Lock()
+
+# Spatial indices of the Iridium coordinates and of the photo cluster centers,
+# kept up to date with the data files.
+COORDINATES_INDEX = spatial.RowIndex(
+    lambda row: (float(row[0]), float(row[1])))
+CLUSTERS_INDEX = spatial.RowIndex(
+    lambda row: (float(row[1][0]), float(row[1][1])))
+# Simplified versions of the Iridium track for every zoom level. They are
+# brought up to date with the rows appended by post() on the next request.
+TRACK = track.Track(lambda row: (float(row[0]), float(row[1])))
+# Compressed bodies of the track levels and of the full data set, for the
+# current data version.
+TRACK_CACHE = compression.EncodedCache(2 * (track.MAX_ZOOM + 2))
+DATA_CACHE = compression.EncodedCache(2)
+# The builder process of serve.py writes the map data as static files for
+# nginx whenever it changes, see bundles.py. It is told about new
+# coordinates right after they are stored.
+if bundles.ENABLED:
+    ingest.COORDINATES_QUEUE.on_stored = bundles.trigger
+
+
+def load_config(filename=CONFIG_FILE):
+    ''' Return a config dict from given JSON filename. The file is only read
+    again once it changed on disk.
+    '''
+    return parser.cached_read(filename, parser.read_json)
+
+
+def render_index_html():
+    ''' Return the cached index.html entry, rendering it again first if the
+    config file changed since the last render.
+    '''
+    signature = parser.file_signature(CONFIG_FILE)
+    with INDEX_HTML_LOCK:
+        if INDEX_HTML_CACHE['signature'] != signature or \
+                signature is None:
+            with RENDER_SECONDS.time(template='index.html'):
+                body = flask.render_template(
+                    "index.html", ACCESS_KEY=load_config()['GOOGLE_MAP_KEY'])
+            INDEX_HTML_CACHE['body'] = body
+            INDEX_HTML_CACHE['etag'] = hashlib.sha1(
+                body.encode('utf-8')).hexdigest()
+            # The time of the config file, the same in every worker.
+            INDEX_HTML_CACHE['last_modified'] = signature and \
+                datetime.utcfromtimestamp(int(signature[2]))
+            INDEX_HTML_CACHE['signature'] = signature
+        return dict(INDEX_HTML_CACHE)
+
+
+def render_index_js():
+    ''' Return the cached index.js entry, rendering it again first if the
+    coordinates changed since the last render. The map data itself is
+    fetched from /api/points, only the latest point is needed to center the
+    map. The ETag is that of the rendered body, so it also changes with the
+    template and STATIC_URL_BASE.
+    '''
+    signature = parser.coordinates_version()
+    with INDEX_JS_LOCK:
+        if INDEX_JS_CACHE['signature'] != signature:
+            latest = parser.get_latest_coordinate()
+            with RENDER_SECONDS.time(template='index.js'):
+                body = flask.render_template(
+                    "index.js", latest=json.dumps(latest),
+                    base_url=os.environ['STATIC_URL_BASE'])
+            INDEX_JS_CACHE['body'] = body
+            INDEX_JS_CACHE['etag'] = hashlib.sha1(
+                body.encode('utf-8')).hexdigest()
+            # Stored with the coordinates, the same in every worker.
+            INDEX_JS_CACHE['last_modified'] = parser.coordinates_modified()
+            INDEX_JS_CACHE['signature'] = signature
+        return dict(INDEX_JS_CACHE)
+
+
+@app.before_request
+def start_request():
+    ''' Note the start of the request, and start its profile if profiling
+    is on.
     '''
-    with open(filename, 'r') as config:
-        return json.load(config)
+    flask.g.started = time.time()
+    if PROFILE_SLOW_REQUESTS > 0:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return  # Another profiler is active in this process.
+        flask.g.profile = profile
+
+
+@app.after_request
+def count_request(response):
+    ''' Count the request and observe its duration. '''
+    endpoint = request.endpoint or 'none'
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    REQUEST_SECONDS.observe(time.time() - flask.g.started, endpoint=endpoint)
+    return response
+
+
+@app.teardown_request
+def finish_profile(_):
+    ''' Stop the profile of the request, and write it to PROFILE_DIR if the
+    request took longer than PROFILE_SLOW_REQUESTS seconds.
+    '''
+    profile = getattr(flask.g, 'profile', None)
+    if profile is None:
+        return
+    profile.disable()
+    seconds = time.time() - flask.g.started
+    if seconds < PROFILE_SLOW_REQUESTS:
+        return
+    if not os.path.isdir(PROFILE_DIR):
+        os.makedirs(PROFILE_DIR)
+    filename = os.path.join(PROFILE_DIR, '{0}-{1}-{2}-{3}ms.prof'.format(
+        datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f'), os.getpid(),
+        request.endpoint or 'none', int(seconds * 1000)))
+    profile.dump_stats(filename)
+    print('{0} profile of a slow request to {1} in {2}'.format(
+        datetime.now(), request.path, filename))
+
+
+@app.route('/metrics')
+def metrics_text():
+    ''' Return the metrics of the app in the Prometheus text format. '''
+    if SHARED_METRICS is not None:
+        text = SHARED_METRICS.render()
+    else:
+        text = metrics.render()
+    return flask.Response(text, content_type=metrics.CONTENT_TYPE)
 
 
 @app.route('/index.js')
 def index_js():
-    locations = parser.get_all_coordinates()
-    images = parser.get_all_images()
-    clusters = parser.get_all_clusters()
-    return flask.render_template("index.js",
-                                 locations=locations,
-                                 images=images,
-                                 clusters=clusters,
-                                 base_url=os.environ['STATIC_URL_BASE'])
+    cached = render_index_js()
+    response = flask.make_response(cached['body'])
+    response.mimetype = 'application/javascript'
+    response.set_etag(cached['etag'])
+    response.last_modified = cached['last_modified']
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def parse_bbox(value):
+    ''' Return the (south, west, north, east) tuple from the bbox query
+    parameter, as written by LatLngBounds.toUrlValue().
+    '''
+    bbox = tuple(float(item) for item in value.split(','))
+    if len(bbox) != 4 or not -90.0 <= bbox[0] <= bbox[2] <= 90.0 or \
+            not all(-180.0 <= lon <= 180.0 for lon in bbox[1::2]):
+        raise ValueError('bbox must be south,west,north,east in degrees')
+    return bbox
+
+
+def json_response(fields, version, cache=None):
+    ''' Return a JSON response of the fields, compressed with the best
+    encoding the client accepts. The body is written in chunks, so it is
+    never in memory as a whole unless it is cached.
+    Arguments:
+        fields  -- list of (name, value) of the JSON object.
+        version -- value that changes whenever the fields change.
+        cache   -- compression.EncodedCache to keep the compressed body in,
+                   or None to compress while sending.
+    '''
+    encoding = compression.best_encoding(request.accept_encodings)
+    if cache is not None and encoding != 'identity':
+        body = cache.get(version, encoding,
+                         lambda: compression.json_chunks(fields))
+    else:
+        body = compression.compress_chunks(compression.json_chunks(fields),
+                                           encoding)
+    response = flask.Response(body, mimetype='application/json')
+    if encoding != 'identity':
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(hashlib.sha1(repr((version, encoding))
+                                   .encode('utf-8')).hexdigest())
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route('/api/points')
+def points():
+    ''' Return the coordinates and photo clusters within the map bounds.
+
+    At low zoom levels, or when there are too many of them, they are
+    aggregated per grid cell into [lat, lon, count] entries. The zoom level
+    must be between 0 and spatial.MAX_ZOOM.
+    '''
+    try:
+        bbox = parse_bbox(request.args['bbox'])
+        zoom = int(request.args.get('zoom', spatial.DETAIL_ZOOM))
+        if not 0 <= zoom <= spatial.MAX_ZOOM:
+            raise ValueError('zoom must be between 0 and {0}'.format(
+                spatial.MAX_ZOOM))
+    except (KeyError, ValueError) as error:
+        return flask.jsonify(error=str(error)), 400
+    coordinates_index = COORDINATES_INDEX.update(parser.get_all_coordinates())
+    clusters_index = CLUSTERS_INDEX.update(parser.get_all_clusters())
+    locations, location_aggregates = coordinates_index.query(bbox, zoom)
+    clusters, cluster_aggregates = clusters_index.query(bbox, zoom)
+    manifest = parser.get_thumbnail_manifest()
+    thumbnails = dict((image[0], manifest[image[0]])
+                      for cluster in clusters for image in cluster[2]
+                      if image[0] in manifest)
+    return json_response([('locations', locations),
+                          ('location_aggregates', location_aggregates),
+                          ('clusters', clusters),
+                          ('cluster_aggregates', cluster_aggregates),
+                          ('thumbnails', thumbnails)],
+                         (parser.data_signature(), bbox, zoom))
+
+
+@app.route('/api/track')
+def track_level():
+    ''' Return the Iridium track, simplified for the requested zoom level.
+    '''
+    try:
+        zoom = int(request.args.get('zoom', track.MAX_ZOOM + 1))
+    except ValueError as error:
+        return flask.jsonify(error=str(error)), 400
+    # The version first, so the cached track is never older than its
+    # version.
+    version = parser.coordinates_version()
+    TRACK.update(parser.get_all_coordinates(version))
+    return json_response([('zoom', zoom), ('track', TRACK.level(zoom))],
+                         (version, zoom), TRACK_CACHE)
+
+
+@app.route('/api/data')
+def data():
+    ''' Return all coordinates, images and photo clusters. The rows are
+    written as they are read from the data files, in the same layout, up to
+    the data version the body is cached for.
+    '''
+    signature = parser.data_signature()
+    return json_response(
+        [('locations', parser.get_all_coordinates(signature[0])),
+         ('images', parser.get_all_images(signature[1])),
+         ('clusters', parser.get_all_clusters())],
+        signature, DATA_CACHE)
+
+
+def update_events(since):
+    ''' Yield the changes since the cursor as Server-Sent Events, until
+    UPDATES_STREAM_SECONDS passed. The first event only holds the cursor if
+    there is none yet. Every event has the cursor as its id, which the
+    browser sends back as Last-Event-ID when it reconnects.
+    '''
+    deadline = time.time() + UPDATES_STREAM_SECONDS
+    yield 'retry: 2000\n\n'
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        found = changes.wait_for_changes(since,
+                                         min(remaining, UPDATES_KEEPALIVE))
+        if since is None or changes.has_changes(found):
+            yield 'id: {0}\nevent: update\ndata: {1}\n\n'.format(
+                found['cursor'], json.dumps(found, separators=(',', ':')))
+            since = changes.parse_cursor(found['cursor'])
+        else:
+            yield ': keep-alive\n\n'
+
+
+@app.route('/api/updates')
+def updates():
+    ''' Return the coordinates, images and clusters that changed since the
+    cursor in the since parameter (or the Last-Event-ID header), together
+    with the new cursor. Without a cursor only the current cursor is
+    returned.
+
+    With wait=<seconds> the request is held until there are changes (long
+    poll). Clients accepting text/event-stream get all changes as
+    Server-Sent Events instead. Both wait only if fewer than
+    UPDATES_MAX_WAITING requests are waiting already, see there.
+    '''
+    try:
+        cursor = request.args.get('since') or \
+            request.headers.get('Last-Event-ID')
+        since = changes.parse_cursor(cursor) if cursor else None
+        wait = min(int(request.args.get('wait', 0)), UPDATES_MAX_WAIT)
+    except ValueError as error:
+        return flask.jsonify(error=str(error)), 400
+    stream = request.accept_mimetypes.best == 'text/event-stream'
+    waiting = (stream or wait > 0) and UPDATES_WAITING.acquire(False)
+    if stream and not waiting:
+        response = flask.Response(
+            'retry: {0}\n\n'.format(UPDATES_RETRY_SECONDS * 1000), 503,
+            mimetype='text/event-stream')
+        response.headers['Retry-After'] = str(UPDATES_RETRY_SECONDS)
+    elif stream:
+        response = flask.Response(update_events(since),
+                                  mimetype='text/event-stream')
+        # Tell nginx not to buffer the events.
+        response.headers['X-Accel-Buffering'] = 'no'
+        # The thread is held until the stream ends or the client leaves.
+        response.call_on_close(UPDATES_WAITING.release)
+    elif waiting:
+        try:
+            response = flask.jsonify(changes.wait_for_changes(since, wait))
+        finally:
+            UPDATES_WAITING.release()
+    elif wait > 0:
+        # Too many waiting already, the client polls again later.
+        found = changes.wait_for_changes(since, 0)
+        found['retry'] = UPDATES_RETRY_SECONDS
+        response = flask.jsonify(found)
+        response.headers['Retry-After'] = str(UPDATES_RETRY_SECONDS)
+    else:
+        response = flask.jsonify(changes.wait_for_changes(since, 0))
+    response.cache_control.no_cache = True
+    return response
 
 
 @app.route('/')
 def index():
-    return flask.render_template("index.html",
-                                 ACCESS_KEY=load_config('/config/config.json')['GOOGLE_MAP_KEY'])
+    cached = render_index_html()
+    response = flask.make_response(cached['body'])
+    response.set_etag(cached['etag'])
+    response.last_modified = cached['last_modified']
+    response.cache_control.max_age = INDEX_HTML_MAX_AGE
+    return response.make_conditional(request)
 
 
 @app.route("/api/coordinates/v1.0/", methods=['POST'])
@@ -40,14 +401,41 @@ def post():
     parsed = parser.parse_message(message)
     resp = MessagingResponse()
     if parsed != 0:
-        # Add the coordinates to our local coordinates file
-        with open(r'/data/coordinates.csv', 'a') as f:
-            writer = csv.writer(f)
-            writer.writerow(parsed)
+        # Queue the coordinates for our local database, they are stored in
+        # the background so Twilio gets its answer right away
+        ingest.COORDINATES_QUEUE.put(parsed)
         return str(resp), 200
     else:
         return str(resp), 500
 
 
+@app.route("/api/coordinates/v1.0/status")
+def post_status():
+    ''' Return the depth of the queue of coordinates that are not stored
+    yet, with its counters and flush timings.
+    '''
+    return flask.jsonify(ingest.COORDINATES_QUEUE.status())
+
+
+def warm_up():
+    ''' Fill the caches of this process, so that the first visitors do not
+    have to wait for them: the data readers, the spatial indices, the
+    simplified track and the rendered index.js.
+    '''
+    if SHARED_METRICS is not None:
+        SHARED_METRICS.start()
+    COORDINATES_INDEX.update(parser.get_all_coordinates())
+    CLUSTERS_INDEX.update(parser.get_all_clusters())
+    TRACK.update(parser.get_all_coordinates())
+    for zoom in range(track.MAX_ZOOM + 1):
+        TRACK.level(zoom)
+    parser.get_thumbnail_manifest()
+    with app.app_context():
+        render_index_html()
+        render_index_js()
+
+
 if __name__ == "__main__":
+    # Development server only, use serve.py in production.
+    storage.import_csv()
     app.run(host="0.0.0.0", port=5000, debug=False)
@@ -0,0 +1,470 @@
+'''
+Utilities for:
+    - writing the map data as static, pre-compressed JSON files, cut in tiles
+      of a geographic grid per zoom level, which nginx serves without asking
+      the app
+    - keeping one directory per data version, so the files never change and
+      can be cached by browsers for as long as they like
+    - building a new version in a process of its own whenever the data
+      changed, and swapping it in atomically with a small manifest
+
+The bundles of a data version are in BUNDLES_DIR/<version>:
+
+    tiles/index.json         the tiles that exist, by zoom level
+    tiles/<zoom>/<lat>_<lon>.json
+                             the points within a tile, as /api/points has
+                             them
+    track/<zoom>.json        the simplified track, as /api/track has it
+
+and BUNDLES_DIR/manifest.json names the current version. Every file is
+written next to a gzipped copy (.json.gz) for nginx's gzip_static.
+
+The builder runs as `python bundles.py`, started by serve.py. A full build
+takes seconds of CPU on a long trip, which would hold the GIL of a request
+worker for all that time. The workers only touch the trigger file after
+they stored coordinates.
+'''
+
+from __future__ import print_function
+from datetime import datetime
+import os
+import sys
+import json
+import time
+import zlib
+import shutil
+import hashlib
+try:
+    import fcntl
+except ImportError:  # Not on Windows, where only one process builds anyway.
+    fcntl = None
+import changes
+import compression
+import metrics
+import parser
+import spatial
+import storage
+import track
+
+BUNDLES_DIR = os.path.join(storage.DATA_DIR, 'bundles')
+MANIFEST_FILE = 'manifest.json'
+# Set STATIC_BUNDLES=0 to not write bundles. The map then asks the app.
+ENABLED = os.environ.get('STATIC_BUNDLES', '1') != '0'
+# A tile of zoom level z spans 360 / 2**z degrees of latitude and longitude,
+# TILE_CELLS by TILE_CELLS aggregation cells (see spatial.cell_size). The
+# tiles of DETAIL_ZOOM hold the individual points, for all higher zoom
+# levels.
+TILE_CELLS = 8
+DETAIL_ZOOM = spatial.DETAIL_ZOOM
+# Seconds between two looks at the data signature, and seconds to wait after
+# a change for more changes before building.
+POLL_INTERVAL = 2.0
+BUILD_DELAY = 1.0
+# The app touches this file in BUNDLES_DIR to have the builder look at the
+# data now, see trigger(). The builder looks at its time every
+# TRIGGER_INTERVAL seconds.
+TRIGGER_FILE = '.trigger'
+TRIGGER_INTERVAL = 0.2
+# The builder process runs at a lower priority than the request workers.
+BUILD_NICENESS = 10
+# A version is kept for KEEP_SECONDS after it was replaced, for maps that
+# still have its manifest: they look at the manifest every 30 seconds, or
+# once a minute in a background tab. The KEEP_VERSIONS newest are kept
+# whatever their age.
+KEEP_SECONDS = 600
+KEEP_VERSIONS = 2
+# The track levels change with every coordinate and are large on a long
+# trip. Level 9 only saves another 5% on them, at seven times the time.
+GZIP_LEVEL = 6
+
+BUILD_SECONDS = metrics.histogram('app_bundle_build_seconds',
+                                  'Seconds spent building the bundles.')
+BUILD_BYTES = metrics.gauge('app_bundle_bytes',
+                            'Size of the current bundles, by encoding.',
+                            ['encoding'])
+
+
+def coordinate_position(row):
+    ''' This function will return the (lat, lon) of a coordinate row. '''
+    return float(row[0]), float(row[1])
+
+
+def cluster_position(row):
+    ''' This function will return the (lat, lon) of a cluster row. '''
+    return float(row[1][0]), float(row[1][1])
+
+
+def tile_size(zoom):
+    ''' This function will return the size in degrees of the tiles of a zoom
+    level.
+    '''
+    return spatial.cell_size(zoom) * TILE_CELLS
+
+
+def index_tiles(index, zoom):
+    ''' This function will return the contents of all tiles of a zoom level
+    as a dict of [items, aggregates, number of points] by tile key (lat
+    key, lon key).
+    Arguments:
+        index -- the spatial.SpatialIndex of the points.
+        zoom  -- the zoom level, at most DETAIL_ZOOM.
+    '''
+    tiles = {}
+    if zoom >= DETAIL_ZOOM:
+        size = tile_size(DETAIL_ZOOM)
+        for position, item in zip(index.positions, index.items):
+            key = spatial.cell_key(position[0], position[1], size)
+            tile = tiles.setdefault(key, [[], [], 0])
+            tile[0].append(item)
+            tile[2] += 1
+        return tiles
+    # The tiles are aligned with the aggregation cells of the zoom level.
+    for key, cell in index.levels[zoom].items():
+        tile = tiles.setdefault((key[0] // TILE_CELLS, key[1] // TILE_CELLS),
+                                [[], [], 0])
+        if cell[2] == 1:
+            tile[0].append(index.items[cell[3]])
+        else:
+            tile[1].append([cell[0] / cell[2], cell[1] / cell[2], cell[2]])
+        tile[2] += cell[2]
+    return tiles
+
+
+def tile_fields(locations, clusters, thumbnail_manifest):
+    ''' This function will return the fields of the /api/points response
+    for a tile.
+    Arguments:
+        locations          -- the coordinates of the tile, see index_tiles.
+        clusters           -- the cluster centers of the tile.
+        thumbnail_manifest -- the thumbnail variants by image name.
+    '''
+    thumbnails = dict((image[0], thumbnail_manifest[image[0]])
+                      for cluster in clusters[0] for image in cluster[2]
+                      if image[0] in thumbnail_manifest)
+    return [('locations', locations[0]),
+            ('location_aggregates', locations[1]),
+            ('clusters', clusters[0]),
+            ('cluster_aggregates', clusters[1]),
+            ('thumbnails', thumbnails)]
+
+
+def link_json(source, filename, sizes):
+    ''' This function will link the file and its gzipped copy to those of
+    the previous version. Returns False if that failed.
+    Arguments:
+        source   -- name of the JSON file of the previous version.
+        filename -- name of the JSON file.
+        sizes    -- dict adding up the bytes per encoding.
+    '''
+    try:
+        os.link(source + '.gz', filename + '.gz')
+        os.link(source, filename)
+    except OSError:
+        return False  # Removed in the meantime, or no hard links here.
+    for encoding, name in (('identity', filename), ('gzip', filename + '.gz')):
+        sizes[encoding] = sizes.get(encoding, 0) + os.path.getsize(name)
+    return True
+
+
+def write_json(filename, fields, sizes, previous, written):
+    ''' This function will write the JSON object of the fields to the file,
+    and its gzipped copy next to it. Files that the previous version has
+    already are linked instead, which saves compressing them again.
+    Arguments:
+        filename -- name of the JSON file.
+        fields   -- list of (name, value) of the object.
+        sizes    -- dict adding up the bytes per encoding.
+        previous -- dict of the files of the previous version, by the digest
+                    of their contents.
+        written  -- dict that the file is added to, by its digest.
+    '''
+    body = b''.join(compression.json_chunks(fields))
+    digest = hashlib.sha1(body).hexdigest()
+    written[digest] = filename
+    if digest in previous and link_json(previous[digest], filename, sizes):
+        return
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    compressed = compressor.compress(body) + compressor.flush()
+    for name, data in ((filename, body), (filename + '.gz', compressed)):
+        if os.path.exists(name):
+            os.remove(name)  # A link to the previous version, keep that.
+        with open(name, 'wb') as outf:
+            outf.write(data)
+    sizes['identity'] = sizes.get('identity', 0) + len(body)
+    sizes['gzip'] = sizes.get('gzip', 0) + len(compressed)
+
+
+def write_bundles(directory, coordinates_index, clusters_index, track_levels,
+                  previous):
+    ''' This function will write the tiles and the track levels to the
+    directory. Returns the number of bytes per encoding, and the files by
+    the digest of their contents or by their fingerprint.
+
+    The indices only grow, so a tile of the same indices with as many
+    points as in the previous version did not change. Such a tile is found
+    by its fingerprint, and linked without building its contents again.
+    Arguments:
+        directory         -- the empty directory of the version.
+        coordinates_index -- spatial.SpatialIndex of the coordinates.
+        clusters_index    -- spatial.SpatialIndex of the cluster centers.
+        track_levels      -- track.Track of the coordinates.
+        previous          -- the files of the previous version, by digest
+                             or fingerprint.
+    '''
+    sizes = {}
+    written = {}
+    tile_index = {}
+    thumbnail_manifest = parser.get_thumbnail_manifest()
+    manifest_signature = parser.file_signature(parser.THUMBNAIL_MANIFEST)
+    for zoom in range(DETAIL_ZOOM + 1):
+        zoom_dir = os.path.join(directory, 'tiles', str(zoom))
+        os.makedirs(zoom_dir)
+        locations = index_tiles(coordinates_index, zoom)
+        clusters = index_tiles(clusters_index, zoom)
+        tile_index[str(zoom)] = keys = sorted(set(locations) | set(clusters))
+        for key in keys:
+            tile_locations = locations.get(key, [[], [], 0])
+            tile_clusters = clusters.get(key, [[], [], 0])
+            filename = os.path.join(zoom_dir, '{0}_{1}.json'.format(*key))
+            fingerprint = (zoom, key, coordinates_index, tile_locations[2],
+                           clusters_index, tile_clusters[2],
+                           manifest_signature)
+            written[fingerprint] = filename
+            if fingerprint in previous and \
+                    link_json(previous[fingerprint], filename, sizes):
+                continue
+            write_json(filename, tile_fields(tile_locations, tile_clusters,
+                                             thumbnail_manifest),
+                       sizes, previous, written)
+    write_json(os.path.join(directory, 'tiles', 'index.json'),
+               [('tiles', tile_index)], sizes, previous, written)
+    os.makedirs(os.path.join(directory, 'track'))
+    for zoom in range(track.MAX_ZOOM + 2):
+        write_json(os.path.join(directory, 'track', '{0}.json'.format(zoom)),
+                   [('zoom', zoom), ('track', track_levels.level(zoom))],
+                   sizes, previous, written)
+    return sizes, written
+
+
+def version_files(directory):
+    ''' This function will return the JSON files of a version by the digest
+    of their contents, see write_json.
+    '''
+    files = {}
+    for path, _, names in os.walk(directory):
+        for name in names:
+            if name.endswith('.json'):
+                filename = os.path.join(path, name)
+                with open(filename, 'rb') as infile:
+                    files[hashlib.sha1(infile.read()).hexdigest()] = filename
+    return files
+
+
+def manifest_version(directory):
+    ''' This function will return the version named by the manifest, or
+    None.
+    '''
+    try:
+        return parser.read_json(os.path.join(directory,
+                                             MANIFEST_FILE))['version']
+    except (EnvironmentError, ValueError, KeyError):
+        return None
+
+
+def trigger(directory=BUNDLES_DIR):
+    ''' This function will make the builder look at the data now instead of
+    at the next poll, by touching the trigger file.
+    '''
+    filename = os.path.join(directory, TRIGGER_FILE)
+    try:
+        with open(filename, 'a'):
+            os.utime(filename, None)
+    except EnvironmentError as error:
+        print('{0} !! triggering the bundle builder failed: {1}'.format(
+            datetime.now(), error))
+
+
+def trigger_time(directory):
+    ''' This function will return the time the trigger file was last
+    touched, or None.
+    '''
+    try:
+        return os.path.getmtime(os.path.join(directory, TRIGGER_FILE))
+    except EnvironmentError:
+        return None
+
+
+def data_version():
+    ''' This function will return the name of the current data version: the
+    cursor of the data (see changes.format_cursor) and a hash of the
+    signatures of the data files.
+    '''
+    digest = hashlib.sha1(repr(parser.data_signature()).encode('utf-8'))
+    return '{0}-{1}'.format(changes.format_cursor(changes.current_version()),
+                            digest.hexdigest()[:8])
+
+
+def remove_old_versions(directory, current, now=None):
+    ''' This function will remove the versions that were replaced more than
+    KEEP_SECONDS ago, except the current one and the KEEP_VERSIONS newest
+    others. A version was replaced when the next newer one was written.
+    Arguments:
+        directory -- the directory of the bundles.
+        current   -- the name of the current version.
+        now       -- the time in seconds since the epoch, by default now.
+    '''
+    if now is None:
+        now = time.time()
+    versions = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            versions.append((os.path.getmtime(path), name, path))
+    kept = 0
+    replaced = now
+    for written, name, path in sorted(versions, reverse=True):
+        if name != current:
+            if kept < KEEP_VERSIONS or replaced > now - KEEP_SECONDS:
+                kept += 1
+            else:
+                shutil.rmtree(path, ignore_errors=True)
+        replaced = written
+
+
+class BundleBuilder(object):
+    ''' Builds the bundles of the current data version, run by the builder
+    process.
+
+    The builder looks at the data signature every POLL_INTERVAL seconds, and
+    right away after trigger(), so new coordinates are in the bundles within
+    seconds and new clusters as soon as the images service wrote them. Of
+    all builders, only the one holding the lock file builds.
+
+    The builder has spatial indices and a track of its own, brought up to
+    date with the rows added since the last build.
+    '''
+
+    def __init__(self, directory=BUNDLES_DIR):
+        ''' Arguments:
+            directory -- the directory of the bundles.
+        '''
+        self.coordinates_index = spatial.RowIndex(coordinate_position)
+        self.clusters_index = spatial.RowIndex(cluster_position)
+        self.track = track.Track(coordinate_position)
+        self.directory = directory
+        self.triggered = trigger_time(directory)
+        # The files of the current version by digest or fingerprint, see
+        # write_bundles, and its name.
+        self.written = {}
+        self.written_version = None
+
+    def wait(self, timeout):
+        ''' Wait until the trigger file is touched, at most timeout
+        seconds. Returns whether it was.
+        '''
+        deadline = time.time() + timeout
+        while True:
+            triggered = trigger_time(self.directory)
+            if triggered != self.triggered:
+                self.triggered = triggered
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(TRIGGER_INTERVAL)
+
+    def run(self, parent=None):
+        ''' Build the bundles whenever the data changed, until the parent
+        process (by pid) exited, if given, or forever.
+        '''
+        while parent is None or os.getppid() == parent:
+            try:
+                self.build()
+            except Exception as error:  # pylint: disable=broad-except
+                print('{0} !! building the bundles failed: {1}'.format(
+                    datetime.now(), error))
+            if self.wait(POLL_INTERVAL):
+                # Let a burst of changes settle.
+                time.sleep(BUILD_DELAY)
+
+    def build(self):
+        ''' Build the bundles of the current version, if no process did so
+        yet. Returns the manifest of the new version, or None.
+        '''
+        version = data_version()
+        if os.path.exists(os.path.join(self.directory, version)):
+            return None
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    return None  # Another process is building.
+            version = data_version()
+            if os.path.exists(os.path.join(self.directory, version)):
+                return None
+            with BUILD_SECONDS.time():
+                return self.write_version(version)
+
+    def write_version(self, version):
+        ''' Write the bundles of the version and make it the current one. '''
+        coordinates = parser.get_all_coordinates()
+        coordinates_index = self.coordinates_index.update(coordinates)
+        clusters_index = self.clusters_index.update(parser.get_all_clusters())
+        self.track.update(coordinates)
+        previous = manifest_version(self.directory)
+        if previous != self.written_version:
+            # Written by another process.
+            self.written = {}
+            if previous is not None:
+                self.written = version_files(os.path.join(self.directory,
+                                                          previous))
+            self.written_version = previous
+        temp_dir = os.path.join(self.directory, '.{0}-{1}'.format(
+            version, os.getpid()))
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+        os.makedirs(temp_dir)
+        try:
+            sizes, written = write_bundles(temp_dir, coordinates_index,
+                                           clusters_index, self.track,
+                                           self.written)
+            os.rename(temp_dir, os.path.join(self.directory, version))
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        prefix = len(temp_dir)
+        self.written = dict(
+            (digest, os.path.join(self.directory, version) + name[prefix:])
+            for digest, name in written.items())
+        self.written_version = version
+        manifest = {'version': version,
+                    'created': datetime.utcnow().isoformat() + 'Z',
+                    'latest': parser.get_latest_coordinate(),
+                    'detail_zoom': DETAIL_ZOOM,
+                    'tile_cells': TILE_CELLS,
+                    'cell_pixels': spatial.CELL_PIXELS,
+                    'track_zoom': track.MAX_ZOOM + 1}
+        temp_manifest = os.path.join(self.directory, MANIFEST_FILE + '.tmp')
+        with open(temp_manifest, 'w') as outf:
+            json.dump(manifest, outf, default=str)
+        os.rename(temp_manifest, os.path.join(self.directory, MANIFEST_FILE))
+        remove_old_versions(self.directory, version)
+        for encoding, size in sizes.items():
+            BUILD_BYTES.set(size, encoding=encoding)
+        return manifest
+
+
+if __name__ == '__main__':
+    # Started by serve.py, with its pid as the argument. The snapshots of
+    # this process are counted by /metrics like those of the request
+    # workers.
+    if os.environ.get('METRICS_DIR'):
+        metrics.SharedMetrics(os.environ['METRICS_DIR']).start()
+    if hasattr(os, 'nice'):
+        os.nice(BUILD_NICENESS)
+    if not os.path.isdir(BUNDLES_DIR):
+        os.makedirs(BUNDLES_DIR)
+    BundleBuilder().run(parent=int(sys.argv[1]) if len(sys.argv) > 1
+                        else os.getppid())
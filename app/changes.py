@@ -0,0 +1,198 @@
+'''
+Utilities for:
+    - describing the version of all map data as a cursor
+    - returning only the coordinates, images and clusters that changed since
+      a cursor
+    - waiting for the next change without asking the database once per
+      waiting client
+'''
+
+import time
+import sqlite3
+import threading
+import parser
+import storage
+
+# The counter bumped by the images service every time it wrote the clusters.
+CLUSTERS_COUNTER = 'clusters_version'
+# Upper limit on the number of coordinates or images in one update. A client
+# that is further behind gets the rest with its next request.
+MAX_ROWS = 5000
+# Seconds between two looks at the database by the watcher.
+POLL_INTERVAL = 1.0
+
+
+def current_version():
+    ''' This function will return the version of the map data:
+    (coordinates generation, last coordinate id, images generation, last
+    image id, clusters version).
+    '''
+    return storage.get_version('coordinates') + \
+        storage.get_version('images') + \
+        (storage.get_counter(CLUSTERS_COUNTER),)
+
+
+def format_cursor(version):
+    ''' This function will return the cursor string of a version. '''
+    return '-'.join(str(number) for number in version)
+
+
+def parse_cursor(cursor):
+    ''' This function will return the version of a cursor string, or raise a
+    ValueError if it is not a cursor.
+    '''
+    version = tuple(int(number) for number in cursor.split('-'))
+    if len(version) != 5 or min(version) < 0:
+        raise ValueError('not a valid cursor: {0}'.format(cursor))
+    return version
+
+
+def table_changes(table, generation, last_id, since):
+    ''' This function will return (reset, rows, last id) of the rows of the
+    table that were added after the given version, up to the current one.
+    Arguments:
+        table      -- 'coordinates' or 'images'.
+        generation -- the current generation of the table.
+        last_id    -- the current id of the last row.
+        since      -- (generation, last id) known by the client.
+    '''
+    reset = since[0] != generation
+    if reset:
+        # The rows were rewritten: everything is new.
+        since = (generation, 0)
+    elif since[1] >= last_id:
+        # Another process of the app may have seen a newer version.
+        return False, [], since[1]
+    rows = [(number, row) for number, row in
+            storage.get_rows(table, since[1], MAX_ROWS) if number <= last_id]
+    if len(rows) < MAX_ROWS:
+        return reset, [row for _, row in rows], last_id
+    return reset, [row for _, row in rows], rows[-1][0]
+
+
+def get_changes(since, version):
+    ''' This function will return the changes between the two versions as a
+    dict with the new cursor and the new coordinates and images. If the
+    clusters changed, all clusters are included. 'reset' tells the client to
+    forget what it has, and 'more' that there are more changes waiting.
+    Arguments:
+        since   -- the version known by the client, None for no changes.
+        version -- the version to bring the client up to, see
+                   VersionWatcher.current().
+    '''
+    changes = {'reset': False, 'more': False, 'coordinates': [],
+               'images': [], 'clusters': None}
+    if since is None or since == version:
+        changes['cursor'] = format_cursor(version)
+        return changes
+    reset, changes['coordinates'], coordinates_id = table_changes(
+        'coordinates', version[0], version[1], since[0:2])
+    changes['reset'] |= reset
+    reset, changes['images'], images_id = table_changes(
+        'images', version[2], version[3], since[2:4])
+    changes['reset'] |= reset
+    if version[4] != since[4]:
+        changes['clusters'] = parser.get_all_clusters()
+    changes['more'] = coordinates_id < version[1] or images_id < version[3]
+    changes['cursor'] = format_cursor((version[0], coordinates_id,
+                                       version[2], images_id, version[4]))
+    return changes
+
+
+def has_changes(changes):
+    ''' This function will return True if the changes contain anything but
+    the cursor.
+    '''
+    return changes['reset'] or bool(changes['coordinates']) or \
+        bool(changes['images']) or changes['clusters'] is not None
+
+
+def wait_for_changes(since, timeout, watcher=None):
+    ''' This function will return the changes since the cursor version as
+    soon as there are any, or no changes once the timeout passed.
+    Arguments:
+        since   -- the version known by the client, None for no changes.
+        timeout -- the maximum number of seconds to wait.
+        watcher -- the VersionWatcher, WATCHER by default.
+    '''
+    watcher = watcher or WATCHER
+    deadline = time.time() + timeout
+    version = watcher.current()
+    while True:
+        changes = get_changes(since, version)
+        remaining = deadline - time.time()
+        if since is None or has_changes(changes) or remaining <= 0:
+            return changes
+        version = watcher.wait(version, remaining)
+
+
+class VersionWatcher(object):
+    ''' Watches the version of the map data in a background thread.
+
+    Clients waiting for a change wait on a condition instead of asking the
+    database themselves, so a thousand open map tabs cost the same as one:
+    a look at the database every POLL_INTERVAL seconds.
+    '''
+
+    def __init__(self, read_version=current_version):
+        ''' Arguments:
+            read_version -- function returning the current version.
+        '''
+        self.read_version = read_version
+        self.condition = threading.Condition()
+        self.version = None
+        self.thread = None
+
+    def start(self):
+        ''' Start the watcher thread, unless it is running already. '''
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                self.version = self.read_version()
+                self.thread = threading.Thread(target=self.run,
+                                               name='version-watcher')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        ''' Look at the version forever, waking up the waiting clients
+        whenever it changed.
+        '''
+        while True:
+            time.sleep(POLL_INTERVAL)
+            try:
+                version = self.read_version()
+            except sqlite3.Error:
+                continue  # Busy or being replaced, try again later.
+            with self.condition:
+                if version != self.version:
+                    self.version = version
+                    self.condition.notify_all()
+
+    def current(self):
+        ''' Return the current version, as last seen by the watcher. Changes
+        are only handed out up to this version, so that a client can
+        always wait for the next one with wait().
+        '''
+        self.start()
+        with self.condition:
+            return self.version
+
+    def wait(self, version, timeout):
+        ''' Wait until the version differs from the given one, or the timeout
+        passed, and return the current version.
+        Arguments:
+            version -- the version the client knows.
+            timeout -- the maximum number of seconds to wait.
+        '''
+        self.start()
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.version == version:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.version
+
+
+WATCHER = VersionWatcher()
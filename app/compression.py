@@ -0,0 +1,136 @@
+'''
+Utilities for:
+    - writing large JSON documents in chunks, without building the whole
+      document in memory first
+    - compressing responses with brotli (if installed) or gzip, as accepted
+      by the client
+    - keeping the compressed bodies of the latest data versions in memory
+'''
+
+import json
+import zlib
+import threading
+from collections import OrderedDict
+try:
+    import brotli
+except ImportError:  # Optional, gzip is used without it.
+    brotli = None
+
+# The encodings we can send, the preferred one first.
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Number of rows written as one chunk of a JSON list.
+ROWS_PER_CHUNK = 1000
+
+
+def best_encoding(accept_encodings):
+    ''' This function will return the preferred encoding that the client
+    accepts, or 'identity' if it accepts none of them.
+    Arguments:
+        accept_encodings -- the parsed Accept-Encoding header of the request.
+    '''
+    for encoding in ENCODINGS:
+        if accept_encodings[encoding]:
+            return encoding
+    return 'identity'
+
+
+def json_chunks(fields):
+    ''' This function will yield a JSON object in chunks of encoded text. The
+    lists are written ROWS_PER_CHUNK rows at a time, so at no point is more
+    than one chunk of text in memory.
+    Arguments:
+        fields -- list of (name, value) of the object. Values that are lists
+                  are written row by row.
+    '''
+    separator = b'{'
+    for name, value in fields:
+        yield separator + json.dumps(name).encode('utf-8') + b':'
+        separator = b','
+        if not isinstance(value, list):
+            yield json.dumps(value, separators=(',', ':')).encode('utf-8')
+            continue
+        # Rows appended while writing are left for the next version.
+        length = len(value)
+        yield b'['
+        for start in range(0, length, ROWS_PER_CHUNK):
+            chunk = json.dumps(value[start:min(length,
+                                               start + ROWS_PER_CHUNK)],
+                               separators=(',', ':'))
+            yield (b',' if start else b'') + chunk[1:-1].encode('utf-8')
+        yield b']'
+    yield b'}' if separator == b',' else b'{}'
+
+
+class Compressor(object):
+    ''' Incremental compressor with the same interface for every encoding.
+    '''
+
+    def __init__(self, encoding):
+        ''' Arguments:
+            encoding -- 'br' or 'gzip'.
+        '''
+        if encoding == 'br':
+            self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            self.compress = self.compressor.process
+            self.flush = self.compressor.finish
+        else:
+            # wbits 31 writes the gzip header and trailer.
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            self.compress = self.compressor.compress
+            self.flush = self.compressor.flush
+
+
+def compress_chunks(chunks, encoding):
+    ''' This function will yield the compressed chunks.
+    Arguments:
+        chunks   -- iterable of bytes.
+        encoding -- 'br', 'gzip' or 'identity'.
+    '''
+    if encoding == 'identity':
+        for chunk in chunks:
+            yield chunk
+        return
+    compressor = Compressor(encoding)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class EncodedCache(object):
+    ''' Compressed bodies, keyed on (key, encoding). Only the most recently
+    used entries are kept; the key should contain the data version, so an
+    entry never has to be invalidated.
+    '''
+
+    def __init__(self, size):
+        ''' Arguments:
+            size -- the number of bodies to keep.
+        '''
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key, encoding, chunks):
+        ''' Return the compressed body for the key, compressing the chunks
+        returned by chunks() if it is not cached.
+        Arguments:
+            key      -- hashable key that includes the data version.
+            encoding -- 'br' or 'gzip'.
+            chunks   -- function returning the uncompressed chunks.
+        '''
+        with self.lock:
+            body = self.entries.pop((key, encoding), None)
+            if body is not None:
+                self.entries[(key, encoding)] = body
+                return body
+        # Compress outside the lock, a duplicate effort beats waiting.
+        body = b''.join(compress_chunks(chunks(), encoding))
+        with self.lock:
+            self.entries[(key, encoding)] = body
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return body
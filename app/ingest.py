@@ -0,0 +1,190 @@
+'''
+Utilities for:
+    - storing the coordinates received by the webhook in the background, so
+      the webhook can reply to Twilio before anything is written to disk
+    - monitoring the coordinates that are waiting to be stored
+'''
+
+from __future__ import print_function
+from datetime import datetime
+import os
+import time
+import atexit
+import threading
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+import metrics
+import storage
+
+# The writer waits this many seconds after the first coordinate of a batch for
+# more to arrive, and never stores more than BATCH_SIZE at once.
+FLUSH_INTERVAL = float(os.environ.get('INGEST_FLUSH_INTERVAL', '0.5'))
+BATCH_SIZE = 500
+# Seconds before storing a batch is tried again after it failed, for
+# example because the disk or the database did.
+RETRY_INTERVAL = 5.0
+# Seconds to wait at exit for the coordinates still in the queue.
+EXIT_TIMEOUT = 10.0
+
+STORED = metrics.counter('app_ingest_coordinates_total',
+                         'Coordinates taken from the queue, by result.',
+                         ['result'])
+FLUSH_SECONDS = metrics.histogram('app_ingest_flush_seconds',
+                                  'Seconds spent storing a batch.')
+DELAY_SECONDS = metrics.histogram(
+    'app_ingest_delay_seconds',
+    'Seconds from receiving the first coordinate of a batch to having it '
+    'on disk.')
+
+
+class WriteBehindQueue(object):
+    ''' Queue of parsed coordinates, stored in batches by a background
+    thread.
+
+    Every batch is synced to disk before it counts as stored, and coordinates
+    that are already stored (Twilio retried the webhook) are skipped. A batch
+    that can not be stored is kept and tried again, so nothing that was
+    accepted is lost while the process keeps running.
+    '''
+
+    def __init__(self, store=storage.add_new_coordinates, on_stored=None):
+        ''' Arguments:
+            store     -- function storing a list of rows, returning the
+                         number of rows that were new.
+            on_stored -- function called after a batch added new rows.
+        '''
+        self.store = store
+        self.on_stored = on_stored
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.counters = {'received': 0, 'stored': 0, 'duplicates': 0,
+                         'batches': 0, 'errors': 0}
+        self.timings = {'last_flush_seconds': None,
+                        'max_flush_seconds': 0.0,
+                        'last_delay_seconds': None,
+                        'max_delay_seconds': 0.0,
+                        'last_flush': None}
+
+    def start(self):
+        ''' Start the writer thread, unless it is running already. It is
+        started from the first put(), so that every process forked by a
+        server gets a thread of its own.
+        '''
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run,
+                                               name='write-behind')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def put(self, row):
+        ''' Queue a coordinate [lat, lon, alt, time] to be stored. '''
+        self.start()
+        with self.lock:
+            self.counters['received'] += 1
+        self.queue.put((time.time(), row))
+
+    def run(self):
+        ''' Store the queued coordinates, batch by batch, forever. '''
+        while True:
+            self.flush(self.take())
+
+    def take(self):
+        ''' Wait for a coordinate, then return it together with the ones
+        that arrive within FLUSH_INTERVAL, as a list of (queued, row).
+        '''
+        batch = [self.queue.get()]
+        deadline = time.time() + FLUSH_INTERVAL
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self, batch):
+        ''' Store a batch of (queued, row), retrying until it succeeds.
+        Whatever the error, the batch is kept and the writer thread keeps
+        running.
+        '''
+        while True:
+            started = time.time()
+            try:
+                added = self.store([row for _, row in batch])
+                break
+            except Exception as error:  # pylint: disable=broad-except
+                with self.lock:
+                    self.counters['errors'] += 1
+                print('{0} !! storing {1} coordinates failed: {2}, retry in '
+                      '{3:.1f}s'.format(datetime.now(), len(batch), error,
+                                        RETRY_INTERVAL))
+                time.sleep(RETRY_INTERVAL)
+        finished = time.time()
+        with self.lock:
+            self.counters['batches'] += 1
+            self.counters['stored'] += added
+            self.counters['duplicates'] += len(batch) - added
+            flush_seconds = finished - started
+            delay_seconds = finished - min(queued for queued, _ in batch)
+            self.timings['last_flush_seconds'] = flush_seconds
+            self.timings['max_flush_seconds'] = max(
+                self.timings['max_flush_seconds'], flush_seconds)
+            self.timings['last_delay_seconds'] = delay_seconds
+            self.timings['max_delay_seconds'] = max(
+                self.timings['max_delay_seconds'], delay_seconds)
+            self.timings['last_flush'] = finished
+        STORED.inc(added, result='stored')
+        STORED.inc(len(batch) - added, result='duplicate')
+        FLUSH_SECONDS.observe(flush_seconds)
+        DELAY_SECONDS.observe(delay_seconds)
+        for _ in batch:
+            self.queue.task_done()
+        if added and self.on_stored is not None:
+            try:
+                self.on_stored()
+            except Exception as error:  # pylint: disable=broad-except
+                print('{0} !! after storing {1} coordinates: {2}'.format(
+                    datetime.now(), added, error))
+
+    def wait(self, timeout=EXIT_TIMEOUT):
+        ''' Wait until every queued coordinate is stored, or the timeout
+        passed. Returns True if the queue is empty.
+        '''
+        deadline = time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def status(self):
+        ''' Return the queue depth, counters and flush timings as a dict.
+        The delay is the time from receiving a coordinate to having it on
+        disk.
+        '''
+        with self.lock:
+            status = dict(self.counters)
+            status.update(self.timings)
+        status['depth'] = self.queue.qsize()
+        status['running'] = self.thread is not None and self.thread.is_alive()
+        return status
+
+
+COORDINATES_QUEUE = WriteBehindQueue()
+
+
+@atexit.register
+def store_pending():
+    ''' Give the writer a chance to store what is still queued at exit. '''
+    if COORDINATES_QUEUE.thread is not None and \
+            not COORDINATES_QUEUE.wait():
+        print('{0} !! exiting with {1} coordinates not stored'.format(
+            datetime.now(), COORDINATES_QUEUE.queue.qsize()))
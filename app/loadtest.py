@@ -0,0 +1,143 @@
+'''
+Load test of a running app: requests /, /index.js and the webhook from a
+number of concurrent clients and reports the requests per second and the
+p50/p99 latency of every endpoint.
+
+The webhook requests store new coordinates, so only point this at a test
+instance:
+
+    python loadtest.py http://localhost:5000 --requests 2000 --concurrency 20
+'''
+
+from __future__ import print_function
+import sys
+import time
+import argparse
+import threading
+try:
+    from http.client import HTTPConnection
+    from urllib.parse import urlparse, urlencode
+except ImportError:  # Python 2
+    from httplib import HTTPConnection
+    from urlparse import urlparse
+    from urllib import urlencode
+
+ENDPOINTS = ('/', '/index.js', '/api/coordinates/v1.0/')
+WEBHOOK = '/api/coordinates/v1.0/'
+
+
+def webhook_body(number):
+    ''' Return the form body of a webhook request with a unique Iridium
+    message, so that no request is dropped as a duplicate.
+    Arguments:
+        number -- the number of the request.
+    '''
+    seconds = number % 60
+    minutes = number // 60 % 60
+    hours = number // 3600 % 24
+    day = number // 86400 % 28 + 1
+    message = ('Lat-{0}deg{1}\'{2}" Lon-{3}deg{4}\'{5}" Alt+{6} m (load test) '
+               '{7:02d}-Jan-2030 {8:02d}:{9:02d}:{10:02d} UTC load test'
+               .format(number % 50, number % 60, number % 59, number % 80,
+                       number % 60, number % 57, number % 3000, day, hours,
+                       minutes, seconds))
+    return urlencode({'Body': message})
+
+
+def percentile(values, fraction):
+    ''' Return the given fraction (0-1) percentile of the sorted values. '''
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_client(url, path, numbers, results):
+    ''' Send the requests with the given numbers over one keep-alive
+    connection, appending (seconds, status) to the results.
+    Arguments:
+        url     -- the parsed base URL.
+        path    -- the endpoint to request.
+        numbers -- iterator of request numbers, shared by the clients.
+        results -- list to append the results to.
+    '''
+    connection = HTTPConnection(url.hostname, url.port or 80, timeout=60)
+    for number in numbers:
+        headers = {}
+        body = None
+        method = 'GET'
+        if path == WEBHOOK:
+            method = 'POST'
+            body = webhook_body(number)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        started = time.time()
+        try:
+            connection.request(method, url.path.rstrip('/') + path, body,
+                               headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+        except (IOError, OSError):
+            connection.close()
+            connection = HTTPConnection(url.hostname, url.port or 80,
+                                        timeout=60)
+            status = None
+        results.append((time.time() - started, status))
+    connection.close()
+
+
+def load_test(base_url, path, requests, concurrency):
+    ''' Return the results of sending the requests to the endpoint from
+    concurrent clients: (wall seconds, [(seconds, status)]).
+    '''
+    url = urlparse(base_url)
+    numbers = iter(range(int(time.time()) % 100000 * requests,
+                         (int(time.time()) % 100000 + 1) * requests))
+    lock = threading.Lock()
+
+    def shared_numbers():
+        while True:
+            with lock:
+                number = next(numbers, None)
+            if number is None:
+                return
+            yield number
+
+    results = []
+    threads = [threading.Thread(target=run_client,
+                                args=(url, path, shared_numbers(), results))
+               for _ in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - started, results
+
+
+def main(arguments):
+    ''' Run the load test of every endpoint and print a report. '''
+    options = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    options.add_argument('url', help='base URL of the app')
+    options.add_argument('--requests', type=int, default=1000,
+                         help='number of requests per endpoint')
+    options.add_argument('--concurrency', type=int, default=10,
+                         help='number of concurrent clients')
+    options.add_argument('--endpoint', action='append',
+                         help='endpoint to test, repeat for more '
+                              '(default: {0})'.format(', '.join(ENDPOINTS)))
+    options = options.parse_args(arguments)
+    print('{0:<24} {1:>8} {2:>10} {3:>10} {4:>10} {5:>7}'.format(
+        'endpoint', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for path in options.endpoint or ENDPOINTS:
+        seconds, results = load_test(options.url, path, options.requests,
+                                     options.concurrency)
+        latencies = sorted(result[0] * 1000 for result in results)
+        errors = sum(1 for result in results
+                     if result[1] is None or result[1] >= 400)
+        print('{0:<24} {1:>8} {2:>10.1f} {3:>10.1f} {4:>10.1f} {5:>7}'.format(
+            path, len(results), len(results) / seconds,
+            percentile(latencies, 0.5), percentile(latencies, 0.99), errors))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -2,14 +2,60 @@
 Freija <freija@gmail.com>, 2017
 Utilities for:
     - parsing text message from Iridium phone to grab GPS information
-    - reading in information from the local files that contain datapoints for
-      GPS and photo
+    - reading in information from the local database and files that contain
+      datapoints for GPS and photo
 '''
 
+from __future__ import print_function
+from collections import namedtuple
 from datetime import datetime
+import os
 import re
+import sys
 import csv
 import ast
+import json
+import bisect
+import threading
+import metrics
+import storage
+
+CLUSTERS_FILE = os.path.join(storage.DATA_DIR, 'image_clusters.csv')
+CLUSTERS_JSON_FILE = os.path.join(storage.DATA_DIR, 'image_clusters.jsonl')
+THUMBNAIL_MANIFEST = os.path.join(storage.DATA_DIR, 'images',
+                                  'manifest.json')
+DATA_FILES = (CLUSTERS_FILE, CLUSTERS_JSON_FILE, THUMBNAIL_MANIFEST)
+
+MESSAGE_REGEX = re.compile(r'^'
+                           r'Lat([0-9\s\-]+)deg(\d+)\'(\d+)\"\s'
+                           r'Lon([0-9\s\-]+)deg(\d+)\'(\d+)\"\s'
+                           r'Alt[+-](\d+)\s\w{1,3}\s'
+                           r'\(.+?\)\s'
+                           r'(\d{2})-([A-Za-z]{3})-(\d{4})\s'
+                           r'(\d{2}):(\d{2}):(\d{2})\sUTC\s'
+                           r'.+'
+                           r'$')
+# Month abbreviations as used in the messages, much faster than strptime.
+MONTHS = dict((month, number + 1) for number, month in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+     'jul', 'aug', 'sep', 'oct', 'nov', 'dec']))
+
+# Returned by parse_messages() for the messages that could not be parsed.
+ParseError = namedtuple('ParseError', ['number', 'message', 'reason'])
+
+# Parsed contents of the data files, keyed on filename. Every entry keeps the
+# signature of the file it was read from, so a file is only parsed again once
+# it has actually changed on disk.
+_FILE_CACHE = {}
+
+ROWS_READ = metrics.counter('app_rows_read_total',
+                            'Rows read from the database.', ['table'])
+READ_SECONDS = metrics.histogram(
+    'app_read_seconds', 'Seconds spent reading new rows from the database.',
+    ['table'])
+PARSE_SECONDS = metrics.histogram('app_parse_seconds',
+                                  'Seconds spent parsing a data file.',
+                                  ['file'])
 
 
 def nospace(input_string):
@@ -31,63 +77,216 @@ def deg_min_sec_todeg(deg, minute, sec):
         return degrees
 
 
+def read_message(message):
+    ''' This function will parse the message to produce a coordinate
+    data-point [lat, lon, alt, time], or raise a ValueError explaining why
+    that is not possible.
+    Arguments:
+        message  -- input message that needs to be parsed.
+    '''
+    matches = MESSAGE_REGEX.match(message)
+    if not matches:
+        raise ValueError('not an Iridium location message')
+    groups = matches.groups()
+    month = MONTHS.get(groups[8].lower())
+    if month is None:
+        raise ValueError('unknown month {0}'.format(groups[8]))
+    return [deg_min_sec_todeg(groups[0], groups[1], groups[2]),
+            deg_min_sec_todeg(groups[3], groups[4], groups[5]),
+            int(groups[6]),
+            datetime(int(groups[9]), month, int(groups[7]),
+                     int(groups[10]), int(groups[11]), int(groups[12]))]
+
+
 def parse_message(message):
     ''' This function will check if the posted message is valid and then
     proceed to parse it to produce a coordinate data-point.
     Arguments:
         message  -- input message that needs to be checked.
     '''
-    result = []
-    message_regex = re.compile(r'^'
-                               r'Lat([0-9\s\-]+)deg(\d+)\'(\d+)\"\s'
-                               r'Lon([0-9\s\-]+)deg(\d+)\'(\d+)\"\s'
-                               r'Alt[+-](\d+)\s\w{1,3}\s'
-                               r'\(.+?\)\s'
-                               r'(\d{2}-[A-Za-z]{3}-\d{4}\s'
-                               r'\d{2}:\d{2}:\d{2})\sUTC\s'
-                               r'.+'
-                               r'$')
-    matches = message_regex.match(message)
-    if matches:
-        lat_deg = matches.group(1)
-        lat_min = matches.group(2)
-        lat_sec = matches.group(3)
-        lon_deg = matches.group(4)
-        lon_min = matches.group(5)
-        lon_sec = matches.group(6)
-        result.append(deg_min_sec_todeg(lat_deg, lat_min, lat_sec))
-        result.append(deg_min_sec_todeg(lon_deg, lon_min, lon_sec))
-        result.append(int(matches.group(7)))
-        result.append(datetime.strptime(matches.group(8), '%d-%b-%Y %H:%M:%S'))
-        return result
-    else:
+    try:
+        return read_message(message)
+    except ValueError:
         return 0
 
 
-def get_all_coordinates():
-    ''' This function will retrieve the coordinates from the local csv file.
+def parse_messages(messages):
+    ''' This function will parse the messages one by one, yielding the
+    coordinate data-point of every valid message and a ParseError for every
+    other one.
+    Arguments:
+        messages -- iterable of input messages, for example an open file.
+    '''
+    for number, message in enumerate(messages, 1):
+        message = message.strip()
+        try:
+            yield read_message(message)
+        except ValueError as error:
+            yield ParseError(number, message, str(error))
+
+
+def import_messages(filename):
+    ''' This function will add the coordinates of all messages in a text
+    dump (one message per line) to the database, skipping the ones that are
+    already stored.
+    Arguments:
+        filename -- name of the text dump.
+    '''
+    rows = []
+    errors = 0
+    with open(filename, 'r') as infile:
+        for parsed in parse_messages(infile):
+            if isinstance(parsed, ParseError):
+                errors += 1
+                if parsed.message:
+                    print('Line {0}: {1}'.format(parsed.number,
+                                                 parsed.reason))
+            else:
+                rows.append(parsed)
+    added = storage.backfill_coordinates(rows)
+    print('Parsed {0} messages, added {1} new coordinates, {2} lines were '
+          'skipped'.format(len(rows), added, errors))
+
+
+def file_signature(filename):
+    ''' This function will return a tuple that changes whenever the given file
+    is modified or replaced, or None if the file does not exist.
+    Arguments:
+        filename -- name of the file to check.
+    '''
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+def coordinates_version():
+    ''' This function will return a value that changes whenever coordinates
+    are added.
     Arguments:
         None
     '''
-    result = []
-    with open('/data/coordinates.csv', 'r') as infile:
-        reader = csv.reader(infile)
-        for row in reader:
-            result.append(row)
-    return result
+    return storage.get_version('coordinates')
 
 
-def get_all_images():
-    ''' This function will retrieve the image details from the local csv file.
+def coordinates_modified():
+    ''' This function will return the time the coordinates were last
+    changed, as a datetime, or None if that is not known.
     Arguments:
         None
     '''
-    result = []
-    with open('/data/images.csv', 'r') as infile:
-        reader = csv.reader(infile)
-        for row in reader:
-            result.append(row)
-    return result
+    modified = storage.get_modified('coordinates')
+    if modified is None:
+        return None
+    return datetime.utcfromtimestamp(modified)
+
+
+def data_signature():
+    ''' This function will return the combined signature of all data.
+    Arguments:
+        None
+    '''
+    return (storage.get_version('coordinates'),
+            storage.get_version('images')) + \
+        tuple(file_signature(filename) for filename in DATA_FILES)
+
+
+def cached_read(filename, loader):
+    ''' This function will return loader(filename), re-using the previous
+    result for as long as the file signature stays the same.
+    Arguments:
+        filename -- name of the file to read.
+        loader   -- function that parses the file and returns its contents.
+    '''
+    signature = file_signature(filename)
+    cached = _FILE_CACHE.get(filename)
+    if cached is None or cached[0] != signature:
+        with PARSE_SECONDS.time(file=os.path.basename(filename)):
+            cached = (signature, loader(filename))
+        _FILE_CACHE[filename] = cached
+    return cached[1]
+
+
+class AppendOnlyTableReader(object):
+    ''' Incremental reader for a table of the database that only grows.
+
+    The reader remembers the id of the last row it read and only asks the
+    database for the rows after it on the next read. If the rows were
+    rewritten (a new generation), or the table ends before that id because
+    the database was replaced, everything is read again.
+
+    The lists it returns are never changed afterwards, new rows go into a
+    new list, so they can be written out while other threads read on. The
+    row objects are shared between those lists, which is how the spatial
+    index and the track know that rows continue those they had.
+    '''
+
+    def __init__(self, table):
+        self.table = table
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        ''' Forget everything that was read so far. '''
+        self.generation = None
+        self.last_id = 0
+        self.ids = []
+        self.rows = []
+
+    def read(self, version=None):
+        ''' Return the rows of the table up to the given version (see
+        storage.get_version), only reading those that were added since the
+        previous call. Take the version before anything that depends on the
+        rows, so that the rows are never older than the version. Without a
+        version all rows are returned.
+        '''
+        with self.lock:
+            generation, last_id = storage.get_version(self.table)
+            if generation != self.generation or last_id < self.last_id:
+                self.reset()
+                self.generation = generation
+            if last_id > self.last_id:
+                with READ_SECONDS.time(table=self.table):
+                    new_rows = storage.get_rows(self.table, self.last_id)
+                    self.ids = self.ids + [row_id for row_id, _ in new_rows]
+                    self.rows = self.rows + [row for _, row in new_rows]
+                ROWS_READ.inc(len(new_rows), table=self.table)
+                self.last_id = new_rows[-1][0]
+            if version is None or version[0] != self.generation or \
+                    version[1] >= self.last_id:
+                return self.rows
+            return self.rows[:bisect.bisect_right(self.ids, version[1])]
+
+
+COORDINATES_READER = AppendOnlyTableReader('coordinates')
+IMAGES_READER = AppendOnlyTableReader('images')
+
+
+def get_all_coordinates(version=None):
+    ''' This function will retrieve all coordinates from the database.
+    Arguments:
+        version -- only the coordinates up to this coordinates_version(),
+                   all by default.
+    '''
+    return COORDINATES_READER.read(version)
+
+
+def get_all_images(version=None):
+    ''' This function will retrieve the image details from the database.
+    Arguments:
+        version -- only the images up to this version of the images table,
+                   all by default.
+    '''
+    return IMAGES_READER.read(version)
+
+
+def get_latest_coordinate():
+    ''' This function will retrieve the most recent coordinate.
+    Arguments:
+        None
+    '''
+    return storage.get_latest_coordinate()
 
 
 def get_all_clusters():
@@ -95,8 +294,56 @@ def get_all_clusters():
     Arguments:
         None
     '''
+    # The JSON lines file is much faster to parse. Older deployments of the
+    # images service only write the csv file, so fall back to that one.
+    if os.path.exists(CLUSTERS_JSON_FILE):
+        return cached_read(CLUSTERS_JSON_FILE, read_cluster_lines)
+    return cached_read(CLUSTERS_FILE, read_cluster_rows)
+
+
+def get_thumbnail_manifest():
+    ''' This function will retrieve the thumbnail variants of every image from
+    the manifest written by the images service. Images that are not in there
+    only have the old png thumbnail.
+    Arguments:
+        None
+    '''
+    if not os.path.exists(THUMBNAIL_MANIFEST):
+        return {}
+    return cached_read(THUMBNAIL_MANIFEST, read_json)
+
+
+def read_json(filename):
+    ''' This function will parse the given JSON file.
+    Arguments:
+        filename -- name of the JSON file.
+    '''
+    with open(filename, 'r') as infile:
+        return json.load(infile)
+
+
+def read_cluster_lines(filename):
+    ''' This function will parse the cluster JSON lines file written by the
+    images service.
+    Arguments:
+        filename -- name of the cluster JSON lines file.
+    '''
+    result = []
+    with open(filename, 'r') as infile:
+        for line in infile:
+            if line.strip():
+                result.append(json.loads(line))
+    return result
+
+
+def read_cluster_rows(filename):
+    ''' This function will parse the (legacy) cluster csv file written by the
+    images service.
+    Arguments:
+        filename -- name of the cluster csv file.
+    '''
     result = []
-    with open('/data/image_clusters.csv', 'r') as infile:
+    with open(filename, 'r') as infile:
         reader = csv.reader(infile)
         for row in reader:
             this_row = []
@@ -104,3 +351,11 @@ def get_all_clusters():
                 this_row.append(ast.literal_eval(item))
             result.append(this_row)
     return result
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'import':
+        import_messages(sys.argv[2])
+    else:
+        print('Usage: python parser.py import <text dump of Iridium messages>')
+        sys.exit(1)
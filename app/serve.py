@@ -0,0 +1,150 @@
+'''
+Production entry point of the app: serves app.py with a multi-process,
+multi-threaded WSGI server instead of Flask's development server.
+
+Configured with environment variables:
+    SERVER  -- 'gunicorn' (default), 'waitress' or 'flask' (development).
+    PORT    -- port to listen on, 5000 by default.
+    WORKERS -- number of worker processes (gunicorn only), by default two per
+               CPU plus one.
+    THREADS -- number of request threads per worker process.
+    TIMEOUT -- seconds before gunicorn restarts a worker that hangs.
+Every worker fills its caches before it accepts requests. The gunicorn
+workers share their metrics (see app.METRICS_DIR) through a temporary
+directory, unless METRICS_DIR is set.
+
+The static bundles (see bundles.py) are built by a process of their own,
+so a full build does not hold the GIL of a worker while it answers
+requests. It runs at a lower priority and adds its metrics to those of the
+workers. Another process started here ("python serve.py bundle-builder")
+starts it and starts it again whenever it exits: the gunicorn arbiter reaps
+every child process of its own, so it can not wait for the builder itself.
+'''
+
+from __future__ import print_function
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import multiprocessing
+
+SERVER = os.environ.get('SERVER', 'gunicorn')
+PORT = int(os.environ.get('PORT', '5000'))
+WORKERS = int(os.environ.get('WORKERS', multiprocessing.cpu_count() * 2 + 1))
+THREADS = int(os.environ.get('THREADS', '4'))
+TIMEOUT = int(os.environ.get('TIMEOUT', '60'))
+# Seconds to wait before starting the bundle builder again after it exited.
+BUILDER_RESTART_DELAY = 5.0
+
+
+def warm_up_worker(worker=None):
+    ''' Fill the caches of a worker process. A failure is not fatal, the
+    caches are then filled by the first requests instead.
+    Arguments:
+        worker -- the gunicorn worker, if any.
+    '''
+    import app
+    try:
+        app.warm_up()
+    except Exception as error:
+        print('Warming up the caches failed: {0}'.format(error))
+
+
+def run_bundle_builder(server):
+    ''' Run the bundle builder process, and run it again whenever it
+    exits, until the server process exited. The builder exits by itself
+    once this process is gone.
+    Arguments:
+        server -- the pid of the server process, the parent of this one.
+    '''
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'bundles.py')
+    while os.getppid() == server:
+        code = subprocess.call([sys.executable, script, str(os.getpid())])
+        if os.getppid() != server:
+            break
+        print('The bundle builder exited with {0}, starting it again in '
+              '{1} seconds'.format(code, BUILDER_RESTART_DELAY))
+        time.sleep(BUILDER_RESTART_DELAY)
+
+
+def start_bundle_builder(server=None):
+    ''' Start the process running the bundle builder in the background,
+    unless the static bundles are disabled. gunicorn calls this once the
+    arbiter is ready (when_ready).
+    Arguments:
+        server -- the gunicorn arbiter, if any.
+    '''
+    import bundles
+    if not bundles.ENABLED:
+        return
+    subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                      'bundle-builder', str(os.getpid())])
+
+
+def serve_gunicorn():
+    ''' Serve the app with gunicorn, WORKERS processes of THREADS threads.
+    The app is imported by every worker itself, so no database connection
+    or background thread is shared between processes.
+    '''
+    from gunicorn.app.base import BaseApplication
+    # Read by app.py in every worker, and by the bundle builder.
+    if not os.environ.get('METRICS_DIR'):
+        os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='metrics-')
+
+    class Application(BaseApplication):
+        ''' gunicorn application configured from this module. '''
+
+        def load_config(self):
+            settings = {'bind': '0.0.0.0:{0}'.format(PORT),
+                        'workers': WORKERS,
+                        'threads': THREADS,
+                        'worker_class': 'gthread',
+                        'timeout': TIMEOUT,
+                        'accesslog': '-',
+                        'when_ready': start_bundle_builder,
+                        'post_worker_init': warm_up_worker}
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            import app
+            return app.app
+
+    Application().run()
+
+
+def serve_waitress():
+    ''' Serve the app with waitress, one process of THREADS threads. '''
+    import waitress
+    import app
+    start_bundle_builder()
+    warm_up_worker()
+    waitress.serve(app.app, host='0.0.0.0', port=PORT, threads=THREADS)
+
+
+def serve_flask():
+    ''' Serve the app with Flask's development server. '''
+    import app
+    start_bundle_builder()
+    app.app.run(host='0.0.0.0', port=PORT, debug=False, threaded=True)
+
+
+SERVERS = {'gunicorn': serve_gunicorn,
+           'waitress': serve_waitress,
+           'flask': serve_flask}
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['bundle-builder']:
+        run_bundle_builder(int(sys.argv[2]))
+        sys.exit(0)
+    if SERVER not in SERVERS:
+        print('Unknown SERVER {0!r}, use one of: {1}'.format(
+            SERVER, ', '.join(sorted(SERVERS))))
+        sys.exit(1)
+    # Once, before any process stores a row.
+    import storage
+    storage.import_csv()
+    SERVERS[SERVER]()
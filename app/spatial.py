@@ -0,0 +1,240 @@
+'''
+Utilities for:
+    - indexing the map points in a grid, so that the points within the map
+      bounds can be found without looking at every point
+    - aggregating the points per grid cell for the low zoom levels, so that
+      responses stay small no matter how long the trip gets
+'''
+
+import math
+import threading
+
+# Below this zoom level the points are aggregated, one aggregate per grid
+# cell of CELL_PIXELS by CELL_PIXELS screen pixels.
+DETAIL_ZOOM = 10
+CELL_PIXELS = 32
+# The highest zoom level of Google Maps. Queries at higher levels are
+# answered as at this one.
+MAX_ZOOM = 22
+# A query never looks at more grid cells than this; the zoom level is lowered
+# until the bounding box fits.
+MAX_CELLS = 4096
+# Size in degrees of the grid cells in which the individual points are kept.
+POINT_CELL_SIZE = 0.25
+# Upper limit on the number of individual points in one response, beyond
+# this the points are aggregated anyway.
+MAX_POINTS = 2000
+
+
+def cell_size(zoom):
+    ''' This function will return the size in degrees of the aggregation grid
+    cells at the given zoom level. A 256 pixel Google Maps tile spans
+    360 / 2**zoom degrees of longitude.
+    Arguments:
+        zoom -- the map zoom level.
+    '''
+    return CELL_PIXELS * 360.0 / (256 * 2 ** zoom)
+
+
+def cell_key(lat, lon, size):
+    ''' This function will return the grid cell containing the coordinate.
+    Arguments:
+        lat, lon -- coordinate in degrees.
+        size     -- size of the grid cells in degrees.
+    '''
+    return (int(math.floor(lat / size)), int(math.floor(lon / size)))
+
+
+def split_bbox(bbox):
+    ''' This function will return the bounding box as a list of boxes that do
+    not cross the antimeridian.
+    Arguments:
+        bbox -- (south, west, north, east) in degrees.
+    '''
+    south, west, north, east = bbox
+    if west <= east:
+        return [bbox]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+
+def count_cells(bbox, size):
+    ''' This function will return the number of grid cells covering the
+    bounding box.
+    Arguments:
+        bbox -- (south, west, north, east) in degrees.
+        size -- size of the grid cells in degrees.
+    '''
+    total = 0
+    for south, west, north, east in split_bbox(bbox):
+        low = cell_key(south, west, size)
+        high = cell_key(north, east, size)
+        total += (high[0] - low[0] + 1) * (high[1] - low[1] + 1)
+    return total
+
+
+def cells_in_bbox(bbox, size):
+    ''' This function will yield the keys of the grid cells covering the
+    bounding box.
+    Arguments:
+        bbox -- (south, west, north, east) in degrees.
+        size -- size of the grid cells in degrees.
+    '''
+    for south, west, north, east in split_bbox(bbox):
+        low = cell_key(south, west, size)
+        high = cell_key(north, east, size)
+        for lat_key in range(low[0], high[0] + 1):
+            for lon_key in range(low[1], high[1] + 1):
+                yield (lat_key, lon_key)
+
+
+def in_bbox(lat, lon, bbox):
+    ''' This function will return True if the coordinate lies in the box.
+    Arguments:
+        lat, lon -- coordinate in degrees.
+        bbox     -- (south, west, north, east) in degrees.
+    '''
+    return any(south <= lat <= north and west <= lon <= east
+               for south, west, north, east in split_bbox(bbox))
+
+
+class SpatialIndex(object):
+    ''' Grid index of map points.
+
+    Every point is kept in a grid of POINT_CELL_SIZE degrees. For every zoom
+    level below DETAIL_ZOOM there is also a grid holding the sum of the
+    coordinates and the number of points per cell, which is all that is
+    needed to show one aggregate marker per cell. Points can only be added,
+    which is all the append-only data files need.
+    '''
+
+    def __init__(self):
+        self.positions = []
+        self.items = []
+        self.cells = {}
+        self.levels = [{} for _ in range(DETAIL_ZOOM)]
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, lat, lon, item):
+        ''' Add a point to the index.
+        Arguments:
+            lat, lon -- coordinate in degrees.
+            item     -- the value returned for this point by query().
+        '''
+        number = len(self.items)
+        self.positions.append((lat, lon))
+        self.items.append(item)
+        key = cell_key(lat, lon, POINT_CELL_SIZE)
+        self.cells.setdefault(key, []).append(number)
+        for zoom, level in enumerate(self.levels):
+            key = cell_key(lat, lon, cell_size(zoom))
+            cell = level.get(key)
+            if cell is None:
+                level[key] = [lat, lon, 1, number]
+            else:
+                cell[0] += lat
+                cell[1] += lon
+                cell[2] += 1
+                cell[3] = number
+
+    def aggregate(self, bbox, zoom):
+        ''' Return the aggregates within the bounding box at the given zoom
+        level. Cells holding only a single point return that point's item.
+        Arguments:
+            bbox -- (south, west, north, east) in degrees.
+            zoom -- the map zoom level, below DETAIL_ZOOM.
+        '''
+        items = []
+        aggregates = []
+        level = self.levels[zoom]
+        for key in cells_in_bbox(bbox, cell_size(zoom)):
+            cell = level.get(key)
+            if cell is None:
+                continue
+            if cell[2] == 1:
+                items.append(self.items[cell[3]])
+            else:
+                aggregates.append([cell[0] / cell[2], cell[1] / cell[2],
+                                   cell[2]])
+        return items, aggregates
+
+    def query(self, bbox, zoom):
+        ''' Return the items and the aggregates ([lat, lon, count]) that
+        should be shown within the bounding box at the given zoom level.
+        Arguments:
+            bbox -- (south, west, north, east) in degrees.
+            zoom -- the map zoom level.
+        '''
+        zoom = min(max(0, int(zoom)), MAX_ZOOM)
+        # Never look at more cells than MAX_CELLS, whatever the client asks.
+        while zoom > 0 and count_cells(bbox, cell_size(zoom)) > MAX_CELLS:
+            zoom -= 1
+        if zoom < DETAIL_ZOOM:
+            return self.aggregate(bbox, zoom)
+        numbers = []
+        for key in cells_in_bbox(bbox, POINT_CELL_SIZE):
+            for number in self.cells.get(key, ()):
+                lat, lon = self.positions[number]
+                if in_bbox(lat, lon, bbox):
+                    numbers.append(number)
+        if len(numbers) > MAX_POINTS:
+            return self.aggregate(bbox, DETAIL_ZOOM - 1)
+        numbers.sort()
+        return [self.items[number] for number in numbers], []
+
+
+def follows(rows, indexed_rows, indexed):
+    ''' Return whether the rows are those of which the first indexed ones
+    were indexed before, or fewer of them. The readers of the data share
+    the row objects between the lists they return until the data is
+    replaced.
+    Arguments:
+        rows         -- the rows to index.
+        indexed_rows -- the rows indexed before.
+        indexed      -- the number of rows indexed before.
+    '''
+    known = min(len(rows), indexed)
+    if known == 0:
+        return len(rows) > 0 or indexed == 0
+    return rows[known - 1] is indexed_rows[known - 1]
+
+
+class RowIndex(object):
+    ''' Spatial index that follows a list of rows from the data files.
+
+    Rows appended to the list are added to the index on the next update. If
+    the reader returns other rows than those indexed so far, the file was
+    replaced and the index is built again, see follows.
+    '''
+
+    def __init__(self, position):
+        ''' Arguments:
+            position -- function returning the (lat, lon) of a row.
+        '''
+        self.position = position
+        self.lock = threading.Lock()
+        self.rows = []
+        self.indexed = 0
+        self.index = SpatialIndex()
+
+    def update(self, rows):
+        ''' Bring the index up to date with the given rows and return it.
+        Arguments:
+            rows -- all rows of the data file.
+        '''
+        with self.lock:
+            if not follows(rows, self.rows, self.indexed):
+                self.indexed = 0
+                self.index = SpatialIndex()
+            if len(rows) <= self.indexed:
+                return self.index
+            for row in rows[self.indexed:]:
+                try:
+                    lat, lon = self.position(row)
+                except (ValueError, TypeError, IndexError):
+                    continue  # Not a valid coordinate, not shown on the map.
+                self.index.add(lat, lon, row)
+            self.rows = rows
+            self.indexed = len(rows)
+            return self.index
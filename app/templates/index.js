@@ -1,6 +1,17 @@
+    // The thumbnail variants of the images in the shown clusters. Older images
+    // only have a png.
+    var thumbnails = {};
+    function thumbnailUrl(name, size) {
+        var variants = thumbnails[name];
+        if( variants && variants[size] ) {
+            return '{{base_url|safe}}/images/' + variants[size];
+        }
+        return '{{base_url|safe}}/images/' + name.replace("jpg", "png");
+    }
     function initMap() {
-        var markers = {{locations|safe}};
-        var centerpoint = new google.maps.LatLng(parseFloat(markers[markers.length -1][0]), parseFloat(markers[markers.length -1][1]));
+        // The last received Iridium location, this is where the map starts.
+        var latest = {{latest|safe}};
+        var centerpoint = new google.maps.LatLng(parseFloat(latest[0]), parseFloat(latest[1]));
         var map = new google.maps.Map(document.getElementById('map'), {
           zoom: 7,
           center: centerpoint,
@@ -9,96 +20,317 @@
         var infowindow = new google.maps.InfoWindow({
            maxWidth: 400
         });
-        /// Add the image cluster locations
-        // This is an example of the cluster information:
-        // ['130',
-        //  '[-12.044581875003733, -77.02696227777153]',
-        //  "[['IMG_20170721_151308.jpg', -12.044618583333332, -77.02700805555557, 160, '2017-07-21 20:13:07'],
-        //    ['IMG_20170721_151316.jpg', -12.044545166666667, -77.0269165, 177, '2017-07-21 20:13:16']]"]
-        var cluster_markers = {{clusters|safe}}
-        var cluster, i;
-        for( i = 0; i < cluster_markers.length; i++ ) {
-            var position = new google.maps.LatLng(parseFloat(cluster_markers[i][1][0]), parseFloat(cluster_markers[i][1][1]));
-            cluster = new google.maps.Marker({
-              icon: {
-                  path: google.maps.SymbolPath.CIRCLE,
-                  strokeWeight: 2,
-                  fillOpacity: 1,
-                  strokeColor: '#008000',
-                  fillColor: '#FFFFFF',
-                  scale: 3,
-                },
-                position: position,
-                map: map
-              });
-              google.maps.event.addListener(cluster, 'click', (function(cluster, i) {
-                  return function() {
-                    // InfoWindow content: show all pictures in the cluster
-                    var content = '';
-                    for ( j = 0; j < cluster_markers[i][2].length ; j++ ) {
-                      content += '<IMG BORDER="0" STYLE="width:100%" SRC="{{base_url|safe}}/images/' + cluster_markers[i][2][j][0].replace("jpg", "png") + '">'
-                    };
-                    infowindow.setContent(content);
-                    infowindow.open(map, cluster);
-                  }
-              })(cluster, i));
-        };
-        // Add the Iridium Markers
-        var marker;
-        for( i = 0; i < markers.length; i++ ) {
-          var position = new google.maps.LatLng(parseFloat(markers[i][0]), parseFloat(markers[i][1]));
-          if( i< markers.length-1 ) {
-            marker = new google.maps.Marker({
-              icon: {
-                path: google.maps.SymbolPath.CIRCLE,
-                strokeWeight: 2,
-                fillOpacity: 1,
-                strokeColor: '#FF0000',
-                fillColor: '#FFFFFF',
-                scale: 5,
-              },
-              position: position,
-              map: map
+        var latest_marker = new google.maps.Marker({
+          position: centerpoint,
+          map: map
+        });
+        google.maps.event.addListener(latest_marker, 'click', function() {
+          infowindow.setContent("Date: " + latest[3]+ " \nAltitude: " +  latest[2] + "m" );
+          infowindow.open(map, latest_marker);
+        });
+        // The markers currently on the map, replaced whenever the map moves.
+        var shown_markers = [];
+        function addMarker(lat, lon, color, scale, content) {
+          var marker = new google.maps.Marker({
+            icon: {
+              path: google.maps.SymbolPath.CIRCLE,
+              strokeWeight: 2,
+              fillOpacity: 1,
+              strokeColor: color,
+              fillColor: '#FFFFFF',
+              scale: scale,
+            },
+            position: new google.maps.LatLng(parseFloat(lat), parseFloat(lon)),
+            map: map
+          });
+          google.maps.event.addListener(marker, 'click', function() {
+            infowindow.setContent(content());
+            infowindow.open(map, marker);
+          });
+          shown_markers.push(marker);
+          return marker;
+        }
+        function addAggregate(aggregate, color) {
+          // Several points in one grid cell: clicking zooms in on them.
+          var marker = new google.maps.Marker({
+            icon: {
+              path: google.maps.SymbolPath.CIRCLE,
+              strokeWeight: 2,
+              fillOpacity: 1,
+              strokeColor: color,
+              fillColor: '#FFFFFF',
+              scale: 8 + Math.min(8, Math.log(aggregate[2])),
+            },
+            label: String(aggregate[2]),
+            position: new google.maps.LatLng(aggregate[0], aggregate[1]),
+            map: map
+          });
+          google.maps.event.addListener(marker, 'click', function() {
+            map.setCenter(marker.getPosition());
+            map.setZoom(map.getZoom() + 2);
+          });
+          shown_markers.push(marker);
+        }
+        function showPoints(data) {
+          var i;
+          for( i = 0; i < shown_markers.length; i++ ) {
+            shown_markers[i].setMap(null);
+          }
+          shown_markers = [];
+          thumbnails = data.thumbnails;
+          /// Add the image cluster locations
+          // This is an example of the cluster information:
+          // [130,
+          //  [-12.044581875003733, -77.02696227777153],
+          //  [['IMG_20170721_151308.jpg', -12.044618583333332, -77.02700805555557, 160, '2017-07-21 20:13:07'],
+          //   ['IMG_20170721_151316.jpg', -12.044545166666667, -77.0269165, 177, '2017-07-21 20:13:16']]]
+          data.clusters.forEach(function(cluster) {
+            addMarker(cluster[1][0], cluster[1][1], '#008000', 3, function() {
+              // InfoWindow content: show small versions of all pictures in
+              // the cluster, each linking to the medium version.
+              var content = '';
+              for ( var j = 0; j < cluster[2].length ; j++ ) {
+                var name = cluster[2][j][0];
+                if( thumbnails[name] ) {
+                  content += '<A HREF="' + thumbnailUrl(name, 'medium') + '" TARGET="_blank"><IMG BORDER="0" STYLE="width:150px" SRC="' + thumbnailUrl(name, 'small') + '"></A>'
+                }
+                else {
+                  content += '<IMG BORDER="0" STYLE="width:100%" SRC="' + thumbnailUrl(name, 'medium') + '">'
+                }
+              };
+              return content;
+            });
+          });
+          data.cluster_aggregates.forEach(function(aggregate) {
+            addAggregate(aggregate, '#008000');
+          });
+          // Add the Iridium Markers
+          data.locations.forEach(function(location) {
+            if( location[3] == latest[3] ) {
+              return;  // Already shown as the last received location.
+            }
+            addMarker(location[0], location[1], '#FF0000', 5, function() {
+              return "Date: " + location[3]+ " \nAltitude: " +  location[2] + "m";
             });
+          });
+          data.location_aggregates.forEach(function(aggregate) {
+            addAggregate(aggregate, '#FF0000');
+          });
+        }
+        // The route, simplified for the current zoom level.
+        var route = new google.maps.Polyline({
+          strokeColor: '#FF0000',
+          strokeOpacity: 0.6,
+          strokeWeight: 2,
+          map: map
+        });
+        var route_zoom = null;
+        function getJSON(url, onload, onerror) {
+          // onerror gets the HTTP status, 0 if there was no response.
+          var request = new XMLHttpRequest();
+          request.open('GET', url);
+          request.onload = function() {
+            if( request.status == 200 ) {
+              onload(JSON.parse(request.responseText));
+            }
+            else if( onerror ) {
+              onerror(request.status);
+            }
+          };
+          request.onerror = function() {
+            if( onerror ) {
+              onerror(0);
+            }
+          };
+          request.send();
+        }
+        // The map data as static files written by the app, see bundles.py:
+        // the manifest of the current version, the url of its files and the
+        // tiles that exist per zoom level. It stays undefined until the
+        // manifest was read, and is null if there are no static files. The
+        // map then asks the app instead.
+        var bundles = undefined;
+        var bundles_url = '{{base_url|safe}}/bundles/';
+        // Seconds between two looks at the manifest for a new version.
+        var manifest_interval = 30;
+        function staleBundles(status) {
+          // The files of old versions are removed after a while. A file
+          // that is gone means there is a newer version.
+          if( status == 404 && bundles ) {
+            loadManifest();
+          }
+        }
+        function showRoute() {
+          var zoom = map.getZoom();
+          if( zoom == route_zoom ) {
+            return;
+          }
+          route_zoom = zoom;
+          var url = '/api/track?zoom=' + zoom;
+          if( bundles ) {
+            url = bundles.url + 'track/' + Math.min(zoom, bundles.manifest.track_zoom) + '.json';
           }
-          else {
-            marker = new google.maps.Marker({
-              position: position,
-              map: map
+          getJSON(url, function(data) {
+            if( zoom == route_zoom ) {
+              route.setPath(data.track.map(function(point) {
+                return new google.maps.LatLng(point[0], point[1]);
+              }));
+            }
+          }, function(status) {
+            if( zoom == route_zoom ) {
+              route_zoom = null;  // Ask again next time.
+            }
+            staleBundles(status);
+          });
+        }
+        function tileUrls() {
+          // The tiles of the current version covering the map bounds, on
+          // both sides of the antimeridian if need be.
+          var manifest = bundles.manifest;
+          var zoom = Math.min(map.getZoom(), manifest.detail_zoom);
+          var size = manifest.cell_pixels * 360 / (256 * Math.pow(2, zoom)) * manifest.tile_cells;
+          var bounds = map.getBounds();
+          var south = bounds.getSouthWest().lat(), west = bounds.getSouthWest().lng();
+          var north = bounds.getNorthEast().lat(), east = bounds.getNorthEast().lng();
+          var lons = west <= east ? [[west, east]] : [[west, 180], [-180, east]];
+          var existing = bundles.tiles[zoom] || {};
+          var urls = [];
+          lons.forEach(function(range) {
+            for( var lat = Math.floor(south / size); lat <= Math.floor(north / size); lat++ ) {
+              for( var lon = Math.floor(range[0] / size); lon <= Math.floor(range[1] / size); lon++ ) {
+                if( existing[lat + '_' + lon] ) {
+                  urls.push(bundles.url + 'tiles/' + zoom + '/' + lat + '_' + lon + '.json');
+                }
+              }
+            }
+          });
+          return urls;
+        }
+        // Only fetch what is within the map bounds, every time the map
+        // stops moving. Responses to older requests are ignored.
+        var request_number = 0;
+        function showMap() {
+          if( bundles === undefined ) {
+            return;  // Shown once the manifest was read.
+          }
+          showRoute();
+          var this_request = ++request_number;
+          if( !bundles ) {
+            getJSON('/api/points?bbox=' + map.getBounds().toUrlValue() + '&zoom=' + map.getZoom(), function(data) {
+              if( this_request == request_number ) {
+                showPoints(data);
+              }
             });
+            return;
           }
-          google.maps.event.addListener(marker, 'click', (function(marker, i) {
-          return function() {
-            infowindow.setContent("Date: " + markers[i][3]+ " \nAltitude: " +  markers[i][2] + "m" );
-            infowindow.open(map, marker);
+          var urls = tileUrls();
+          var data = {locations: [], location_aggregates: [], clusters: [],
+                      cluster_aggregates: [], thumbnails: {}};
+          // The points are shown once every tile was read or failed, a
+          // failed tile is left out until the map is shown again.
+          var pending = urls.length;
+          var failed = 0;
+          function tileDone() {
+            if( --pending == 0 && this_request == request_number && failed < urls.length ) {
+              showPoints(data);
+            }
+          }
+          if( pending == 0 ) {
+            showPoints(data);
+          }
+          urls.forEach(function(url) {
+            getJSON(url, function(tile) {
+              ['locations', 'location_aggregates', 'clusters', 'cluster_aggregates'].forEach(function(field) {
+                data[field] = data[field].concat(tile[field]);
+              });
+              for( var name in tile.thumbnails ) {
+                data.thumbnails[name] = tile.thumbnails[name];
+              }
+              tileDone();
+            }, function(status) {
+              failed++;
+              tileDone();
+              if( failed == 1 ) {
+                staleBundles(status);
+              }
+            });
+          });
+        }
+        map.addListener('idle', showMap);
+        function showLatest(location) {
+          if( location[3] > latest[3] ) {
+            latest = location;
+          }
+          if( latest_marker.getPosition().lat() != parseFloat(latest[0]) ||
+              latest_marker.getPosition().lng() != parseFloat(latest[1]) ) {
+            latest_marker.setPosition(new google.maps.LatLng(parseFloat(latest[0]), parseFloat(latest[1])));
+          }
+        }
+        // Seconds that /api/updates holds a request until something changes,
+        // and seconds to wait after a failed request.
+        var updates_wait = 25;
+        var updates_retry = 30;
+        function listenForUpdates(cursor) {
+          // Listen for new coordinates and photos with long polls, and show
+          // them without reloading the page. Every answer holds the cursor
+          // to ask with next, so nothing is missed in between. When the app
+          // is busy it answers right away and says when to come back.
+          var url = '/api/updates?wait=' + updates_wait;
+          if( cursor ) {
+            url += '&since=' + encodeURIComponent(cursor);
+          }
+          getJSON(url, function(changes) {
+            if( cursor ) {
+              changes.coordinates.forEach(showLatest);
+              if( changes.reset || changes.coordinates.length || changes.images.length || changes.clusters ) {
+                route_zoom = null;
+                showMap();
+              }
+            }
+            setTimeout(function() {
+              listenForUpdates(changes.cursor);
+            }, (changes.retry || 0) * 1000);
+          }, function() {
+            setTimeout(function() {
+              listenForUpdates(cursor);
+            }, updates_retry * 1000);
+          });
+        }
+        function noBundles() {
+          if( bundles === undefined ) {
+            bundles = null;
+            listenForUpdates();
+            showMap();
           }
-          })(marker, i));
-    };
-    // Add the image locations as well
-    //var image_markers = {{images|safe}}
-    //var image;
-    //for( i = 0; i < image_markers.length; i++ ) {
-    //  if( image_markers[i][0] == 1 ) {
-    //    var position = new google.maps.LatLng(parseFloat(image_markers[i][2]), parseFloat(image_markers[i][3]));
-    //    image = new google.maps.Marker({
-    //      icon: {
-    //          path: google.maps.SymbolPath.CIRCLE,
-    //          strokeWeight: 2,
-    //          fillOpacity: 1,
-    //          strokeColor: '#000000',
-    //          fillColor: '#FFFFFF',
-    //          scale: 2,
-    //        },
-    //        position: position,
-    //        map: map
-    //      });
-    //      google.maps.event.addListener(image, 'click', (function(image, i) {
-    //      return function() {
-            //infowindow.setContent("Date: " + image_markers[i][4]+ " \nAltitude: " +  image_markers[i][3] + "m" );
-    //        infowindow.setContent('<IMG BORDER="0" STYLE="width:100%" SRC="{{base_url|safe}}/images/' + image_markers[i][1].replace("jpg", "png") + '">' + image_markers[i][5]);
-    //        infowindow.open(map, image);
-    //      }
-    //    })(image, i));
-    //  };
-    //};
+        }
+        function loadManifest() {
+          // Switch to the newest version of the static files. The files of
+          // a version never change, the manifest is the only one that the
+          // browser has to ask for again.
+          getJSON(bundles_url + 'manifest.json', function(manifest) {
+            if( bundles && bundles.manifest.version == manifest.version ) {
+              return;
+            }
+            var url = bundles_url + manifest.version + '/';
+            getJSON(url + 'tiles/index.json', function(index) {
+              var tiles = {};
+              for( var zoom in index.tiles ) {
+                tiles[zoom] = {};
+                index.tiles[zoom].forEach(function(key) {
+                  tiles[zoom][key[0] + '_' + key[1]] = true;
+                });
+              }
+              if( bundles === undefined ) {
+                setInterval(loadManifest, manifest_interval * 1000);
+              }
+              bundles = {manifest: manifest, url: url, tiles: tiles};
+              if( manifest.latest ) {
+                showLatest(manifest.latest);
+              }
+              route_zoom = null;
+              showMap();
+            }, noBundles);
+          }, noBundles);
+        }
+        loadManifest();
     }
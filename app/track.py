@@ -0,0 +1,208 @@
+'''
+Utilities for:
+    - simplifying the Iridium track with Douglas-Peucker on the sphere
+    - keeping a simplified track for every zoom level up to date while new
+      coordinates are appended
+'''
+
+import math
+import threading
+import spatial
+
+# Highest zoom level with its own simplified track; above it the full track
+# is returned.
+MAX_ZOOM = 14
+# Allowed deviation of the simplified track from the real one, in screen
+# pixels at the zoom level the track is made for.
+TOLERANCE_PIXELS = 1.0
+# The track is simplified per chunk of this many points. A completed chunk is
+# never simplified again, only the last chunk changes when points are added.
+CHUNK_SIZE = 256
+
+
+def tolerance(zoom):
+    ''' This function will return the tolerance in radians at the given zoom
+    level. A 256 pixel Google Maps tile spans 2 pi / 2**zoom radians along
+    the equator.
+    Arguments:
+        zoom -- the map zoom level.
+    '''
+    return TOLERANCE_PIXELS * 2.0 * math.pi / (256 * 2 ** zoom)
+
+
+def to_vector(lat, lon):
+    ''' This function will return the unit vector of the coordinate.
+    Arguments:
+        lat, lon -- coordinate in degrees.
+    '''
+    lat = math.radians(lat)
+    lon = math.radians(lon)
+    return (math.cos(lat) * math.cos(lon),
+            math.cos(lat) * math.sin(lon),
+            math.sin(lat))
+
+
+def cross(first, second):
+    ''' Return the cross product of two vectors. '''
+    return (first[1] * second[2] - first[2] * second[1],
+            first[2] * second[0] - first[0] * second[2],
+            first[0] * second[1] - first[1] * second[0])
+
+
+def dot(first, second):
+    ''' Return the dot product of two vectors. '''
+    return first[0] * second[0] + first[1] * second[1] + first[2] * second[2]
+
+
+def angle(first, second):
+    ''' Return the angle in radians between two unit vectors. '''
+    normal = cross(first, second)
+    return math.atan2(math.sqrt(dot(normal, normal)), dot(first, second))
+
+
+def arc_distance(point, start, end):
+    ''' This function will return the angular distance (radians) from the
+    point to the great circle arc between start and end.
+    Arguments:
+        point, start, end -- unit vectors.
+    '''
+    normal = cross(start, end)
+    norm = math.sqrt(dot(normal, normal))
+    if norm < 1e-15:
+        return angle(point, start)  # start and end coincide
+    normal = (normal[0] / norm, normal[1] / norm, normal[2] / norm)
+    # The point is beside the arc if its projection on the great circle lies
+    # between start and end, otherwise the closest end is what counts.
+    if dot(cross(start, point), normal) >= 0 and \
+            dot(cross(point, end), normal) >= 0:
+        return abs(math.asin(max(-1.0, min(1.0, dot(point, normal)))))
+    return min(angle(point, start), angle(point, end))
+
+
+def simplify(vectors, indices, max_distance):
+    ''' This function will return the subset of the indices that is kept by
+    Douglas-Peucker with the given tolerance. The first and last index are
+    always kept.
+    Arguments:
+        vectors      -- unit vectors of all points.
+        indices      -- the indices of the points (in order) to simplify.
+        max_distance -- the tolerance in radians.
+    '''
+    if len(indices) < 3:
+        return list(indices)
+    keep = [False] * len(indices)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(indices) - 1)]
+    while stack:
+        first, last = stack.pop()
+        start = vectors[indices[first]]
+        end = vectors[indices[last]]
+        farthest, farthest_distance = None, max_distance
+        for position in range(first + 1, last):
+            distance = arc_distance(vectors[indices[position]], start, end)
+            if distance > farthest_distance:
+                farthest, farthest_distance = position, distance
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [index for index, kept in zip(indices, keep) if kept]
+
+
+def simplify_levels(vectors, indices):
+    ''' This function will return the simplified indices for every zoom level
+    up to MAX_ZOOM. Each level is simplified from the level above it, which
+    is much cheaper than starting from all points every time. This can add
+    up to the tolerances of the levels above, less than twice the tolerance
+    of the level itself.
+    Arguments:
+        vectors -- unit vectors of all points.
+        indices -- the indices of the points (in order) to simplify.
+    '''
+    levels = [None] * (MAX_ZOOM + 1)
+    for zoom in range(MAX_ZOOM, -1, -1):
+        indices = simplify(vectors, indices, tolerance(zoom))
+        levels[zoom] = indices
+    return levels
+
+
+class Track(object):
+    ''' Simplified versions of the track, following the rows of the
+    coordinates file.
+
+    The track is cut in chunks of CHUNK_SIZE points that share their end
+    points. The simplified levels of completed chunks are kept, so adding
+    points only simplifies the last chunk again.
+    '''
+
+    def __init__(self, position):
+        ''' Arguments:
+            position -- function returning the (lat, lon) of a row.
+        '''
+        self.position = position
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        ''' Forget the track. '''
+        self.rows = []
+        self.indexed = 0
+        self.coords = []
+        self.vectors = []
+        self.chunks = []
+        self.tail = None
+        self.assembled = {}
+
+    def update(self, rows):
+        ''' Bring the track up to date with the given rows. If they are not
+        the rows followed so far, the track is built again. Fewer of the same
+        rows leave the track as it is.
+        Arguments:
+            rows -- all rows of the coordinates file.
+        '''
+        with self.lock:
+            if not spatial.follows(rows, self.rows, self.indexed):
+                self.reset()
+            if len(rows) <= self.indexed:
+                return
+            for row in rows[self.indexed:]:
+                try:
+                    lat, lon = self.position(row)
+                except (ValueError, TypeError, IndexError):
+                    continue  # Not a valid coordinate, not on the track.
+                self.coords.append([lat, lon])
+                self.vectors.append(to_vector(lat, lon))
+            self.rows = rows
+            self.indexed = len(rows)
+            # Simplify the chunks that were completed by the new points.
+            while (len(self.chunks) + 1) * CHUNK_SIZE < len(self.coords):
+                start = len(self.chunks) * CHUNK_SIZE
+                self.chunks.append(simplify_levels(
+                    self.vectors, range(start, start + CHUNK_SIZE + 1)))
+            self.tail = None
+            self.assembled = {}
+
+    def level(self, zoom):
+        ''' Return the simplified track, as [lat, lon] pairs, for the given
+        zoom level.
+        Arguments:
+            zoom -- the map zoom level.
+        '''
+        with self.lock:
+            if zoom > MAX_ZOOM:
+                return self.coords
+            zoom = max(0, zoom)
+            if zoom not in self.assembled:
+                if self.tail is None:
+                    # The levels of the last chunk, shared by all zoom
+                    # levels until points are added.
+                    start = len(self.chunks) * CHUNK_SIZE
+                    self.tail = simplify_levels(
+                        self.vectors, range(start, len(self.coords)))
+                indices = []
+                for chunk in self.chunks + [self.tail]:
+                    # Consecutive chunks share their end points.
+                    indices.extend(chunk[zoom][1 if indices else 0:])
+                self.assembled[zoom] = [self.coords[index]
+                                        for index in indices]
+            return self.assembled[zoom]
@@ -0,0 +1,643 @@
+'''
+Benchmarks the stages of both services on synthetic trips (see
+synthetic.py), offline: the Google Drive is a fakedrive.FakeDrive over the
+photos of the trip.
+
+For every scale and stage this measures the throughput, the latency
+percentiles and the peak memory, and writes them to a JSON file, so the
+results of two commits can be compared:
+
+    python bench/benchmark.py --scales 1 10 100 --output new.json
+    python bench/benchmark.py --compare old.json new.json
+
+Every stage runs in a process of its own, so its peak memory is its own.
+The trees are built in --trees the first time and re-used after that.
+'''
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from datetime import datetime
+import synthetic
+
+SCALES = (1, 10, 100)
+TREES_DIR = os.path.join(tempfile.gettempdir(), 'whereispatrick-bench')
+# The stages that work per photo only get this many photos, the others all
+# of them. They take the same time for every photo, so more would only
+# make the benchmark slower.
+PHOTO_SAMPLE = 300
+# Requests per app endpoint, after the first one that fills the caches.
+REQUESTS = 50
+# Coordinates posted to the webhook.
+WEBHOOK_MESSAGES = 500
+# Photos of the cluster files that the old CSV and the JSON lines reader
+# are compared on, whatever the scale.
+CLUSTER_PHOTOS = 50000
+# The thumbnail stages work on this many photos of 12 megapixels, whatever
+# the scale. They share the image data of a few different pictures.
+LARGE_PHOTOS = 24
+LARGE_PHOTO_SIZE = (4000, 3000)
+# The app endpoints, by stage name. bbox is the whole trip, or Lima.
+ENDPOINTS = [
+    ('index.html', '/'),
+    ('index.js', '/index.js'),
+    ('api_data', '/api/data'),
+    ('api_points_trip', '/api/points?bbox=-60,-90,5,-60&zoom=4'),
+    ('api_points_city', '/api/points?bbox=-12.3,-77.3,-11.8,-76.8&zoom=12'),
+    ('api_track', '/api/track?zoom=6'),
+    ('api_updates', '/api/updates?since={cursor}')]
+
+
+def rss_mb():
+    ''' Returns the resident memory of this process now, in MB. '''
+    with open('/proc/self/statm') as infile:
+        pages = int(infile.read().split()[1])
+    return pages * resource.getpagesize() / 1e6
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    ''' Returns the peak resident memory of this process, in MB, or of
+    the largest of its children that ended with RUSAGE_CHILDREN.
+    '''
+    return resource.getrusage(who).ru_maxrss / 1e3
+
+
+def percentile(values, fraction):
+    ''' Returns the value below which the fraction of the sorted values
+    lies.
+    '''
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def timed(function, items):
+    ''' Returns the seconds that function took for every item. '''
+    latencies = []
+    for item in items:
+        started = time.time()
+        function(item)
+        latencies.append(time.time() - started)
+    return latencies
+
+
+def scratch_data(tree, with_database=True):
+    ''' Copies the data directory of a tree to a temporary directory and
+    points the services at it, so a stage can change it. Returns the
+    temporary directory.
+    '''
+    scratch = tempfile.mkdtemp(prefix='bench-')
+    data_dir = os.path.join(scratch, 'data')
+    os.makedirs(os.path.join(data_dir, 'images'))
+    if with_database:
+        shutil.copy(os.path.join(tree, 'data', 'whereispatrick.db'),
+                    data_dir)
+    os.environ['DATA_DIR'] = data_dir
+    os.chdir(scratch)
+    return scratch
+
+
+def photo_sample(tree):
+    ''' Returns the full names of the first PHOTO_SAMPLE photos of a
+    tree.
+    '''
+    drive = os.path.join(tree, 'drive')
+    return [os.path.join(drive, name)
+            for name in sorted(os.listdir(drive))[:PHOTO_SAMPLE]]
+
+
+def stage_parse_message(tree):
+    ''' parser.parse_message() for every message. '''
+    import parser
+    with open(os.path.join(tree, 'messages.txt')) as infile:
+        messages = infile.read().splitlines()
+    return {'latencies': timed(parser.parse_message, messages)}
+
+
+def read_table(table):
+    ''' Returns a function reading all rows of a table into a new reader,
+    as a worker process does at its start.
+    '''
+    import parser
+    return lambda _: parser.AppendOnlyTableReader(table).read()
+
+
+def stage_get_all_coordinates(_):
+    ''' parser.get_all_coordinates() in a new process. '''
+    return {'latencies': timed(read_table('coordinates'), range(10))}
+
+
+def stage_get_all_images(_):
+    ''' parser.get_all_images() in a new process. '''
+    return {'latencies': timed(read_table('images'), range(10))}
+
+
+def stage_get_all_clusters(_):
+    ''' Parsing the clusters of parser.get_all_clusters(). '''
+    import parser
+    return {'latencies': timed(
+        lambda _: parser.read_cluster_lines(parser.CLUSTERS_JSON_FILE),
+        range(10))}
+
+
+def cluster_files(tree):
+    ''' Returns the names of the cluster CSV and JSON lines files of a trip
+    of CLUSTER_PHOTOS photos, made by images.clustering() the first time
+    and kept next to the trees.
+    '''
+    folder = os.path.join(os.path.dirname(tree),
+                          'clusters-{0}'.format(CLUSTER_PHOTOS))
+    names = [os.path.join(folder, 'image_clusters.csv'),
+             os.path.join(folder, 'image_clusters.jsonl')]
+    if os.path.exists(os.path.join(folder, 'done')):
+        return names
+    scratch = scratch_data(tree, with_database=False)
+    try:
+        import random
+        import images
+        import storage
+        storage.add_images(synthetic.make_image_rows(
+            CLUSTER_PHOTOS, random.Random(1)), export=False)
+        images.clustering(100.0)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        shutil.copy(images.CLUSTERS_CSV, names[0])
+        shutil.copy(images.CLUSTERS_JSON, names[1])
+        open(os.path.join(folder, 'done'), 'w').close()
+        return names
+    finally:
+        shutil.rmtree(scratch)
+
+
+def stage_clusters_csv(tree):
+    ''' parser.read_cluster_rows() of the clusters of CLUSTER_PHOTOS
+    photos: the old CSV file, with a literal_eval of every cell.
+    '''
+    filename = cluster_files(tree)[0]
+    import csv
+    import parser
+    # The photos without GPS position are all in one cluster, a cell larger
+    # than the csv module reads by default.
+    csv.field_size_limit(2 ** 31 - 1)
+    return {'latencies': timed(lambda _: parser.read_cluster_rows(filename),
+                               range(5)),
+            'bytes': os.path.getsize(filename)}
+
+
+def stage_clusters_jsonl(tree):
+    ''' parser.read_cluster_lines() of the clusters of CLUSTER_PHOTOS
+    photos: the JSON lines file.
+    '''
+    filename = cluster_files(tree)[1]
+    import parser
+    return {'latencies': timed(lambda _: parser.read_cluster_lines(filename),
+                               range(5)),
+            'bytes': os.path.getsize(filename)}
+
+
+def large_photos(tree):
+    ''' Returns the names of LARGE_PHOTOS jpgs of LARGE_PHOTO_SIZE pixels,
+    written the first time and kept next to the trees.
+    '''
+    folder = os.path.join(os.path.dirname(tree), 'photos-{0}x{1}'.format(
+        *LARGE_PHOTO_SIZE))
+    names = [os.path.join(folder, 'IMG_{0:06d}.jpg'.format(number))
+             for number in range(1, LARGE_PHOTOS + 1)]
+    if os.path.exists(os.path.join(folder, 'done')):
+        return names
+    import random
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    pictures = synthetic.make_pictures(4, LARGE_PHOTO_SIZE, random.Random(1))
+    for number, name in enumerate(names):
+        with open(name, 'wb') as outf:
+            outf.write(pictures[number % len(pictures)])
+    open(os.path.join(folder, 'done'), 'w').close()
+    return names
+
+
+def old_jpg_to_png_thumbnail(dimension, image_name):
+    ''' images.jpg_to_png_thumbnail() as it was before the thumbnails were
+    made in a pool with draft decoding: all pixels of the photo are decoded
+    and resized. ANTIALIAS is the old name of LANCZOS.
+    '''
+    from PIL import Image
+    image = Image.open(image_name)
+    wpercent = (dimension/float(image.size[0]))
+    hsize = int((float(image.size[1])*float(wpercent)))
+    img = image.resize((dimension, hsize), Image.LANCZOS)
+    new_image = image_name.replace('.jpg', '.png')
+    img.save(new_image)
+    return new_image
+
+
+def old_thumbnail(image_name):
+    ''' The png thumbnail of the old images service. '''
+    return old_jpg_to_png_thumbnail(500, image_name)
+
+
+def draft_thumbnail(image_name):
+    ''' The same png thumbnail with images.jpg_to_png_thumbnail(). '''
+    import images
+    return images.jpg_to_png_thumbnail(500, image_name)
+
+
+def thumbnail_stage(function, parallel):
+    ''' Returns the stage making thumbnails of the large photos with the
+    function, one after the other or in a multiprocessing.Pool of
+    images.THUMBNAIL_WORKERS processes, like the images service.
+    '''
+    def stage(tree):
+        import images
+        scratch = tempfile.mkdtemp(prefix='bench-')
+        try:
+            names = []
+            for name in large_photos(tree):
+                names.append(os.path.join(scratch, os.path.basename(name)))
+                shutil.copy(name, names[-1])
+            started = time.time()
+            if parallel:
+                pool = multiprocessing.Pool(images.THUMBNAIL_WORKERS)
+                try:
+                    pool.map(function, names)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for name in names:
+                    function(name)
+            return {'seconds': time.time() - started, 'count': len(names),
+                    'workers': images.THUMBNAIL_WORKERS if parallel else 1,
+                    'children_peak_rss_mb': peak_rss_mb(
+                        resource.RUSAGE_CHILDREN)}
+        finally:
+            shutil.rmtree(scratch)
+    stage.__doc__ = '{0} of the large photos{1}.'.format(
+        function.__doc__.strip().rstrip('.'),
+        ', in a process pool' if parallel else '')
+    return stage
+
+
+def stage_process_all_jpgs(tree):
+    ''' images.process_all_jpgs() of the large photos: the thumbnail stage
+    of the images service, with every variant of THUMBNAIL_SIZES.
+    '''
+    scratch = scratch_data(tree, with_database=False)
+    try:
+        import images
+        for name in large_photos(tree):
+            shutil.copy(name, images.IMAGE_DIR)
+        started = time.time()
+        count = images.process_all_jpgs()
+        return {'seconds': time.time() - started, 'count': count,
+                'workers': images.THUMBNAIL_WORKERS,
+                'children_peak_rss_mb': peak_rss_mb(
+                    resource.RUSAGE_CHILDREN)}
+    finally:
+        shutil.rmtree(scratch)
+
+
+def endpoint_stage(url):
+    ''' Returns the stage requesting an app endpoint REQUESTS times, with
+    gzip, after a first request that fills the caches.
+    '''
+    def stage(_):
+        import app
+        import changes
+        version = list(changes.current_version())
+        # Half of the coordinates are new to the client.
+        version[1] //= 2
+        client = app.app.test_client()
+        headers = {'Accept-Encoding': 'gzip'}
+        target = url.format(cursor=changes.format_cursor(version))
+        started = time.time()
+        response = client.get(target, headers=headers)
+        cold = time.time() - started
+        size = len(response.get_data())
+        if response.status_code != 200:
+            raise RuntimeError('{0} returned {1}'.format(
+                target, response.status_code))
+        latencies = timed(lambda _: client.get(target,
+                                               headers=headers).get_data(),
+                          range(REQUESTS))
+        return {'latencies': latencies, 'cold_seconds': cold,
+                'bytes': size}
+    stage.__doc__ = 'GET {0}'.format(url)
+    return stage
+
+
+def stage_webhook(tree):
+    ''' POST new messages to the webhook, until they are all stored. '''
+    scratch = scratch_data(tree)
+    try:
+        import app
+        import ingest
+        client = app.app.test_client()
+        messages = [synthetic.format_message(
+            -60 - number * 0.001, -70, 100,
+            synthetic.TRIP_START.replace(year=2020))
+            for number in range(WEBHOOK_MESSAGES)]
+        started = time.time()
+        latencies = timed(lambda message: client.post(
+            '/api/coordinates/v1.0/', data={'Body': message}), messages)
+        ingest.COORDINATES_QUEUE.wait()
+        return {'latencies': latencies,
+                'seconds_until_stored': time.time() - started}
+    finally:
+        shutil.rmtree(scratch)
+
+
+def stage_exif(tree):
+    ''' exif.read_gps_file() for every photo. '''
+    import exif
+    return {'latencies': timed(exif.read_gps_file, photo_sample(tree))}
+
+
+def stage_jpg_to_png_thumbnail(tree):
+    ''' images.jpg_to_png_thumbnail() of 150 pixels for every photo. '''
+    import images
+    scratch = tempfile.mkdtemp(prefix='bench-')
+    try:
+        return {'latencies': timed(
+            lambda name: images.jpg_to_png_thumbnail(150, name, scratch),
+            photo_sample(tree))}
+    finally:
+        shutil.rmtree(scratch)
+
+
+def stage_make_thumbnails(tree):
+    ''' images.make_thumbnails() for every photo. '''
+    import images
+    scratch = tempfile.mkdtemp(prefix='bench-')
+    try:
+        return {'latencies': timed(
+            lambda name: images.make_thumbnails(name, scratch),
+            photo_sample(tree))}
+    finally:
+        shutil.rmtree(scratch)
+
+
+def stage_get_pictures(tree):
+    ''' images.get_pictures() of the photos on a fake Google Drive, into an
+    empty database: listing, downloads, EXIF and thumbnails.
+    '''
+    scratch = scratch_data(tree, with_database=False)
+    try:
+        drive = os.path.join(scratch, 'drive')
+        os.makedirs(drive)
+        for name in photo_sample(tree):
+            os.symlink(name, os.path.join(drive, os.path.basename(name)))
+        import images
+        import fakedrive
+        fake = fakedrive.FakeDrive(drive)
+        started = time.time()
+        stored = images.get_pictures(fake)
+        return {'seconds': time.time() - started, 'count': stored,
+                'bytes': fake.counters['bytes']}
+    finally:
+        shutil.rmtree(scratch)
+
+
+def stage_images_startup(tree):
+    ''' Starting the images service: importing images, and a round of
+    clustering and thumbnails when there are no new photos.
+    '''
+    scratch = scratch_data(tree)
+    try:
+        # The first clustering, in a process of its own so this one only
+        # imports what an idle round needs.
+        environment = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            synthetic.MODULE_DIRS))
+        subprocess.check_call([sys.executable, '-c',
+                               'import images; images.clustering(100.0)'],
+                              env=environment)
+        started = time.time()
+        import images
+        import_seconds = time.time() - started
+        import_rss = rss_mb()
+        latencies = timed(lambda _: (images.clustering(100.0),
+                                     images.process_all_jpgs()), range(10))
+        return {'latencies': latencies, 'import_seconds': import_seconds,
+                'import_rss_mb': import_rss, 'idle_rss_mb': rss_mb(),
+                'modules': len(sys.modules)}
+    finally:
+        shutil.rmtree(scratch)
+
+
+def stage_clustering_full(tree):
+    ''' images.clustering() of all photos, without a cluster index. '''
+    scratch = scratch_data(tree)
+    try:
+        import images
+        import storage
+        started = time.time()
+        images.clustering(100.0)
+        return {'seconds': time.time() - started,
+                'count': storage.get_version('images')[1]}
+    finally:
+        shutil.rmtree(scratch)
+
+
+def stage_clustering_incremental(tree):
+    ''' images.clustering() after 1% of the photos were added. '''
+    scratch = scratch_data(tree)
+    try:
+        import images
+        import storage
+        rows = storage.get_rows('images')
+        new_rows = rows[len(rows) * 99 // 100:]
+        with storage.get_connection() as connection:
+            connection.execute('DELETE FROM images WHERE id >= ?',
+                               (new_rows[0][0],))
+        images.clustering(100.0)
+        storage.add_images([row for _, row in new_rows], export=False)
+        started = time.time()
+        images.clustering(100.0)
+        return {'seconds': time.time() - started, 'count': len(new_rows)}
+    finally:
+        shutil.rmtree(scratch)
+
+
+STAGES = [('parse_message', stage_parse_message),
+          ('get_all_coordinates', stage_get_all_coordinates),
+          ('get_all_images', stage_get_all_images),
+          ('get_all_clusters', stage_get_all_clusters),
+          ('clusters_csv_50k', stage_clusters_csv),
+          ('clusters_jsonl_50k', stage_clusters_jsonl)] + \
+    [(name, endpoint_stage(url)) for name, url in ENDPOINTS] + \
+    [('webhook', stage_webhook),
+     ('exif', stage_exif),
+     ('jpg_to_png_thumbnail', stage_jpg_to_png_thumbnail),
+     ('make_thumbnails', stage_make_thumbnails),
+     ('thumbs_12mp_old', thumbnail_stage(old_thumbnail, False)),
+     ('thumbs_12mp_old_pool', thumbnail_stage(old_thumbnail, True)),
+     ('thumbs_12mp_draft_pool', thumbnail_stage(draft_thumbnail, True)),
+     ('process_all_jpgs_12mp', stage_process_all_jpgs),
+     ('get_pictures', stage_get_pictures),
+     ('images_startup', stage_images_startup),
+     ('clustering_full', stage_clustering_full),
+     ('clustering_incremental', stage_clustering_incremental)]
+
+
+def run_stage(name, tree):
+    ''' Runs a stage in this process, and returns its result as a dict:
+    count, seconds, per_second, the latency percentiles in milliseconds
+    (if the stage has latencies) and the memory in MB.
+    '''
+    synthetic.use_tree(tree)
+    stage = dict(STAGES)[name]
+    rss_before = rss_mb()
+    result = stage(tree)
+    latencies = sorted(result.pop('latencies', []))
+    if latencies:
+        result.setdefault('count', len(latencies))
+        result.setdefault('seconds', sum(latencies))
+        for label, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            result[label + '_ms'] = percentile(latencies, fraction) * 1e3
+        result['max_ms'] = latencies[-1] * 1e3
+    if result['seconds'] > 0:
+        result['per_second'] = result['count'] / result['seconds']
+    result['rss_before_mb'] = rss_before
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def git_commit():
+    ''' Returns (commit, dirty) of the repository, or (None, None). '''
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=synthetic.REPO_DIR,
+            stderr=subprocess.STDOUT).decode().strip()
+        dirty = bool(subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=synthetic.REPO_DIR).strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def get_tree(trees_dir, scale):
+    ''' Returns the tree of a scale, building it first if needed. '''
+    tree = os.path.join(trees_dir, 'scale-{0:g}'.format(scale))
+    if not os.path.exists(os.path.join(tree, 'done')):
+        if os.path.exists(tree):
+            shutil.rmtree(tree)
+        print('Building the trip of scale {0:g} in {1}'.format(scale, tree))
+        # In a process of its own, the modules it imports are configured
+        # for the tree.
+        subprocess.check_call([sys.executable, synthetic.__file__, tree,
+                               str(scale)])
+        open(os.path.join(tree, 'done'), 'w').close()
+    return tree
+
+
+def print_result(scale, name, result):
+    ''' Prints a result as a line of a table. '''
+    def number(key, fmt):
+        value = result.get(key)
+        return fmt.format(value) if value is not None else '-'
+    print('{0:>5g} {1:<24} {2:>7} {3:>10} {4:>9} {5:>9} {6:>9} {7:>8} '
+          '{8:>8}'.format(
+              scale, name, result.get('count', '-'),
+              number('per_second', '{0:.1f}'), number('p50_ms', '{0:.2f}'),
+              number('p99_ms', '{0:.2f}'), number('seconds', '{0:.2f}'),
+              number('peak_rss_mb', '{0:.0f}'),
+              number('children_peak_rss_mb', '{0:.0f}')))
+
+
+def run(scales, stages, trees_dir, output):
+    ''' Runs the stages at every scale, and writes the results to the
+    output file.
+    '''
+    commit, dirty = git_commit()
+    report = {'commit': commit, 'dirty': dirty,
+              'created': datetime.utcnow().isoformat() + 'Z',
+              'host': socket.gethostname(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'cpus': multiprocessing.cpu_count(),
+              'photo_sample': PHOTO_SAMPLE, 'requests': REQUESTS,
+              'results': []}
+    print('{0:>5} {1:<24} {2:>7} {3:>10} {4:>9} {5:>9} {6:>9} {7:>8} '
+          '{8:>8}'.format('scale', 'stage', 'count', 'per second', 'p50 ms',
+                          'p99 ms', 'seconds', 'peak MB', 'child MB'))
+    for scale in scales:
+        tree = get_tree(trees_dir, scale)
+        for name in stages:
+            output_text = subprocess.check_output(
+                [sys.executable, __file__, '--run-stage', name, tree])
+            result = json.loads(output_text.decode().splitlines()[-1])
+            print_result(scale, name, result)
+            result.update(scale=scale, stage=name)
+            report['results'].append(result)
+            with open(output, 'w') as outf:
+                json.dump(report, outf, indent=1, sort_keys=True)
+    print('Results written to {0}'.format(output))
+
+
+def compare(old_file, new_file):
+    ''' Prints the change of the p50 latency (or the duration) and of the
+    peak memory of every stage between two result files.
+    '''
+    results = []
+    for filename in (old_file, new_file):
+        with open(filename) as infile:
+            report = json.load(infile)
+        print('{0}: commit {1}{2}, {3}'.format(
+            filename, report['commit'], ' (dirty)' if report['dirty'] else '',
+            report['created']))
+        results.append(dict(((result['scale'], result['stage']), result)
+                            for result in report['results']))
+    print('{0:>5} {1:<24} {2:>12} {3:>12} {4:>8} {5:>10}'.format(
+        'scale', 'stage', 'old', 'new', 'change', 'peak MB'))
+    for key in sorted(set(results[0]) & set(results[1])):
+        old, new = results[0][key], results[1][key]
+        metric = 'p50_ms' if 'p50_ms' in old and 'p50_ms' in new \
+            else 'seconds'
+        unit = 'ms' if metric == 'p50_ms' else 's'
+        change = (new[metric] - old[metric]) / old[metric] * 100 \
+            if old[metric] else 0.0
+        print('{0:>5g} {1:<24} {2:>10.2f}{3:<2} {4:>10.2f}{3:<2} {5:>+7.1f}% '
+              '{6:>4.0f}->{7:<4.0f}'.format(
+                  key[0], key[1], old[metric], unit, new[metric], change,
+                  old['peak_rss_mb'], new['peak_rss_mb']))
+
+
+def main():
+    ''' Parse the command line and run the benchmarks. '''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scales', type=float, nargs='+', default=SCALES,
+                        help='sizes of the trips, relative to the real one')
+    parser.add_argument('--stages', nargs='+', choices=dict(STAGES),
+                        default=[name for name, _ in STAGES],
+                        metavar='STAGE', help='the stages to run: ' +
+                        ', '.join(name for name, _ in STAGES))
+    parser.add_argument('--trees', default=TREES_DIR,
+                        help='directory with the synthetic trips')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='the JSON file to write the results to')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files')
+    parser.add_argument('--run-stage', nargs=2, metavar=('STAGE', 'TREE'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_stage:
+        print(json.dumps(run_stage(*args.run_stage)))
+    elif args.compare:
+        compare(*args.compare)
+    else:
+        run(args.scales, args.stages, args.trees, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+'''
+Builds synthetic trips, for benchmarking the services offline:
+    - Iridium messages along the route from Quito to Ushuaia, as the phone
+      sends them, and the coordinates they hold
+    - geotagged photos taken in bursts along the same route, with the GPS
+      information in a real EXIF segment
+    - the data directory the services would have made of them: the CSV
+      files, the database, the thumbnail manifest and the photo clusters
+
+A trip of scale 1 has MESSAGES messages and PHOTOS photos, about what the
+real trip will bring. The tree of a trip is:
+
+    <tree>/messages.txt  the messages, one per line
+    <tree>/drive/        the photos, for fakedrive.FakeDrive
+    <tree>/config.json   the config of the app
+    <tree>/data/         the data directory (DATA_DIR) of the services
+
+Build one with:
+
+    python bench/synthetic.py <tree> [scale]
+'''
+
+from __future__ import print_function
+import os
+import io
+import sys
+import json
+import math
+import random
+import struct
+import datetime
+
+# Directories with the modules of the services.
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULE_DIRS = [os.path.join(REPO_DIR, name)
+               for name in ('app', 'images', 'common')]
+
+# Size of a trip of scale 1.
+MESSAGES = 1500
+PHOTOS = 400
+# The photos are taken in bursts of about this many, within BURST_RADIUS
+# degrees (about 100 m) of each other.
+PHOTOS_PER_BURST = 6
+BURST_RADIUS = 0.001
+# This fraction of the photos has no GPS information.
+NO_GPS_FRACTION = 0.1
+# Size in pixels of the photos. They share the image data of a few different
+# pictures, only their EXIF differs.
+PHOTO_SIZE = (640, 480)
+BASE_PICTURES = 8
+TRIP_START = datetime.datetime(2017, 1, 15, 8, 0, 0)
+TRIP_DAYS = 300
+# The route, as (latitude, longitude) of the places along the way.
+ROUTE = [(-0.1807, -78.4678),   # Quito
+         (-2.9001, -79.0059),   # Cuenca
+         (-5.1945, -80.6328),   # Piura
+         (-12.0464, -77.0428),  # Lima
+         (-13.5320, -71.9675),  # Cusco
+         (-16.4897, -68.1193),  # La Paz
+         (-20.4604, -66.8261),  # Uyuni
+         (-24.7821, -65.4232),  # Salta
+         (-32.8895, -68.8458),  # Mendoza
+         (-41.1335, -71.3103),  # Bariloche
+         (-50.3379, -72.2648),  # El Calafate
+         (-54.8019, -68.3030)]  # Ushuaia
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+          'Oct', 'Nov', 'Dec']
+
+
+def use_tree(tree):
+    ''' Points the services at the data directory of a tree. This must be
+    done before their modules are imported.
+    '''
+    os.environ['DATA_DIR'] = os.path.join(tree, 'data')
+    os.environ['CONFIG_FILE'] = os.path.join(tree, 'config.json')
+    os.environ.setdefault('STATIC_URL_BASE', '/static')
+    os.environ['CSV_EXPORT'] = '0'
+    for directory in reversed(MODULE_DIRS):
+        if directory not in sys.path:
+            sys.path.insert(0, directory)
+
+
+def route_position(fraction):
+    ''' Returns (latitude, longitude) of the point at the given fraction of
+    the route, measured along the route.
+    '''
+    lengths = [math.hypot(end[0] - start[0], end[1] - start[1])
+               for start, end in zip(ROUTE, ROUTE[1:])]
+    distance = fraction * sum(lengths)
+    for (start, end), length in zip(zip(ROUTE, ROUTE[1:]), lengths):
+        if distance <= length:
+            part = distance / length
+            return (start[0] + part * (end[0] - start[0]),
+                    start[1] + part * (end[1] - start[1]))
+        distance -= length
+    return ROUTE[-1]
+
+
+def trip_time(fraction):
+    ''' Returns the time at the given fraction of the trip, whole seconds. '''
+    return TRIP_START + datetime.timedelta(
+        seconds=int(fraction * TRIP_DAYS * 24 * 3600))
+
+
+def to_dms(degrees):
+    ''' Returns (sign, degrees, minutes, seconds), all whole, of an angle. '''
+    total = int(round(abs(degrees) * 3600))
+    return (-1 if degrees < 0 else 1, total // 3600, total // 60 % 60,
+            total % 60)
+
+
+def format_message(latitude, longitude, altitude, time):
+    ''' Returns an Iridium location message, see parser.MESSAGE_REGEX. '''
+    parts = []
+    for name, angle in (('Lat', latitude), ('Lon', longitude)):
+        sign, degrees, minutes, seconds = to_dms(angle)
+        parts.append('{0}{1}{2}deg{3}\'{4}"'.format(
+            name, '-' if sign < 0 else '', degrees, minutes, seconds))
+    return '{0} {1} Alt+{2} m (Sat) {3:02d}-{4}-{5} {6} UTC {7}'.format(
+        parts[0], parts[1], altitude, time.day, MONTHS[time.month - 1],
+        time.year, time.strftime('%H:%M:%S'), 'Todo bien')
+
+
+def message_coordinate(latitude, longitude, altitude, time):
+    ''' Returns the coordinate row [lat, lon, alt, time] that the app makes
+    of the message of a position.
+    '''
+    row = []
+    for angle in (latitude, longitude):
+        sign, degrees, minutes, seconds = to_dms(angle)
+        row.append(sign * (degrees + minutes / 60.0 + seconds / 3600.0))
+    return row + [altitude, time]
+
+
+def make_messages(count, rand):
+    ''' Returns the messages and their coordinate rows of a trip, in the
+    order they were sent.
+    '''
+    messages, rows = [], []
+    for number in range(count):
+        fraction = (number + rand.random() * 0.5) / count
+        latitude, longitude = route_position(fraction)
+        latitude += rand.gauss(0, 0.01)
+        longitude += rand.gauss(0, 0.01)
+        altitude = rand.randint(0, 4500)
+        time = trip_time(fraction)
+        messages.append(format_message(latitude, longitude, altitude, time))
+        rows.append(message_coordinate(latitude, longitude, altitude, time))
+    return messages, rows
+
+
+def make_pictures(count, size, rand):
+    ''' Returns the JPEG data, without EXIF, of a few different pictures. '''
+    from PIL import Image
+    pictures = []
+    for _ in range(count):
+        noise = Image.effect_noise(size, rand.randint(20, 60))
+        gradient = Image.linear_gradient('L').rotate(
+            rand.randint(0, 359)).resize(size)
+        radial = Image.radial_gradient('L').resize(size)
+        picture = Image.merge('RGB', (gradient, radial, noise))
+        data = io.BytesIO()
+        picture.save(data, 'JPEG', quality=90)
+        pictures.append(data.getvalue())
+    return pictures
+
+
+def rational(value, denominator=1):
+    ''' Returns the EXIF rational (numerator, denominator) of a value. '''
+    return (int(round(value * denominator)), denominator)
+
+
+def make_exif(name, time, position=None):
+    ''' Returns the APP1 segment with the EXIF of a photo, with GPS
+    information if the (latitude, longitude, altitude) position is given.
+    '''
+    import piexif
+    exif = {'0th': {piexif.ImageIFD.Make: 'Synthetic',
+                    piexif.ImageIFD.ImageDescription: name,
+                    piexif.ImageIFD.DateTime: time.strftime(
+                        '%Y:%m:%d %H:%M:%S')}}
+    if position is not None:
+        exif['GPS'] = gps_fields(time, *position)
+    data = piexif.dump(exif)
+    return b'\xff\xe1' + struct.pack('>H', len(data) + 2) + data
+
+
+def gps_fields(time, latitude, longitude, altitude):
+    ''' Returns the GPS fields of the EXIF of a photo, for piexif. '''
+    import piexif
+    gps = {piexif.GPSIFD.GPSVersionID: (2, 2, 0, 0),
+           piexif.GPSIFD.GPSAltitudeRef: 0,
+           piexif.GPSIFD.GPSAltitude: rational(altitude),
+           piexif.GPSIFD.GPSTimeStamp: (rational(time.hour),
+                                        rational(time.minute),
+                                        rational(time.second)),
+           piexif.GPSIFD.GPSDateStamp: time.strftime('%Y:%m:%d')}
+    for ref_tag, tag, angle, signs in (
+            (piexif.GPSIFD.GPSLatitudeRef, piexif.GPSIFD.GPSLatitude,
+             latitude, 'NS'),
+            (piexif.GPSIFD.GPSLongitudeRef, piexif.GPSIFD.GPSLongitude,
+             longitude, 'EW')):
+        minutes, seconds = divmod(abs(angle) * 3600, 60)
+        degrees, minutes = divmod(minutes, 60)
+        gps[ref_tag] = signs[angle < 0]
+        gps[tag] = (rational(degrees), rational(minutes),
+                    rational(seconds, 10000))
+    return gps
+
+
+def make_photos(folder, count, size, rand):
+    ''' Writes the photos of a trip to the folder, and returns their names
+    in the order they were taken.
+    '''
+    pictures = make_pictures(BASE_PICTURES, size, rand)
+    names = []
+    number = 0
+    while number < count:
+        fraction = rand.random()
+        center = route_position(fraction)
+        for _ in range(min(count - number,
+                           rand.randint(1, 2 * PHOTOS_PER_BURST - 1))):
+            number += 1
+            name = 'IMG_{0:06d}.jpg'.format(number)
+            picture = rand.choice(pictures)
+            position = None
+            if rand.random() >= NO_GPS_FRACTION:
+                position = (
+                    center[0] + rand.uniform(-BURST_RADIUS, BURST_RADIUS),
+                    center[1] + rand.uniform(-BURST_RADIUS, BURST_RADIUS),
+                    rand.randint(0, 4500))
+            exif_segment = make_exif(name, trip_time(fraction) +
+                                     datetime.timedelta(
+                                         seconds=rand.randint(0, 600)),
+                                     position)
+            with open(os.path.join(folder, name), 'wb') as outf:
+                # The EXIF goes right after the start of image marker.
+                outf.write(picture[:2] + exif_segment + picture[2:])
+            names.append(name)
+    return names
+
+
+def make_image_rows(count, rand):
+    ''' Returns the image rows (shown, name, lat, lon, alt, time) of a
+    trip of count photos, taken in bursts like those of make_photos, without
+    writing the photos.
+    '''
+    rows = []
+    while len(rows) < count:
+        fraction = rand.random()
+        center = route_position(fraction)
+        for _ in range(min(count - len(rows),
+                           rand.randint(1, 2 * PHOTOS_PER_BURST - 1))):
+            name = 'IMG_{0:06d}.jpg'.format(len(rows) + 1)
+            time = trip_time(fraction) + datetime.timedelta(
+                seconds=rand.randint(0, 600))
+            if rand.random() < NO_GPS_FRACTION:
+                rows.append((0, name, 0, 0, 0, 0))
+                continue
+            rows.append((
+                1, name,
+                center[0] + rand.uniform(-BURST_RADIUS, BURST_RADIUS),
+                center[1] + rand.uniform(-BURST_RADIUS, BURST_RADIUS),
+                float(rand.randint(0, 4500)), time))
+    return rows
+
+
+def write_csv(filename, rows):
+    ''' Writes the rows to a CSV file. '''
+    import csv
+    with open(filename, 'w') as outf:
+        writer = csv.writer(outf)
+        for row in rows:
+            writer.writerow(row)
+
+
+def build(tree, scale=1, seed=1, photo_size=PHOTO_SIZE):
+    ''' Builds the tree of a synthetic trip, see the module documentation.
+
+    Arguments:
+        string: the directory of the tree, which must not exist yet.
+        float: size of the trip, relative to the real one.
+        int: seed of the random numbers, the same seed gives the same trip.
+        tuple: size in pixels of the photos.
+    Returns:
+        dict: the numbers of messages, photos, photos with GPS information
+        and clusters.
+    '''
+    rand = random.Random(seed)
+    data_dir = os.path.join(tree, 'data')
+    drive_dir = os.path.join(tree, 'drive')
+    for directory in (data_dir, os.path.join(data_dir, 'images'), drive_dir):
+        os.makedirs(directory)
+    use_tree(tree)
+    import storage
+    import images
+    with open(os.path.join(tree, 'config.json'), 'w') as outf:
+        json.dump({'GOOGLE_MAP_KEY': 'synthetic'}, outf)
+    messages, coordinates = make_messages(int(MESSAGES * scale), rand)
+    with open(os.path.join(tree, 'messages.txt'), 'w') as outf:
+        outf.write('\n'.join(messages) + '\n')
+    write_csv(storage.COORDINATES_CSV, coordinates)
+    # The image rows are read from the photos like the images service does.
+    names = make_photos(drive_dir, int(PHOTOS * scale), photo_size, rand)
+    image_rows = [images.get_image_gps_info(os.path.join(drive_dir, name))
+                  for name in names]
+    image_rows = [(row[0], os.path.basename(row[1])) + tuple(row[2:])
+                  for row in image_rows]
+    write_csv(storage.IMAGES_CSV, image_rows)
+    manifest = dict((name, {'small': name[:-4] + '_small.webp',
+                            'medium': name[:-4] + '_medium.webp'})
+                    for shown, name, _, _, _, _ in image_rows if shown)
+    with open(images.THUMBNAIL_MANIFEST, 'w') as outf:
+        json.dump(manifest, outf, sort_keys=True)
+    storage.import_csv()
+    images.clustering(100.0)
+    with open(images.CLUSTERS_JSON) as infile:
+        clusters = sum(1 for line in infile if line.strip())
+    return {'messages': len(messages), 'photos': len(names),
+            'photos_with_gps': len(manifest), 'clusters': clusters}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print('Usage: python synthetic.py <tree> [scale]')
+        sys.exit(1)
+    print(json.dumps(build(sys.argv[1], float(sys.argv[2])
+                           if len(sys.argv) == 3 else 1)))
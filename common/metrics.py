@@ -0,0 +1,426 @@
+'''
+Utilities for:
+    - counting and timing what the services do, with counters, gauges and
+      histograms, optionally split up by labels
+    - writing them in the Prometheus text format, for the /metrics endpoint of
+      the app and the metrics file of the images service
+    - adding up the metrics of several processes of the same service, which
+      share them through snapshot files in a directory
+'''
+
+from __future__ import print_function
+import os
+import json
+import time
+import glob
+import errno
+import threading
+try:
+    import fcntl
+except ImportError:  # Not on Windows, where there is one process anyway.
+    fcntl = None
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the buckets of the duration histograms.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0, 30.0, 60.0, 300.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric(object):
+    ''' A named value, one for every combination of label values. '''
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        ''' Arguments:
+            name          -- the Prometheus name of the metric.
+            documentation -- one line describing the metric.
+            labels        -- the names of the labels.
+        '''
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        ''' Return the label values as a tuple, in the order of the label
+        names.
+        '''
+        if len(labels) != len(self.labels):
+            raise ValueError('{0} needs the labels {1}'.format(
+                self.name, ', '.join(self.labels)))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def snapshot(self):
+        ''' Return the metric as a dict that can be written as JSON. '''
+        with self.lock:
+            return {'kind': self.kind, 'documentation': self.documentation,
+                    'labels': list(self.labels),
+                    'values': [[list(key), self.copy(value)]
+                               for key, value in self.values.items()]}
+
+    @staticmethod
+    def copy(value):
+        ''' Return a copy of a value that the metric does not change. '''
+        return value
+
+
+class Counter(Metric):
+    ''' A number that only goes up. '''
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        ''' Add amount to the counter of the label values. '''
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    ''' A number that is set to its current value. '''
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        ''' Set the gauge of the label values. '''
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    ''' Counts observations, durations in seconds for example, per bucket. '''
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        ''' Arguments:
+            buckets -- the upper bounds of the buckets, see Metric for the
+                       others.
+        '''
+        Metric.__init__(self, name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        ''' Count an observation for the label values. The value is stored
+        as [count per bucket..., count above the last bucket, sum].
+        '''
+        key = self.key(labels)
+        index = len(self.buckets)
+        for number, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = number
+                break
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            self.values[key][index] += 1
+            self.values[key][-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        ''' Observe the seconds spent in the with block. '''
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def snapshot(self):
+        snapshot = Metric.snapshot(self)
+        snapshot['buckets'] = list(self.buckets)
+        return snapshot
+
+    @staticmethod
+    def copy(value):
+        return list(value)
+
+
+class Registry(object):
+    ''' The metrics of a process, by name. '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric_class, name, *args, **kwargs):
+        ''' Return the metric with the given name, creating it first if it
+        does not exist yet.
+        '''
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = metric_class(name, *args, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, documentation, labels=()):
+        ''' Return the Counter with the given name, see Metric. '''
+        return self.register(Counter, name, documentation, labels)
+
+    def gauge(self, name, documentation, labels=()):
+        ''' Return the Gauge with the given name, see Metric. '''
+        return self.register(Gauge, name, documentation, labels)
+
+    def histogram(self, name, documentation, labels=(),
+                  buckets=DEFAULT_BUCKETS):
+        ''' Return the Histogram with the given name, see Histogram. '''
+        return self.register(Histogram, name, documentation, labels,
+                             buckets)
+
+    def snapshot(self):
+        ''' Return all metrics as a dict that can be written as JSON. '''
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return dict((metric.name, metric.snapshot()) for metric in metrics)
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+def merge(snapshots):
+    ''' Return the sum of the snapshots of several processes: the counts,
+    sums and gauges of equal label values are added up. Only pass the gauges
+    of processes that are still running, see without_gauges().
+    '''
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            if name not in merged:
+                merged[name] = dict(metric, values={})
+            values = merged[name]['values']
+            for key, value in metric['values']:
+                key = tuple(key)
+                if key not in values:
+                    values[key] = value
+                elif isinstance(value, list):
+                    values[key] = [old + new for old, new in
+                                   zip(values[key], value)]
+                else:
+                    values[key] += value
+    for metric in merged.values():
+        metric['values'] = [[list(key), value] for key, value in
+                            sorted(metric['values'].items())]
+    return merged
+
+
+def without_gauges(snapshot):
+    ''' Return the counters and histograms of a snapshot. The gauges of a
+    process that exited no longer hold, its counts still do.
+    '''
+    return dict((name, metric) for name, metric in snapshot.items()
+                if metric['kind'] != 'gauge')
+
+
+def is_running(pid):
+    ''' Return whether the process with the pid is still running. '''
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+
+def format_labels(names, values, extra=()):
+    ''' Return the labels of a sample in the text format, like {a="1"}. '''
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(
+        name, value.replace('\\', r'\\').replace('"', r'\"')
+        .replace('\n', r'\n')) for name, value in pairs) + '}'
+
+
+def format_number(value):
+    ''' Return a sample value in the text format. '''
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snapshot=None):
+    ''' Return the metrics in the Prometheus text format.
+    Arguments:
+        snapshot -- the metrics to render, see Registry.snapshot() and
+                    merge(). Those of this process by default.
+    '''
+    if snapshot is None:
+        snapshot = REGISTRY.snapshot()
+    lines = []
+    for name in sorted(snapshot):
+        metric = snapshot[name]
+        lines.append('# HELP {0} {1}'.format(name, metric['documentation']))
+        lines.append('# TYPE {0} {1}'.format(name, metric['kind']))
+        for key, value in metric['values']:
+            if metric['kind'] != 'histogram':
+                lines.append('{0}{1} {2}'.format(
+                    name, format_labels(metric['labels'], key),
+                    format_number(value)))
+                continue
+            cumulative = 0
+            bounds = [format_number(bound) for bound in metric['buckets']]
+            for bound, count in zip(bounds + ['+Inf'], value[:-1]):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(
+                    name, format_labels(metric['labels'], key,
+                                        [('le', bound)]), cumulative))
+            lines.append('{0}_sum{1} {2}'.format(
+                name, format_labels(metric['labels'], key),
+                format_number(value[-1])))
+            lines.append('{0}_count{1} {2}'.format(
+                name, format_labels(metric['labels'], key), cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+def write_atomically(filename, text):
+    ''' Write the text to a temporary file that is renamed when complete, so
+    readers never see half of it.
+    '''
+    temp_filename = '{0}.{1}.tmp'.format(filename, os.getpid())
+    with open(temp_filename, 'w') as outf:
+        outf.write(text)
+    os.rename(temp_filename, filename)
+
+
+def write_textfile(filename):
+    ''' Write the metrics of this process to a file in the text format, as
+    read by the textfile collector of the Prometheus node exporter.
+    '''
+    write_atomically(filename, render())
+
+
+class SharedMetrics(object):
+    ''' Shares the metrics of the processes of a service through a
+    directory.
+
+    Every process writes a snapshot of its metrics to <pid>.json every
+    interval seconds. Any of them can then render the metrics of all of
+    them, so it does not matter which process answers /metrics. The
+    counters and histograms of processes that exited are added to
+    EXITED_FILE, and their snapshots removed, so counters never go down
+    when a process is replaced. Their gauges are dropped.
+    '''
+
+    # The counters and histograms of the processes that exited.
+    EXITED_FILE = 'exited.json'
+    # Held while snapshots are moved into EXITED_FILE, so that none is
+    # counted twice or not at all.
+    LOCK_FILE = '.lock'
+
+    def __init__(self, directory, interval=5.0):
+        ''' Arguments:
+            directory -- the directory with the snapshots.
+            interval  -- seconds between two snapshots of a process.
+        '''
+        self.directory = directory
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        ''' Start writing the snapshots of this process, unless it does
+        already. Forked processes start a thread of their own.
+        '''
+        with self.lock:
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run,
+                                               name='metrics')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def filename(self):
+        ''' Return the name of the snapshot file of this process. '''
+        return os.path.join(self.directory, '{0}.json'.format(os.getpid()))
+
+    def write(self):
+        ''' Write the snapshot of this process. '''
+        write_atomically(self.filename(), json.dumps(REGISTRY.snapshot()))
+
+    def run(self):
+        ''' Write a snapshot every interval seconds, and move those of the
+        processes that exited into EXITED_FILE, forever.
+        '''
+        while True:
+            try:
+                self.write()
+                self.remove_exited()
+            except EnvironmentError as error:
+                print('Writing the metrics failed: {0}'.format(error))
+            time.sleep(self.interval)
+
+    def locked(self, exclusive):
+        ''' Return the LOCK_FILE of the directory, locked for this process
+        alone or shared with other readers. Closing it releases the lock.
+        '''
+        lock_file = open(os.path.join(self.directory, self.LOCK_FILE), 'a')
+        if fcntl is None:
+            return lock_file
+        try:
+            fcntl.flock(lock_file,
+                        fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        except BaseException:
+            lock_file.close()
+            raise
+        return lock_file
+
+    def read_snapshots(self):
+        ''' Return (pid, snapshot) of every snapshot file in the directory
+        except that of this process. The pid of EXITED_FILE is None.
+        '''
+        snapshots = []
+        for filename in glob.glob(os.path.join(self.directory, '*.json')):
+            if filename == self.filename():
+                continue
+            name = os.path.basename(filename)
+            if name == self.EXITED_FILE:
+                pid = None
+            elif name[:-len('.json')].isdigit():
+                pid = int(name[:-len('.json')])
+            else:
+                continue
+            try:
+                with open(filename, 'r') as infile:
+                    snapshots.append((pid, json.load(infile)))
+            except (EnvironmentError, ValueError):
+                continue  # Being replaced, it is in the next scrape.
+        return snapshots
+
+    def remove_exited(self):
+        ''' Add the counters and histograms of the processes that exited
+        to EXITED_FILE, and remove their snapshots.
+        '''
+        with self.locked(exclusive=True):
+            snapshots = self.read_snapshots()
+            exited = [pid for pid, _ in snapshots
+                      if pid is not None and not is_running(pid)]
+            if not exited:
+                return
+            write_atomically(
+                os.path.join(self.directory, self.EXITED_FILE),
+                json.dumps(merge(without_gauges(snapshot)
+                                 for pid, snapshot in snapshots
+                                 if pid is None or pid in exited)))
+            for pid in exited:
+                os.remove(os.path.join(self.directory,
+                                       '{0}.json'.format(pid)))
+
+    def render(self):
+        ''' Return the metrics of all processes in the text format, with
+        the live ones of this process. Only the gauges of running processes
+        are included.
+        '''
+        self.start()
+        snapshots = [REGISTRY.snapshot()]
+        with self.locked(exclusive=False):
+            for pid, snapshot in self.read_snapshots():
+                if pid is None or not is_running(pid):
+                    snapshot = without_gauges(snapshot)
+                snapshots.append(snapshot)
+        return render(merge(snapshots))
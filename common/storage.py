@@ -0,0 +1,524 @@
+'''
+Utilities for:
+    - storing the Iridium coordinates and the photo information in a single
+      SQLite database, shared by the app and images services
+    - importing the CSV files used before, and exporting to them for
+      backward compatibility
+
+The existing CSV files are copied into the database once, by the services
+when they start or with "python storage.py import", see import_csv. Run
+"python storage.py export" to write the CSV files from the database.
+'''
+
+from __future__ import print_function
+import os
+import sys
+import csv
+import time
+import sqlite3
+import threading
+
+# The data directory shared by the services, /data in the containers.
+DATA_DIR = os.environ.get('DATA_DIR', '/data')
+DATABASE = os.environ.get('DATABASE',
+                          os.path.join(DATA_DIR, 'whereispatrick.db'))
+COORDINATES_CSV = os.path.join(DATA_DIR, 'coordinates.csv')
+IMAGES_CSV = os.path.join(DATA_DIR, 'images.csv')
+# Also append every new row to the CSV files, for anything that still reads
+# those. Set CSV_EXPORT=0 to turn this off.
+CSV_EXPORT = os.environ.get('CSV_EXPORT', '1') != '0'
+
+# Setting recording that the CSV files were imported, and how many rows.
+IMPORT_SETTING = 'csv_imported'
+
+# The rows are returned in the column order of the old CSV files.
+COORDINATE_COLUMNS = ('lat', 'lon', 'alt', 'time')
+IMAGE_COLUMNS = ('shown', 'name', 'lat', 'lon', 'alt', 'time')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS coordinates (
+    id INTEGER PRIMARY KEY,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    alt NUMERIC,
+    time TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS coordinates_time ON coordinates (time);
+CREATE INDEX IF NOT EXISTS coordinates_location ON coordinates (lat, lon);
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    shown INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    lat REAL,
+    lon REAL,
+    alt NUMERIC,
+    time TEXT
+);
+CREATE INDEX IF NOT EXISTS images_name ON images (name);
+CREATE INDEX IF NOT EXISTS images_time ON images (time);
+CREATE INDEX IF NOT EXISTS images_location ON images (lat, lon);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS drive_files (
+    file_id TEXT PRIMARY KEY,
+    md5 TEXT,
+    name TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS drive_files_md5 ON drive_files (md5);
+CREATE INDEX IF NOT EXISTS drive_files_done ON drive_files (done);
+'''
+
+# Connections can not be shared between threads, every thread gets its own.
+THREAD_DATA = threading.local()
+
+
+def connect(filename=DATABASE):
+    ''' Returns a new connection to the database, creating the tables if
+    needed.
+
+    The database is in WAL mode, so readers never block the writer and the
+    writer never blocks readers. Writers wait up to 30 seconds for each
+    other.
+    Arguments:
+        string: name of the database file.
+    Returns:
+        sqlite3.Connection: the connection.
+    '''
+    connection = sqlite3.connect(filename, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def get_connection():
+    ''' Returns the connection of the current thread. '''
+    connections = getattr(THREAD_DATA, 'connections', None)
+    if connections is None:
+        connections = THREAD_DATA.connections = {}
+    if DATABASE not in connections:
+        connections[DATABASE] = connect(DATABASE)
+    return connections[DATABASE]
+
+
+def append_csv(filename, rows, durable=False):
+    ''' Appends the rows to the given CSV file, and makes sure they are on
+    disk before returning if durable is set.
+    '''
+    with open(filename, 'a') as outf:
+        writer = csv.writer(outf)
+        for row in rows:
+            writer.writerow(row)
+        if durable:
+            outf.flush()
+            os.fsync(outf.fileno())
+
+
+def add_coordinates(rows, export=CSV_EXPORT):
+    ''' Stores new Iridium coordinates.
+
+    Arguments:
+        list: rows of (lat, lon, alt, time).
+        bool: whether to also append the rows to the coordinates CSV file.
+    Returns:
+        None
+    '''
+    rows = [(row[0], row[1], row[2], str(row[3])) for row in rows]
+    connection = get_connection()
+    with connection:
+        connection.executemany(
+            'INSERT INTO coordinates (lat, lon, alt, time) '
+            'VALUES (?, ?, ?, ?)', rows)
+        set_modified('coordinates', connection)
+    if export:
+        append_csv(COORDINATES_CSV, rows)
+
+
+def add_new_coordinates(rows, export=CSV_EXPORT, durable=True):
+    ''' Stores the Iridium coordinates that are not stored yet.
+
+    A coordinate with the same (time, lat, lon) as a stored one is a message
+    that was delivered twice and is skipped. Every check is part of its
+    insert statement, so this is safe with several processes writing.
+    Arguments:
+        list: rows of (lat, lon, alt, time).
+        bool: whether to also append the new rows to the coordinates CSV file.
+        bool: whether to wait until the rows are on disk, not just in the
+              operating system's buffers, before returning.
+    Returns:
+        int: the number of rows that were added.
+    '''
+    rows = [(row[0], row[1], row[2], str(row[3])) for row in rows]
+    connection = get_connection()
+    if durable:
+        # Sync the WAL on every commit instead of only on checkpoints.
+        connection.execute('PRAGMA synchronous=FULL')
+    added = []
+    try:
+        with connection:
+            for row in rows:
+                cursor = connection.execute(
+                    'INSERT INTO coordinates (lat, lon, alt, time) '
+                    'SELECT ?, ?, ?, ? WHERE NOT EXISTS ('
+                    'SELECT 1 FROM coordinates '
+                    'WHERE time = ? AND lat = ? AND lon = ?)',
+                    row + (row[3], row[0], row[1]))
+                if cursor.rowcount == 1:
+                    added.append(row)
+            if added:
+                set_modified('coordinates', connection)
+    finally:
+        if durable:
+            connection.execute('PRAGMA synchronous=NORMAL')
+    if export and added:
+        append_csv(COORDINATES_CSV, added, durable)
+    return len(added)
+
+
+def add_images(rows, export=CSV_EXPORT, file_ids=()):
+    ''' Stores the information of new photos.
+
+    Arguments:
+        list: rows of (shown, name, lat, lon, alt, time), see
+              images.get_image_gps_info.
+        bool: whether to also append the rows to the images CSV file.
+        list: the GD file ids of the photos, which are marked as done in the
+              same transaction, see add_drive_files.
+    Returns:
+        None
+    '''
+    rows = [(row[0], row[1], row[2], row[3], row[4], str(row[5]))
+            for row in rows]
+    connection = get_connection()
+    with connection:
+        connection.executemany(
+            'INSERT INTO images (shown, name, lat, lon, alt, time) '
+            'VALUES (?, ?, ?, ?, ?, ?)', rows)
+        connection.executemany(
+            'UPDATE drive_files SET done = 1 WHERE file_id = ?',
+            [(file_id,) for file_id in file_ids])
+        set_modified('images', connection)
+    if export:
+        append_csv(IMAGES_CSV, rows)
+
+
+def get_rows(table, since=0, limit=-1):
+    ''' Returns the rows that were added to the table after the given id.
+
+    Arguments:
+        string: 'coordinates' or 'images'.
+        int: only return rows with a larger id, 0 for all rows.
+        int: the maximum number of rows to return, -1 for no limit.
+    Returns:
+        list: (id, row) for every row, in the order they were added.
+    '''
+    columns = COORDINATE_COLUMNS if table == 'coordinates' else IMAGE_COLUMNS
+    cursor = get_connection().execute(
+        'SELECT id, {0} FROM {1} WHERE id > ? ORDER BY id LIMIT ?'.format(
+            ', '.join(columns), table), (since, limit))
+    return [(row[0], list(row[1:])) for row in cursor]
+
+
+def get_counter(key, connection=None):
+    ''' Returns the value of a counter in the meta table, 0 if it was never
+    bumped.
+    '''
+    row = (connection or get_connection()).execute(
+        'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else 0
+
+
+def bump_counter(key, connection=None):
+    ''' Increments a counter in the meta table, as part of the current
+    transaction of the connection, or in a transaction of its own if no
+    connection is given.
+    '''
+    if connection is None:
+        connection = get_connection()
+        with connection:
+            bump_counter(key, connection)
+        return
+    connection.execute('INSERT OR IGNORE INTO meta (key, value) VALUES (?, 0)',
+                       (key,))
+    connection.execute('UPDATE meta SET value = value + 1 WHERE key = ?',
+                       (key,))
+
+
+def set_modified(table, connection):
+    ''' Records the current time as the last change of the table, as part
+    of the current transaction of the connection.
+    '''
+    connection.execute(
+        'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+        (table + '_modified', int(time.time())))
+
+
+def get_modified(table):
+    ''' Returns the time of the last change of the table in seconds since
+    the epoch, the same in every process, or None if it was not recorded.
+    '''
+    row = get_connection().execute(
+        'SELECT value FROM meta WHERE key = ?',
+        (table + '_modified',)).fetchone()
+    return row[0] if row else None
+
+
+def get_version(table):
+    ''' Returns the version of the table: (generation, id of the last row).
+
+    The last id changes whenever a row is added, and is 0 if the table is
+    empty. The generation changes whenever the rows were rewritten, after
+    which rows can have different ids than before.
+    '''
+    connection = get_connection()
+    last_id = connection.execute(
+        'SELECT COALESCE(MAX(id), 0) FROM {0}'.format(table)).fetchone()[0]
+    return (get_counter(table + '_generation', connection), last_id)
+
+
+def get_coordinate_keys():
+    ''' Returns the set of (time, lat, lon) of all stored coordinates. '''
+    return set(get_connection().execute(
+        'SELECT time, lat, lon FROM coordinates'))
+
+
+def backfill_coordinates(rows, export=CSV_EXPORT):
+    ''' Stores older Iridium coordinates, for example from an exported dump.
+
+    Rows that are already stored are skipped. The table is then rewritten in
+    order of time, so the new rows are not just appended after the newer
+    ones, and its generation is bumped so readers start over.
+    Arguments:
+        list: rows of (lat, lon, alt, time).
+        bool: whether to also rewrite the CSV files.
+    Returns:
+        int: the number of rows that were added.
+    '''
+    known = get_coordinate_keys()
+    new_rows = []
+    for row in rows:
+        row = (row[0], row[1], row[2], str(row[3]))
+        if (row[3], row[0], row[1]) not in known:
+            known.add((row[3], row[0], row[1]))
+            new_rows.append(row)
+    if not new_rows:
+        return 0
+    connection = get_connection()
+    with connection:
+        connection.executemany(
+            'INSERT INTO coordinates (lat, lon, alt, time) '
+            'VALUES (?, ?, ?, ?)', new_rows)
+        connection.execute(
+            'CREATE TEMP TABLE sorted AS SELECT lat, lon, alt, time '
+            'FROM coordinates ORDER BY time, id')
+        connection.execute('DELETE FROM coordinates')
+        connection.execute(
+            'INSERT INTO coordinates (lat, lon, alt, time) '
+            'SELECT lat, lon, alt, time FROM sorted ORDER BY rowid')
+        connection.execute('DROP TABLE sorted')
+        bump_counter('coordinates_generation', connection)
+        set_modified('coordinates', connection)
+    if export:
+        export_csv()
+    return len(new_rows)
+
+
+def get_image_names():
+    ''' Returns the set of the names of all processed photos. '''
+    return set(row[0] for row in
+               get_connection().execute('SELECT name FROM images'))
+
+
+def get_setting(key, default=None):
+    ''' Returns a string stored with set_setting, or the default. '''
+    row = get_connection().execute(
+        'SELECT value FROM settings WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_setting(key, value):
+    ''' Stores a string under the key, replacing what was stored before. '''
+    connection = get_connection()
+    with connection:
+        connection.execute(
+            'INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+            (key, value))
+
+
+def add_drive_files(items, done=False, setting=None):
+    ''' Records GD files, so that each file is only processed once. Files
+    that are already recorded are left as they are.
+
+    Arguments:
+        list: GD file items, with the 'id', 'name' and 'md5Checksum'.
+        bool: whether the files are done, or still have to be processed.
+        tuple: (key, value) of a setting to store in the same transaction,
+               for example the GD page token the files were listed with.
+    Returns:
+        None
+    '''
+    connection = get_connection()
+    with connection:
+        connection.executemany(
+            'INSERT OR IGNORE INTO drive_files (file_id, md5, name, done) '
+            'VALUES (?, ?, ?, ?)',
+            [(item['id'], item.get('md5Checksum'), item['name'], int(done))
+             for item in items])
+        if setting is not None:
+            connection.execute(
+                'INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+                setting)
+
+
+def get_drive_files(pending_only=False):
+    ''' Returns the recorded GD files as items with the 'id', 'name' and
+    'md5Checksum', only those still to be processed if pending_only is set.
+    '''
+    query = 'SELECT file_id, name, md5 FROM drive_files'
+    if pending_only:
+        query += ' WHERE done = 0'
+    return [{'id': row[0], 'name': row[1], 'md5Checksum': row[2]}
+            for row in get_connection().execute(query + ' ORDER BY rowid')]
+
+
+def get_latest_coordinate():
+    ''' Returns the most recent Iridium coordinate (lat, lon, alt, time), or
+    None if there is none. Uses the index on time.
+    '''
+    row = get_connection().execute(
+        'SELECT {0} FROM coordinates ORDER BY time DESC, id DESC '
+        'LIMIT 1'.format(', '.join(COORDINATE_COLUMNS))).fetchone()
+    return list(row) if row else None
+
+
+def read_csv(filename):
+    ''' Returns all rows of the CSV file, or no rows if it does not exist. '''
+    if not os.path.exists(filename):
+        return []
+    with open(filename, 'r') as infile:
+        return [row for row in csv.reader(infile) if row]
+
+
+def convert_rows(filename, convert):
+    ''' Returns the rows of the CSV file converted by the function. A row
+    that can not be converted is reported and skipped.
+    Arguments:
+        string: name of the CSV file.
+        function: converts a row of strings to a tuple of values.
+    Returns:
+        list: the converted rows.
+    '''
+    rows = []
+    for number, row in enumerate(read_csv(filename), 1):
+        try:
+            rows.append(convert(row))
+        except (ValueError, IndexError) as error:
+            print('Skipping row {0} of {1}: {2!r} ({3})'.format(
+                number, filename, row, error), file=sys.stderr)
+    return rows
+
+
+def import_csv(connection=None):
+    ''' Copies the rows of the CSV files into the database, once.
+
+    The services run this when they start, before they store anything. It
+    runs in a transaction that holds the write lock, so only one of them
+    imports the files. Afterwards IMPORT_SETTING is set, and the CSV files
+    are never imported again. Rows that are already stored, from an import
+    by an earlier version, are skipped, as are rows that can not be read.
+    Arguments:
+        sqlite3.Connection: the connection, a new one that is closed again
+                            by default.
+    Returns:
+        tuple: the numbers of imported coordinates and images, None if the
+               CSV files were imported before.
+    '''
+    if connection is None:
+        connection = connect(DATABASE)
+        try:
+            return import_csv(connection)
+        finally:
+            connection.close()
+    if connection.execute('SELECT 1 FROM settings WHERE key = ?',
+                          (IMPORT_SETTING,)).fetchone():
+        return None
+    coordinate_rows = convert_rows(COORDINATES_CSV, lambda row: (
+        float(row[0]), float(row[1]), int(row[2]), row[3]))
+    image_rows = convert_rows(IMAGES_CSV, lambda row: (
+        int(row[0]), row[1], float(row[2]), float(row[3]), float(row[4]),
+        row[5]))
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        if connection.execute('SELECT 1 FROM settings WHERE key = ?',
+                              (IMPORT_SETTING,)).fetchone():
+            connection.rollback()
+            return None  # Another process was first.
+        coordinates = 0
+        for row in coordinate_rows:
+            coordinates += connection.execute(
+                'INSERT INTO coordinates (lat, lon, alt, time) '
+                'SELECT ?, ?, ?, ? WHERE NOT EXISTS ('
+                'SELECT 1 FROM coordinates '
+                'WHERE time = ? AND lat = ? AND lon = ?)',
+                row + (row[3], row[0], row[1])).rowcount
+        images = 0
+        for row in image_rows:
+            images += connection.execute(
+                'INSERT INTO images (shown, name, lat, lon, alt, time) '
+                'SELECT ?, ?, ?, ?, ?, ? WHERE NOT EXISTS ('
+                'SELECT 1 FROM images WHERE name = ? AND lat = ? '
+                'AND lon = ? AND alt = ? AND time = ?)',
+                row + row[1:]).rowcount
+        if coordinates:
+            set_modified('coordinates', connection)
+        if images:
+            set_modified('images', connection)
+        connection.execute(
+            'INSERT INTO settings (key, value) VALUES (?, ?)',
+            (IMPORT_SETTING, '{0} coordinates, {1} images'.format(
+                coordinates, images)))
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    if coordinates or images:
+        print('Imported {0} coordinates and {1} images from the CSV '
+              'files'.format(coordinates, images))
+    return coordinates, images
+
+
+def export_csv():
+    ''' Writes all rows of the database to the CSV files.
+
+    Arguments:
+        None
+    Returns:
+        None
+    '''
+    for table, filename in (('coordinates', COORDINATES_CSV),
+                            ('images', IMAGES_CSV)):
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w') as outf:
+            writer = csv.writer(outf)
+            for _, row in get_rows(table):
+                writer.writerow(row)
+        os.rename(temp_filename, filename)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['import']:
+        import_csv()
+        print('CSV files imported: {0}'.format(
+            get_setting(IMPORT_SETTING)))
+    elif sys.argv[1:] == ['export']:
+        export_csv()
+    else:
+        print('Usage: python storage.py import|export')
+        sys.exit(1)
@@ -0,0 +1,209 @@
+'''
+Utilities for:
+    - finding the centers of the photo clusters and the photos of every
+      cluster, for all clusters at once
+    - keeping the clusters up to date as photos are added, without running
+      DBSCAN on all photos again
+
+This is the only part of the images service that needs NumPy, so it is only
+imported when the clustering runs.
+'''
+
+import os
+import math
+import numpy as np
+
+
+def get_cluster_centers(coords, cluster_labels):
+    ''' Finds the centers of all clusters at once.
+
+    The center is the spherical mean: the average of the unit vectors of all
+    coordinates in the cluster, converted back to latitude and longitude.
+
+    Arguments:
+        np.array: the coordinates in degrees of all photos.
+        np.array: the cluster number of every photo.
+    Returns:
+        np.array: the coordinates (lat, lon) of every cluster center.
+    '''
+    radians = np.asarray(coords, dtype=float) * math.pi / 180.0
+    lat, lon = radians[:, 0], radians[:, 1]
+    counts = np.bincount(cluster_labels)
+    x_coord = np.bincount(cluster_labels,
+                          weights=np.cos(lat) * np.cos(lon)) / counts
+    y_coord = np.bincount(cluster_labels,
+                          weights=np.cos(lat) * np.sin(lon)) / counts
+    z_coord = np.bincount(cluster_labels, weights=np.sin(lat)) / counts
+    center_lat = np.arctan2(z_coord,
+                            np.sqrt(x_coord * x_coord + y_coord * y_coord))
+    center_lon = np.arctan2(y_coord, x_coord)
+    return np.column_stack((center_lat, center_lon)) * 180.0 / math.pi
+
+
+def group_by_cluster(cluster_labels):
+    ''' Returns the indices of the photos in every cluster, in their
+    original order.
+    '''
+    order = np.argsort(cluster_labels, kind='mergesort')  # stable
+    return np.split(order, np.cumsum(np.bincount(cluster_labels))[:-1])
+
+
+def first_occurrences(cluster_labels, names):
+    ''' Returns a mask of the photos that are the first one with their name
+    in their cluster. Duplicate images can occur from testing and not
+    cleaning up afterwards!
+    '''
+    _, name_codes = np.unique(np.asarray(names).astype(str),
+                              return_inverse=True)
+    keys = cluster_labels.astype(np.int64) * (name_codes.max() + 1) + \
+        name_codes
+    _, first = np.unique(keys, return_index=True)
+    mask = np.zeros(len(cluster_labels), dtype=bool)
+    mask[first] = True
+    return mask
+
+
+class ClusterIndex(object):
+    ''' Incrementally maintained clusters of photo coordinates.
+
+    With min_samples=1, DBSCAN puts two photos in the same cluster whenever
+    there is a chain of photos between them that are each within the cluster
+    radius of the next. Those are the connected components that are kept
+    here in a union-find structure. Photos are looked up in a grid over
+    their unit vectors, with cells as large as the chord of the cluster
+    radius, so all neighbours of a photo are in the surrounding cells.
+
+    The clusters are numbered in the order of the first photo of every
+    cluster, just like DBSCAN numbers them, so the labels match a full run.
+    '''
+
+    def __init__(self, epsilon):
+        ''' Arguments:
+            float: the cluster radius in radians.
+        '''
+        self.epsilon = epsilon
+        self.cell_size = 2.0 * math.sin(epsilon / 2.0)
+        self.coords = np.empty((0, 2))
+        self.parent = []
+        self.cells = {}
+        # The version of the images table (as a string) this index is up to
+        # date with.
+        self.signature = None
+
+    def __len__(self):
+        return len(self.parent)
+
+    def cell_keys(self, coords):
+        ''' Returns the grid cell of each of the coordinates (radians). '''
+        xyz = np.column_stack((np.cos(coords[:, 0]) * np.cos(coords[:, 1]),
+                               np.cos(coords[:, 0]) * np.sin(coords[:, 1]),
+                               np.sin(coords[:, 0])))
+        return [tuple(key) for key in
+                np.floor(xyz / self.cell_size).astype(np.int64).tolist()]
+
+    def find(self, index):
+        ''' Returns the representative photo of the cluster of a photo. '''
+        root = index
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[index] != root:
+            self.parent[index], index = root, self.parent[index]
+        return root
+
+    def union(self, first, second):
+        ''' Merges the clusters of both photos. '''
+        first, second = self.find(first), self.find(second)
+        if first != second:
+            self.parent[max(first, second)] = min(first, second)
+
+    def add(self, coords):
+        ''' Adds new photos, merging them with all clusters within reach.
+
+        Arguments:
+            np.array: the coordinates in radians of the new photos.
+        Returns:
+            None
+        '''
+        start = len(self)
+        self.coords = np.vstack((self.coords, coords))
+        for offset, key in enumerate(self.cell_keys(coords)):
+            index = start + offset
+            self.parent.append(index)
+            candidates = []
+            for d_x in (-1, 0, 1):
+                for d_y in (-1, 0, 1):
+                    for d_z in (-1, 0, 1):
+                        candidates.extend(self.cells.get(
+                            (key[0] + d_x, key[1] + d_y, key[2] + d_z), ()))
+            if candidates:
+                candidates = np.array(candidates)
+                lat, lon = self.coords[index]
+                lats = self.coords[candidates, 0]
+                lons = self.coords[candidates, 1]
+                # Haversine distance, as used by DBSCAN.
+                distances = 2.0 * np.arcsin(np.sqrt(
+                    np.sin((lats - lat) / 2.0) ** 2 +
+                    np.cos(lat) * np.cos(lats) *
+                    np.sin((lons - lon) / 2.0) ** 2))
+                for neighbour in candidates[distances <= self.epsilon]:
+                    self.union(index, int(neighbour))
+            self.cells.setdefault(key, []).append(index)
+
+    def labels(self):
+        ''' Returns the cluster number of every photo. '''
+        roots = np.array([self.find(index) for index in range(len(self))],
+                         dtype=np.int64)
+        # Representatives are the first photo of their cluster, so ranking
+        # them numbers the clusters in order of appearance.
+        _, labels = np.unique(roots, return_inverse=True)
+        return labels
+
+    def index_cells(self):
+        ''' Rebuilds the grid cells of all photos. '''
+        self.cells = {}
+        for photo, key in enumerate(self.cell_keys(self.coords)):
+            self.cells.setdefault(key, []).append(photo)
+
+    @classmethod
+    def from_labels(cls, epsilon, coords, cluster_labels):
+        ''' Builds the index from the result of a full DBSCAN run.
+
+        Arguments:
+            float: the cluster radius in radians.
+            np.array: the coordinates in radians of all photos.
+            np.array: the DBSCAN cluster number of every photo.
+        Returns:
+            ClusterIndex: the index holding these clusters.
+        '''
+        index = cls(epsilon)
+        index.coords = np.array(coords, dtype=float).reshape(-1, 2)
+        _, first = np.unique(cluster_labels, return_index=True)
+        index.parent = first[cluster_labels].tolist()
+        index.index_cells()
+        return index
+
+    @classmethod
+    def load(cls, filename, epsilon):
+        ''' Returns the persisted index, or None if there is none for this
+        cluster radius.
+        '''
+        if not os.path.exists(filename):
+            return None
+        with np.load(filename) as data:
+            if float(data['epsilon']) != epsilon:
+                return None
+            index = cls(epsilon)
+            index.coords = data['coords']
+            index.parent = data['parent'].tolist()
+            index.signature = str(data['signature'])
+        index.index_cells()
+        return index
+
+    def save(self, filename):
+        ''' Persists the index, replacing the file atomically. '''
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'wb') as outf:
+            np.savez(outf, epsilon=self.epsilon, coords=self.coords,
+                     parent=np.array(self.parent, dtype=np.int64),
+                     signature=str(self.signature))
+        os.rename(temp_filename, filename)
@@ -0,0 +1,216 @@
+'''
+A fake Google Drive, for running and testing the images service offline.
+
+It implements the part of the GD API v3 that images.py uses: files().list(),
+files().get_media() (downloadable in ranges, see images.download_range), and
+changes().getStartPageToken() and changes().list(). The files are the jpgs
+in a local folder and its subfolders, which can hold files with the same
+name like the folders of a GD; files copied into the folder later show up
+as changes.
+Run the images service against a folder with:
+
+    FAKE_DRIVE=/path/to/photos python images.py
+
+Tests can make downloads fail, see FakeDrive.inject_failure.
+'''
+
+import os
+import hashlib
+import threading
+import httplib2
+
+
+class Call(object):
+    ''' A prepared API call, run by execute() like the real ones. '''
+
+    def __init__(self, function, **params):
+        self.function = function
+        self.params = params
+
+    def execute(self, **_):
+        ''' Run the call and return its result. '''
+        return self.function(**self.params)
+
+
+class MediaRequest(object):
+    ''' The media download request of a file, like the HttpRequest of the
+    real API: an uri, headers and an http object to request ranges with.
+    '''
+
+    def __init__(self, drive, file_id):
+        self.uri = 'fake://drive/files/{0}?alt=media'.format(file_id)
+        self.headers = {}
+        self.http = MediaHttp(drive, file_id)
+
+
+class MediaHttp(object):
+    ''' Answers the range requests of a media download. '''
+
+    def __init__(self, drive, file_id):
+        self.drive = drive
+        self.file_id = file_id
+
+    def request(self, uri, method='GET', body=None, headers=None, **_):
+        ''' Return (response, content) for the requested range, or raise
+        the failure injected for this request.
+        '''
+        self.drive.fail(self.file_id)
+        data = self.drive.read(self.file_id)
+        start, end = 0, len(data) - 1
+        if headers and 'range' in headers:
+            first, last = headers['range'].split('=')[1].split('-')
+            start, end = int(first), min(end, int(last))
+        if start >= len(data):
+            return httplib2.Response({'status': 416}), b''
+        content = data[start:end + 1]
+        self.drive.count('bytes', len(content))
+        return httplib2.Response({
+            'status': 206,
+            'content-range': 'bytes {0}-{1}/{2}'.format(
+                start, start + len(content) - 1, len(data))}), content
+
+
+class FakeDrive(object):
+    ''' A GD API service handler for the jpgs in a local folder.
+
+    Every file gets an id and an md5 checksum the first time it is seen.
+    The calls and downloaded bytes are counted in self.counters.
+    '''
+
+    def __init__(self, folder, page_size=100):
+        ''' Arguments:
+            folder    -- the folder with the jpg files.
+            page_size -- the largest page size the fake hands out.
+        '''
+        self.folder = folder
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.entries = []
+        self.paths = {}
+        self.ids = {}
+        self.counters = {'list': 0, 'changes': 0, 'get_media': 0,
+                         'bytes': 0}
+        # The media requests per file id, and the failures to inject by
+        # (name, number of the media request of that file).
+        self.media_requests = {}
+        self.failures = {}
+
+    def __call__(self):
+        ''' Return the service handler, so the fake can be passed as the
+        service_factory of images.get_pictures().
+        '''
+        return self
+
+    def count(self, name, number=1):
+        ''' Add to one of the counters. '''
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + number
+
+    def inject_failure(self, name, request, error):
+        ''' Make a media request of the files with the name raise the error,
+        once. The requests of every file are numbered from 0, one per
+        downloaded range.
+        '''
+        with self.lock:
+            self.failures[(name, request)] = error
+
+    def fail(self, file_id):
+        ''' Count a media request of the file, and raise the failure that
+        was injected for it, if any.
+        '''
+        with self.lock:
+            number = self.media_requests.get(file_id, 0)
+            self.media_requests[file_id] = number + 1
+            name = os.path.basename(self.ids[file_id])
+            error = self.failures.pop((name, number), None)
+        if error is not None:
+            raise error
+
+    def scan(self):
+        ''' Pick up the files that were added to the folder. '''
+        with self.lock:
+            paths = [os.path.join(directory, name)
+                     for directory, _, names in os.walk(self.folder)
+                     for name in names]
+            for path in sorted(paths):
+                if path in self.paths:
+                    continue
+                with open(path, 'rb') as infile:
+                    md5 = hashlib.md5(infile.read()).hexdigest()
+                item = {'id': 'fake{0:08d}'.format(len(self.entries) + 1),
+                        'name': os.path.basename(path),
+                        'md5Checksum': md5,
+                        'mimeType': 'image/jpeg',
+                        'trashed': False}
+                self.paths[path] = item
+                self.ids[item['id']] = path
+                self.entries.append((path, item))
+
+    def read(self, file_id):
+        ''' Return the contents of a file. '''
+        with open(self.ids[file_id], 'rb') as infile:
+            return infile.read()
+
+    def page(self, items, page_token, page_size):
+        ''' Return (items on the page, token of the next page or None). '''
+        start = int(page_token or 0)
+        end = start + min(page_size or self.page_size, self.page_size)
+        return items[start:end], str(end) if end < len(items) else None
+
+    def files_list(self, pageToken=None, pageSize=None, **_):
+        ''' files().list(), listing all files. '''
+        self.count('list')
+        self.scan()
+        items, next_token = self.page(
+            [dict(item) for _, item in self.entries], pageToken, pageSize)
+        response = {'files': items}
+        if next_token is not None:
+            response['nextPageToken'] = next_token
+        return response
+
+    def start_page_token(self, **_):
+        ''' changes().getStartPageToken(): the number of files seen. '''
+        self.scan()
+        return {'startPageToken': str(len(self.entries))}
+
+    def changes_list(self, pageToken, pageSize=None, **_):
+        ''' changes().list(): the files added after the page token. The page
+        token of the fake is the number of files seen at the time.
+        '''
+        self.count('changes')
+        self.scan()
+        position = int(pageToken)
+        end = position + min(pageSize or self.page_size, self.page_size)
+        response = {'changes': [{'fileId': item['id'], 'removed': False,
+                                 'file': dict(item)}
+                                for _, item in self.entries[position:end]]}
+        if end < len(self.entries):
+            response['nextPageToken'] = str(end)
+        else:
+            response['newStartPageToken'] = str(len(self.entries))
+        return response
+
+    def get_media(self, fileId, **_):
+        ''' files().get_media(): the download request of a file. '''
+        self.count('get_media')
+        return MediaRequest(self, fileId)
+
+    def files(self):
+        ''' The files collection. '''
+        return Collection(list=lambda **params: Call(self.files_list,
+                                                     **params),
+                          get_media=self.get_media)
+
+    def changes(self):
+        ''' The changes collection. '''
+        return Collection(
+            getStartPageToken=lambda **params: Call(self.start_page_token,
+                                                    **params),
+            list=lambda **params: Call(self.changes_list, **params))
+
+
+class Collection(object):
+    ''' An API collection with the given methods. '''
+
+    def __init__(self, **methods):
+        self.__dict__.update(methods)
@@ -11,32 +11,26 @@ from __future__ import print_function
 import os
 import glob
 import io
+import ssl
+import errno
 import csv
-import shutil
-import math
+import json
+import random
+import socket
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from time import sleep
-
-# External imports
-import pandas as pd
-import numpy as np
-from sklearn.cluster import DBSCAN
-from PIL import Image
-import httplib2
-import piexif
-from apiclient import discovery
-from apiclient.http import MediaIoBaseDownload
-from oauth2client import client
-from oauth2client import tools
-from oauth2client.file import Storage
-
-# The following is needed to handle the possible command line arguments,
-# for example when updating the credentials.
-try:
-    import argparse
-    CLFLAGS = argparse.ArgumentParser(parents=[tools.argparser]).parse_args()
-except ImportError:
-    CLFLAGS = None
+import time
+
+# The external dependencies (NumPy, scikit-learn, Pillow and the Google API
+# client) are imported by the functions that need them. Most runs of a stage
+# find nothing to do, and the service starts much faster and smaller without
+# them.
+import exif
+import metrics
+import scheduler
+import storage
 
 # If modifying these scopes, delete your previously saved credentials
 # so that new credentials can be created.
@@ -44,6 +38,111 @@ SCOPES = 'https://www.googleapis.com/auth/drive'
 CLIENT_SECRET_FILE = 'client_secret.json'
 APPLICATION_NAME = 'whereispatrick'
 
+# Settings for downloading the pictures from the Google Drive: the number of
+# concurrent downloads, the size of each downloaded chunk, and how often (with
+# exponential backoff starting at DOWNLOAD_BACKOFF seconds) a download is
+# retried on transient errors before giving up on it until the next check.
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '4'))
+DOWNLOAD_CHUNKSIZE = int(os.environ.get('DOWNLOAD_CHUNKSIZE',
+                                        str(1024 * 1024)))
+DOWNLOAD_RETRIES = int(os.environ.get('DOWNLOAD_RETRIES', '5'))
+DOWNLOAD_BACKOFF = float(os.environ.get('DOWNLOAD_BACKOFF', '1.0'))
+# Pictures without GPS information are not shown on the map, so normally only
+# their EXIF is downloaded. Set DOWNLOAD_WITHOUT_GPS=1 to download them anyway.
+DOWNLOAD_WITHOUT_GPS = os.environ.get('DOWNLOAD_WITHOUT_GPS', '0') == '1'
+# Only these fields of the GD files are requested, in pages of PAGE_SIZE. The
+# page token of the GD changes feed is stored in the database under
+# PAGE_TOKEN_SETTING, so every check only fetches what changed.
+FILE_FIELDS = 'id, name, md5Checksum, trashed'
+PAGE_SIZE = 1000
+PAGE_TOKEN_SETTING = 'drive_page_token'
+# HTTP status codes for which a download is worth retrying.
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+# Error numbers of socket errors for which a download is worth retrying. Other
+# errors, like a full disk (ENOSPC), are not solved by trying again.
+NETWORK_ERRNOS = frozenset(
+    getattr(errno, name) for name in (
+        'ECONNRESET', 'ECONNREFUSED', 'ECONNABORTED', 'ETIMEDOUT', 'EPIPE',
+        'ENETDOWN', 'ENETUNREACH', 'ENETRESET', 'EHOSTDOWN', 'EHOSTUNREACH')
+    if hasattr(errno, name))
+
+# httplib2 is not thread-safe, so every download thread keeps its own
+# service handler(s) here.
+THREAD_DATA = threading.local()
+
+# Number of processes making thumbnails, one per CPU by default. They are
+# a multiprocessing.Pool: the ProcessPoolExecutor of the futures backport is
+# not reliable on Python 2.
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS',
+                                       str(multiprocessing.cpu_count())))
+# The thumbnail variants (name, width in pixels) made for every photo. The map
+# shows the small ones in the info window and links to the medium ones.
+THUMBNAIL_SIZES = (('small', 150), ('medium', 500))
+THUMBNAIL_QUALITY = 80
+# The thumbnails are served by nginx from this directory. Full-sized jpgs
+# copied into it are made into thumbnails too.
+IMAGE_DIR = os.path.join(storage.DATA_DIR, 'images')
+# Records the variants for every photo, keyed on the name of the original.
+THUMBNAIL_MANIFEST = os.path.join(IMAGE_DIR, 'manifest.json')
+# The downloads and the jpgs dropped into the image directory both add to the
+# manifest, one at a time.
+MANIFEST_LOCK = threading.Lock()
+
+# The stages of the service run independently, see scheduler.py. The GD is
+# checked every DOWNLOAD_INTERVAL seconds, full-sized jpgs copied into the
+# image directory are processed as soon as they are written, and the
+# clustering runs once no download stored new photos for CLUSTERING_DEBOUNCE
+# seconds. The INTERVALs are the longest time between two runs of a stage.
+# The state of every stage is written to STATUS_FILE.
+DOWNLOAD_INTERVAL = float(os.environ.get('DOWNLOAD_INTERVAL', '300'))
+THUMBNAIL_INTERVAL = float(os.environ.get('THUMBNAIL_INTERVAL', '3600'))
+CLUSTERING_INTERVAL = float(os.environ.get('CLUSTERING_INTERVAL', '3600'))
+CLUSTERING_DEBOUNCE = float(os.environ.get('CLUSTERING_DEBOUNCE', '60'))
+STATUS_FILE = os.environ.get('STATUS_FILE', os.path.join(
+    storage.DATA_DIR, 'images_status.json'))
+# The metrics of the service are written here in the Prometheus text format,
+# for the textfile collector of the node exporter.
+METRICS_FILE = os.environ.get('METRICS_FILE', os.path.join(
+    storage.DATA_DIR, 'images_metrics.prom'))
+
+DOWNLOADS = metrics.counter(
+    'images_downloads_total',
+    'New GD files, by result: photo (downloaded), exif_only (no GPS '
+    'information) or failed.', ['result'])
+DOWNLOAD_BYTES = metrics.counter('images_download_bytes_total',
+                                 'Bytes downloaded from the GD.')
+DOWNLOAD_SECONDS = metrics.histogram(
+    'images_download_seconds', 'Seconds spent downloading one GD file.')
+DOWNLOAD_RATE = metrics.gauge(
+    'images_download_photos_per_second',
+    'New GD files stored per second by the last check that found any.')
+THUMBNAILS = metrics.counter('images_thumbnails_total',
+                             'Photos made into thumbnails, by result.',
+                             ['result'])
+DBSCAN_SECONDS = metrics.histogram(
+    'images_dbscan_seconds',
+    'Seconds spent clustering, by mode: full (DBSCAN on all photos) or '
+    'incremental (only the new photos).', ['mode'])
+CLUSTERS = metrics.gauge('images_clusters', 'Number of photo clusters.')
+CLUSTERED_PHOTOS = metrics.gauge('images_clustered_photos',
+                                 'Number of photos that were clustered.')
+
+# The clustering state is kept here between runs, so that new photos can be
+# added to the existing clusters.
+CLUSTER_INDEX_FILE = os.path.join(storage.DATA_DIR,
+                                  'image_cluster_index.npz')
+# The clusters are written to a CSV file, and to a JSON lines file that is
+# much faster to read, see write_clusters_json.
+CLUSTERS_CSV = os.path.join(storage.DATA_DIR, 'image_clusters.csv')
+CLUSTERS_JSON = os.path.join(storage.DATA_DIR, 'image_clusters.jsonl')
+# The cluster radius and the version of the images table of the last
+# clustering, so a run without new photos stops before loading anything.
+CLUSTERS_SIGNATURE_SETTING = 'clusters_signature'
+# The columns of numbers of all photos, see photoindex.py.
+PHOTO_INDEX_DIR = os.path.join(storage.DATA_DIR, 'photo_index')
+PHOTO_INDEX_LOCK = threading.Lock()
+EARTH_RADIUS = 6371008.8  # meters per Earth radian
+
 
 def get_credentials():
     """Gets valid user credentials from storage.
@@ -64,33 +163,39 @@ def get_credentials():
     credential_path = os.path.join(credential_dir,
                                    'whereispatrickcred.json')
 
+    from oauth2client import client
+    from oauth2client import tools
+    from oauth2client.file import Storage
     store = Storage(credential_path)
     credentials = store.get()
     if not credentials or credentials.invalid:
         flow = client.flow_from_clientsecrets(CLIENT_SECRET_FILE, SCOPES)
         flow.user_agent = APPLICATION_NAME
-        if CLFLAGS:
-            credentials = tools.run_flow(flow, store, CLFLAGS)
+        # The command line arguments are only needed here, for example
+        # --noauth_local_webserver when updating the credentials.
+        try:
+            import argparse
+            flags = argparse.ArgumentParser(
+                parents=[tools.argparser]).parse_args()
+        except ImportError:
+            flags = None
+        if flags:
+            credentials = tools.run_flow(flow, store, flags)
         else:  # Needed only for compatibility with Python 2.6
             credentials = tools.run(flow, store)
         print('Storing credentials to ' + credential_path)
     return credentials
 
 
-def get_images_list():
-    ''' Retrieves the meta information of the images from the local CSV file.
+def get_images_list(count=-1):
+    ''' Retrieves the meta information of the images from the database.
 
     Arguments:
-        None
+        int: the number of images, all of them by default.
     Returns:
-        list: a list of the image information for all lines in the image file.
+        list: a list of the image information for the first count images.
     '''
-    result = []
-    with open('/data/images.csv', 'r') as infile:
-        reader = csv.reader(infile)
-        for row in reader:
-            result.append(row)
-    return result
+    return [row for _, row in storage.get_rows('images', limit=count)]
 
 
 def get_sign(code):
@@ -131,7 +236,7 @@ def deg_min_sec_todeg(degs, mins, secs, sign_code):
         return sign * degrees
 
 
-def get_image_gps_info(image):
+def get_image_gps_info(image, gps=None):
     ''' Returns the GPS information found in the EXIF of the image.
 
     The piece of info we want is in the GPS section of the EXIF. This can
@@ -149,8 +254,10 @@ def get_image_gps_info(image):
         27: some crazy stuff,                     undefined data (?)
         29: '2017:07:12'                          date
         }
+    Only the EXIF segment at the start of the file is read, see exif.py.
     Arguments:
         string: name of the image for which to extract the EXIF information.
+        dict: the GPS information, if it was already read from the file.
     Returns:
         int: 1 (use this image) or 0 (do not use this image).
         string: name of the image.
@@ -159,35 +266,14 @@ def get_image_gps_info(image):
         float: altitude in unit of the phone setting.
         datetime: date_and_time in the phone setting (not always local time).
     '''
-    exif = piexif.load(image)
+    gps = exif.read_gps_file(image) if gps is None else gps
     # Make sure that there is in fact GPS information available.
-    if len(exif['GPS']) > 0:
-        # First get the coordinates in the correct Google Maps API shape.
-        # Google maps API wants the coordinates in degrees, with the sign
-        # indicating the hemispheres.
-        # See key in docstring above.
-        latitude = deg_min_sec_todeg(exif['GPS'][2][0],   # degrees
-                                     exif['GPS'][2][1],   # minutes
-                                     exif['GPS'][2][2],   # seconds
-                                     exif['GPS'][1])      # hemisphere
-        longitude = deg_min_sec_todeg(exif['GPS'][4][0],  # degrees
-                                      exif['GPS'][4][1],  # minutes
-                                      exif['GPS'][4][2],  # seconds
-                                      exif['GPS'][3])     # hemisphere
-        if latitude == 0 or longitude == 0:
-            return 0, image, 0, 0, 0, 0  # Something went wrong.
-        # Also get the altitude.
-        altitude = exif['GPS'][6][0]/exif['GPS'][6][1]
-        # Now get the time and put in datetime format.
-        # You probably want to check the time zone. For these
-        # pictures, the GPS time is not in local time.
-        hour = exif['GPS'][7][0][0]/exif['GPS'][7][0][1]
-        minute = exif['GPS'][7][1][0]/exif['GPS'][7][1][1]
-        second = exif['GPS'][7][2][0]/exif['GPS'][7][2][1]
-        datestring = '{0} {1}:{2}:{3}'.format(exif['GPS'][29], hour,
-                                              minute, second)
-        date_and_time = datetime.strptime(datestring, '%Y:%m:%d %H:%M:%S')
-        return 1, image, latitude, longitude, altitude, date_and_time
+    if len(gps) > 0:
+        try:
+            return gps_info(image, gps)
+        except (KeyError, IndexError, TypeError, ValueError,
+                ZeroDivisionError):
+            return 0, image, 0, 0, 0, 0  # Incomplete GPS information.
     else:
         # No GPS coordinates available. We still want an entry to indicate
         # that this picture was processed. This will prevent duplicate GD
@@ -196,17 +282,51 @@ def get_image_gps_info(image):
         return 0, image, 0, 0, 0, 0
 
 
+def gps_info(image, gps):
+    ''' Returns the image information from its GPS fields, see
+    get_image_gps_info.
+    '''
+    # First get the coordinates in the correct Google Maps API shape.
+    # Google maps API wants the coordinates in degrees, with the sign
+    # indicating the hemispheres.
+    # See key in docstring above.
+    latitude = deg_min_sec_todeg(gps[2][0],   # degrees
+                                 gps[2][1],   # minutes
+                                 gps[2][2],   # seconds
+                                 gps[1])      # hemisphere
+    longitude = deg_min_sec_todeg(gps[4][0],  # degrees
+                                  gps[4][1],  # minutes
+                                  gps[4][2],  # seconds
+                                  gps[3])     # hemisphere
+    if latitude == 0 or longitude == 0:
+        return 0, image, 0, 0, 0, 0  # Something went wrong.
+    # Also get the altitude.
+    altitude = gps[6][0]/gps[6][1]
+    # Now get the time and put in datetime format.
+    # You probably want to check the time zone. For these
+    # pictures, the GPS time is not in local time.
+    hour = gps[7][0][0]//gps[7][0][1]
+    minute = gps[7][1][0]//gps[7][1][1]
+    second = gps[7][2][0]//gps[7][2][1]
+    datestring = '{0} {1}:{2}:{3}'.format(gps[29], hour,
+                                          minute, second)
+    date_and_time = datetime.strptime(datestring, '%Y:%m:%d %H:%M:%S')
+    return 1, image, latitude, longitude, altitude, date_and_time
+
+
 def list_files(service):
     ''' Generator to yield the GD files.
     From https://gist.github.com/revolunet/9507070
+    Only the fields that are needed are requested, in pages of PAGE_SIZE.
     Arguments:
         service: the GD API service handler.
     Yields:
-        dict:
+        dict: the GD file item, with the FILE_FIELDS.
     '''
     page_token = None
     while True:
-        param = {}
+        param = {'pageSize': PAGE_SIZE, 'q': 'trashed = false',
+                 'fields': 'nextPageToken, files({0})'.format(FILE_FIELDS)}
         if page_token:
             param['pageToken'] = page_token
         files = service.files().list(**param).execute()
@@ -217,44 +337,282 @@ def list_files(service):
             break
 
 
-def jpg_to_png_thumbnail(dimension, image_name):
+def list_changes(service, page_token):
+    ''' Returns the GD files that were added or changed since the page token
+    was handed out.
+
+    Arguments:
+        service: the GD API service handler.
+        string: the page token, from an earlier call or from
+                changes().getStartPageToken().
+    Returns:
+        list: the GD file items, with the FILE_FIELDS.
+        string: the page token to pass the next time.
+    '''
+    items = []
+    fields = 'nextPageToken, newStartPageToken, changes(fileId, removed, ' \
+        'file({0}))'.format(FILE_FIELDS)
+    while True:
+        changes = service.changes().list(pageToken=page_token,
+                                         pageSize=PAGE_SIZE, spaces='drive',
+                                         fields=fields).execute()
+        for change in changes.get('changes', []):
+            if not change.get('removed') and 'file' in change:
+                items.append(change['file'])
+        if 'newStartPageToken' in changes:
+            return items, changes['newStartPageToken']
+        page_token = changes['nextPageToken']
+
+
+def find_new_files(service):
+    ''' Returns the GD files that still have to be downloaded.
+
+    Only the changes since the previous check are fetched, using the page
+    token stored in the database. The first time, all files are listed.
+    New files are recorded as pending together with the new page token, and
+    are marked as done once their image information is stored, so a failed
+    download is tried again the next time. A file is only new if both its
+    id and its md5 checksum are unknown. Names are not unique, cameras
+    reuse them, so they are only compared during the first listing: that
+    is when the photos stored before the GD files were recorded are
+    matched, as those only have their name.
+
+    Arguments:
+        service: the GD API service handler.
+    Returns:
+        list: the GD file items to download, with the 'id', 'name' and
+              'md5Checksum'.
+    '''
+    page_token = storage.get_setting(PAGE_TOKEN_SETTING)
+    if page_token is None:
+        # Ask for the token first, so nothing added while listing is missed.
+        new_token = service.changes().getStartPageToken().execute()[
+            'startPageToken']
+        items = list_files(service)
+    else:
+        items, new_token = list_changes(service, page_token)
+    known = storage.get_drive_files()
+    known_ids = set(item['id'] for item in known)
+    known_checksums = set(item['md5Checksum'] for item in known)
+    # Photos stored before the GD files were recorded only have their name.
+    known_names = storage.get_image_names() if page_token is None else set()
+    new_items = []
+    duplicates = []
+    for item in items:
+        # Only process jpg files. If there are multiple directories, you can
+        # check the file parents to make sure you are looking in the right
+        # directory. Not needed in my case.
+        if not item['name'].endswith('.jpg') or item.get('trashed') or \
+                item['id'] in known_ids:
+            continue
+        known_ids.add(item['id'])
+        checksum = item.get('md5Checksum')
+        if (checksum is not None and checksum in known_checksums) or \
+                item['name'] in known_names:
+            # The same photo again, or one that was stored by name.
+            duplicates.append(item)
+        else:
+            new_items.append(item)
+        known_checksums.add(checksum)
+    storage.add_drive_files(duplicates, done=True)
+    storage.add_drive_files(new_items,
+                            setting=(PAGE_TOKEN_SETTING, new_token))
+    return storage.get_drive_files(pending_only=True)
+
+
+def save_atomically(image, filename, image_format, **params):
+    ''' Saves the image to a temporary file that is renamed when complete,
+    so a crash never leaves a truncated image behind.
+
+    Arguments:
+        Image: the image to save.
+        string: name of the file.
+        string: the image format, for example 'PNG'.
+        params: extra options for the image writer.
+    Returns:
+        None
+    '''
+    temp_filename = filename + '.tmp'
+    image.save(temp_filename, image_format, **params)
+    os.rename(temp_filename, filename)
+
+
+def open_draft(image_name, dimension):
+    ''' Opens a jpg image and lets the JPEG decoder scale it down while
+    decoding (draft mode), which is a lot cheaper than decoding all pixels
+    of a large photo.
+
+    Arguments:
+        string: name of the image.
+        int: the largest width that is needed in pixels.
+    Returns:
+        Image: the opened image, at least dimension pixels wide.
+    '''
+    from PIL import Image
+    image = Image.open(image_name)
+    # The decoder picks the smallest scale that is at least this large.
+    image.draft('RGB', (dimension,
+                        int(float(image.size[1]) * dimension / image.size[0])))
+    return image
+
+
+def resize_to_width(image, dimension):
+    ''' Returns the image resized to the given width, keeping its aspect
+    ratio.
+    '''
+    from PIL import Image
+    wpercent = (dimension/float(image.size[0]))
+    hsize = int((float(image.size[1])*float(wpercent)))
+    return image.resize((dimension, hsize), Image.LANCZOS)
+
+
+def jpg_to_png_thumbnail(dimension, image_name, output_dir=None):
     ''' Creates and saves a png thumbnail of the provided
     jpg image and width dimension.
 
     Arguments:
         int:width dimension of thumbnail in pixels.
         string: name of the image.
+        string: directory for the thumbnail, the image directory by default.
     Returns:
         string: name of the new image.
     '''
-
-    image = Image.open(image_name)
-    wpercent = (dimension/float(image.size[0]))
-    hsize = int((float(image.size[1])*float(wpercent)))
-    img = image.resize((dimension, hsize), Image.ANTIALIAS)
+    img = resize_to_width(open_draft(image_name, dimension), dimension)
     new_image = image_name.replace('.jpg', '.png')
-    img.save(new_image)
+    if output_dir is not None:
+        new_image = os.path.join(output_dir, os.path.basename(new_image))
+    save_atomically(img, new_image, 'PNG')
     return new_image
 
 
+def make_thumbnails(image_name, output_dir=None):
+    ''' Creates and saves all thumbnail variants (see THUMBNAIL_SIZES) of
+    the provided jpg image.
+
+    The variants are WebP when Pillow supports it, progressive JPEG
+    otherwise. Both are several times smaller than png for photos.
+
+    Arguments:
+        string: name of the image.
+        string: directory for the thumbnails, the image directory by default.
+    Returns:
+        dict: the file name (without directory) of every variant.
+    '''
+    from PIL import features
+    if features.check('webp'):
+        extension, image_format = 'webp', 'WEBP'
+        params = {'quality': THUMBNAIL_QUALITY, 'method': 6}
+    else:
+        extension, image_format = 'jpg', 'JPEG'
+        params = {'quality': THUMBNAIL_QUALITY, 'progressive': True,
+                  'optimize': True}
+    if output_dir is None:
+        output_dir = os.path.dirname(image_name)
+    base_name = os.path.splitext(os.path.basename(image_name))[0]
+    image = open_draft(image_name, max(size for _, size in THUMBNAIL_SIZES))
+    image = image.convert('RGB')
+    variants = {}
+    for variant, dimension in THUMBNAIL_SIZES:
+        variants[variant] = '{0}_{1}.{2}'.format(base_name, variant, extension)
+        save_atomically(resize_to_width(image, dimension),
+                        os.path.join(output_dir, variants[variant]),
+                        image_format, **params)
+    return variants
+
+
+def update_thumbnail_manifest(new_variants, filename=THUMBNAIL_MANIFEST):
+    ''' Adds the variants of newly processed images to the manifest.
+
+    Only the main process writes the manifest, the file is replaced
+    atomically.
+
+    Arguments:
+        dict: the variants (see make_thumbnails) for every image name.
+        string: name of the manifest file.
+    Returns:
+        None
+    '''
+    with MANIFEST_LOCK:
+        manifest = {}
+        if os.path.exists(filename):
+            with open(filename, 'r') as infile:
+                manifest = json.load(infile)
+        manifest.update(new_variants)
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w') as outf:
+            json.dump(manifest, outf, sort_keys=True)
+        os.rename(temp_filename, filename)
+
+
+def wait_for_thumbnails(results):
+    ''' Waits for the submitted thumbnail jobs, reports the failures and
+    records the new variants in the manifest.
+
+    Arguments:
+        dict: the image name for every AsyncResult of the thumbnail pool.
+    Returns:
+        int: the number of failed jobs.
+    '''
+    failed = 0
+    new_variants = {}
+    for result, image_name in results.items():
+        try:
+            new_variants[os.path.basename(image_name)] = result.get()
+        except Exception as error:  # pylint: disable=broad-except
+            failed += 1
+            print('{0} !! thumbnail of {1} failed: {2}'.format(
+                datetime.now(), image_name, error))
+    THUMBNAILS.inc(len(new_variants), result='success')
+    THUMBNAILS.inc(failed, result='failure')
+    if new_variants:
+        update_thumbnail_manifest(new_variants)
+    return failed
+
+
+def is_thumbnail(image_name):
+    ''' Returns True if the jpg is one of the thumbnail variants, see
+    make_thumbnails.
+    '''
+    base_name = os.path.splitext(os.path.basename(image_name))[0]
+    return any(base_name.endswith('_' + variant)
+               for variant, _ in THUMBNAIL_SIZES)
+
+
+def full_sized_jpgs():
+    ''' Returns the names of the full-sized jpgs in the image directory.
+
+    Without WebP support the thumbnails are jpgs too, these are left alone.
+    '''
+    return [infile for infile in glob.glob(os.path.join(IMAGE_DIR, '*.jpg'))
+            if not is_thumbnail(infile)]
+
+
 def process_all_jpgs():
     ''' Processes all local full-sized jpgs.
 
-    All local full-sized jpgs will be made into smaller png thumbnails and
+    All local full-sized jpgs will be made into smaller thumbnails and
     removed. This is a way to make sure that we do not have any full-sized
     photos taking up space on the server.
 
     Arguments:
         None
     Returns:
-        None
+        int: the number of processed jpgs.
     '''
     # All we have to do is make a list of the jpg files in the image directory
-    # and process them.
-    for infile in glob.glob("/data/images/*.jpg"):
-        jpg_to_png_thumbnail(500, infile)
-        # Remove the full sized jpg to save space.
-        os.remove(infile)
+    # and process them, spread over all CPUs.
+    infiles = full_sized_jpgs()
+    if not infiles:
+        return 0
+    pool = multiprocessing.Pool(THUMBNAIL_WORKERS)
+    try:
+        failed = wait_for_thumbnails(dict(
+            (pool.apply_async(process_image, (infile,)), infile)
+            for infile in infiles))
+    finally:
+        pool.close()
+        pool.join()
+    return len(infiles) - failed
 
 
 def process_all_png():
@@ -269,26 +627,27 @@ def process_all_png():
     '''
     # All we have to do is make a list of png files in the image directory
     # and process them.
-    for infile in glob.glob("/data/images/*.png"):
+    for infile in glob.glob(os.path.join(IMAGE_DIR, "*.png")):
         process_old_png(infile)
 
 
 def process_image(image_name):
-    ''' function to do some image manipulations
+    ''' function to do some image manipulations, returns the thumbnail
+    variants that were made.
     '''
     # We only want to keep smaller sized images to show on the website.
-    new_image = jpg_to_png_thumbnail(500, image_name)
-    # Move the new image to the correct directory.
-    shutil.move(new_image,
-                "/data/images/{0}".format(new_image))
+    # They go straight into the correct directory.
+    variants = make_thumbnails(image_name, IMAGE_DIR)
     # Remove the full sized jpg to save space
     os.remove(image_name)
+    return variants
 
 
 def process_old_png(image_name):
     ''' Function to reprocess old png files to remove the
     whitespace.
     '''
+    from PIL import Image
     image = Image.open(image_name)
     image.load()
     imagesize = image.size
@@ -304,75 +663,291 @@ def process_old_png(image_name):
     return 0
 
 
-def get_pictures():
-    ''' Gets the latest images from the Google Drive.
+def build_service():
+    ''' Returns a new GD API service handler.
 
-    Inspired by the Google Drive example code:
-    (https://developers.google.com/drive/v3/web/quickstart/python).
     Arguments:
         None
     Returns:
-        None
+        the GD API service handler.
     '''
+    import httplib2
+    from apiclient import discovery
     credentials = get_credentials()
     http = credentials.authorize(httplib2.Http())
-    service = discovery.build('drive', 'v3', http=http)
-    # Grab the current list of images
-    local_images = get_images_list()
-    # Make a set of the image names that were already processed.
-    local_image_names_set = set([image_info[1] for image_info in local_images])
-    for item in list_files(service):
-        # Only process jpg files. If there are multiple directories, you can
-        # check the file parents to make sure you are looking in the right
-        # directory. Not needed in my case.
-        if item['name'].endswith('.jpg'):
-            # Is this an image we need to download?
-            if item['name'] in local_image_names_set:
-                continue  # No, skip it.
-            # New picture! Time to download and process.
-            print('{0} --> {1} ({2})'.format(datetime.now(),
-                                             item['name'],
-                                             item['id']))
-            request = service.files().get_media(fileId=item['id'])
-            filehandle = io.FileIO(item['name'], 'wb')
-            downloader = MediaIoBaseDownload(filehandle, request)
-            done = False
-            while done is False:
-                _, done = downloader.next_chunk()
-            # We have a new image, save the information to the CSV file.
-            image_info = get_image_gps_info(item['name'])
-            # Add the coordinates to our local coordinates file.
-            with open(r'/data/images.csv', 'a') as outf:
-                writer = csv.writer(outf)
-                writer.writerow(image_info)
+    return discovery.build('drive', 'v3', http=http)
+
+
+def get_thread_service(service_factory):
+    ''' Returns the service handler of the current thread.
+
+    Arguments:
+        function: called without arguments to create the service handler the
+                  first time the current thread needs one.
+    Returns:
+        the GD API service handler.
+    '''
+    services = getattr(THREAD_DATA, 'services', None)
+    if services is None:
+        services = THREAD_DATA.services = {}
+    if service_factory not in services:
+        services[service_factory] = service_factory()
+    return services[service_factory]
+
+
+def is_transient_error(error):
+    ''' Returns True if a download that failed with this error is worth
+    retrying: server errors, timeouts and network errors, but no local
+    errors like a full disk. socket.error is OSError on Python 3.
+    '''
+    import httplib2
+    from apiclient.errors import HttpError
+    if isinstance(error, HttpError):
+        return error.resp.status in TRANSIENT_STATUSES
+    if isinstance(error, (socket.timeout, socket.gaierror, ssl.SSLError,
+                          httplib2.HttpLib2Error)):
+        return True
+    return isinstance(error, socket.error) and \
+        error.errno in NETWORK_ERRNOS
+
+
+def download_range(request, filehandle, offset, length):
+    ''' Downloads a range of a GD file, and appends it to the file.
+
+    The range is asked for with a Range header, the way MediaIoBaseDownload
+    does. A server that ignores it sends the whole file, which then
+    replaces what was downloaded before.
+
+    Arguments:
+        HttpRequest: the media request, see files().get_media().
+        file: the file to append to, opened for appending.
+        int: the offset of the range, the bytes downloaded before.
+        int: the length of the range.
+    Returns:
+        bool: True if the download is complete.
+    '''
+    from apiclient.errors import HttpError
+    headers = dict(request.headers)
+    headers['range'] = 'bytes={0}-{1}'.format(offset, offset + length - 1)
+    response, content = request.http.request(request.uri, 'GET',
+                                             headers=headers)
+    if response.status not in (200, 206):
+        raise HttpError(response, content, uri=request.uri)
+    DOWNLOAD_BYTES.inc(len(content))
+    if response.status == 200:
+        filehandle.seek(0)
+        filehandle.truncate()
+        filehandle.write(content)
+        return True
+    filehandle.write(content)
+    total = response.get('content-range', '').rpartition('/')[2]
+    if total.isdigit():
+        return offset + len(content) >= int(total)
+    return len(content) < length
+
+
+def download_file(service, item, header_check=None):
+    ''' Downloads a GD file to the current directory.
+
+    The data is first written to a .part file. If that file is still around
+    from an earlier attempt, the download resumes after its last chunk
+    instead of starting over.
+
+    Arguments:
+        service: the GD API service handler.
+        dict: the GD file item, with at least the 'id' and 'name'.
+        function: called with the name of the .part file before every chunk,
+                  until it returns True (download the rest) or False (stop).
+                  None means it needs more of the file. The first chunk is
+                  then only exif.EXIF_READ_BYTES long.
+    Returns:
+        string: name of the downloaded file, None if the download stopped.
+    '''
+    partial_name = item['name'] + '.part'
+    request = service.files().get_media(fileId=item['id'])
+    chunksize = DOWNLOAD_CHUNKSIZE
+    with io.FileIO(partial_name, 'ab') as filehandle:
+        offset = filehandle.seek(0, io.SEEK_END)
+        if header_check is not None and offset < exif.EXIF_READ_BYTES:
+            chunksize = exif.EXIF_READ_BYTES
+        done = False
+        while not done:
+            if header_check is not None:
+                decision = header_check(partial_name)
+                if decision is False:
+                    return None
+                elif decision is True:
+                    header_check = None
+                    chunksize = DOWNLOAD_CHUNKSIZE
+            done = download_range(request, filehandle, offset, chunksize)
+            offset = filehandle.tell()
+    os.rename(partial_name, item['name'])
+    return item['name']
+
+
+def check_gps(partial_name):
+    ''' Tells download_file whether to download the rest of a picture: only
+    if it has GPS information, or if DOWNLOAD_WITHOUT_GPS is set. Returns
+    None while the EXIF is not complete yet.
+    '''
+    try:
+        return bool(exif.read_gps_file(partial_name)) or DOWNLOAD_WITHOUT_GPS
+    except exif.TruncatedError:
+        return None
+
+
+def fetch_picture(service_factory, item):
+    ''' Downloads a new picture and extracts its GPS information.
+
+    Transient errors are retried with exponential backoff. This runs in the
+    download threads, so it must not store the image information. Pictures
+    without GPS information can not be shown on the map, so only their EXIF
+    is downloaded, unless DOWNLOAD_WITHOUT_GPS is set.
+
+    Arguments:
+        function: creates a GD API service handler.
+        dict: the GD file item, with at least the 'id' and 'name'.
+    Returns:
+        tuple: the image information, see get_image_gps_info.
+    '''
+    import httplib2
+    from apiclient.errors import HttpError
+    print('{0} --> {1} ({2})'.format(datetime.now(), item['name'], item['id']))
+    attempt = 0
+    started = time.time()
+    while True:
+        try:
+            filename = download_file(get_thread_service(service_factory),
+                                     item, check_gps)
+            break
+        except (HttpError, socket.error, httplib2.HttpLib2Error) as error:
+            if isinstance(error, HttpError) and error.resp.status == 416:
+                # The requested range is not satisfiable: the partial file
+                # does not match the GD file. Start over.
+                os.remove(item['name'] + '.part')
+            elif not is_transient_error(error):
+                raise
+            if attempt >= DOWNLOAD_RETRIES:
+                raise
+            delay = DOWNLOAD_BACKOFF * 2 ** attempt
+            attempt += 1
+            print('{0} !! {1}: {2}, retry in {3:.1f}s'.format(
+                datetime.now(), item['name'], error, delay))
+            time.sleep(delay * random.uniform(0.5, 1.5))
+    DOWNLOAD_SECONDS.observe(time.time() - started)
+    if filename is None:
+        # No GPS information: recorded, but not downloaded any further.
+        os.remove(item['name'] + '.part')
+        return get_image_gps_info(item['name'], {})
+    return get_image_gps_info(item['name'])
+
+
+def get_pictures(service_factory=build_service, workers=None):
+    ''' Gets the latest images from the Google Drive.
+
+    Inspired by the Google Drive example code:
+    (https://developers.google.com/drive/v3/web/quickstart/python).
+    The new pictures are downloaded by a pool of threads. Only the calling
+    thread stores the image information, so rows are never interleaved.
+    Arguments:
+        function: creates a GD API service handler, build_service by default.
+        int: number of concurrent downloads, DOWNLOAD_WORKERS by default.
+    Returns:
+        int: the number of new images that were stored.
+    '''
+    new_items = find_new_files(get_thread_service(service_factory))
+    if not new_items:
+        return 0
+    started = time.time()
+    stored = 0
+    executor = ThreadPoolExecutor(max_workers=workers or DOWNLOAD_WORKERS)
+    futures = dict((executor.submit(fetch_picture, service_factory, item),
+                    item) for item in new_items)
+    # The thumbnails are made in other processes while downloads continue.
+    # The pool is only started for the first photo that needs them.
+    thumbnail_pool = None
+    thumbnails = {}
+    try:
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                image_info = future.result()
+            except Exception as error:  # pylint: disable=broad-except
+                # Leave it for the next check, a partial download resumes.
+                print('{0} !! {1} ({2}) failed: {3}'.format(
+                    datetime.now(), item['name'], item['id'], error))
+                DOWNLOADS.inc(result='failed')
+                continue
+            # Add the coordinates to our local database.
+            storage.add_images([image_info], file_ids=[item['id']])
+            stored += 1
+            if not os.path.exists(item['name']):
+                DOWNLOADS.inc(result='exif_only')
+                continue  # Only the EXIF was downloaded, see fetch_picture.
+            DOWNLOADS.inc(result='photo')
             # Process the image.
-            process_image(item['name'])
+            if thumbnail_pool is None:
+                thumbnail_pool = multiprocessing.Pool(THUMBNAIL_WORKERS)
+            thumbnails[thumbnail_pool.apply_async(
+                process_image, (item['name'],))] = item['name']
+        wait_for_thumbnails(thumbnails)
+    finally:
+        executor.shutdown()
+        if thumbnail_pool is not None:
+            thumbnail_pool.close()
+            thumbnail_pool.join()
+    if stored:
+        DOWNLOAD_RATE.set(stored / (time.time() - started))
+        update_photo_index()
+    return stored
 
 
-def get_cluster_center(cluster):
-    ''' Finds center of cluster.
+def update_photo_index():
+    ''' Appends the photos that were stored since the last update to the
+    photo index, see photoindex.py.
 
     Arguments:
-        np.array: the coordinates in degrees of the cluster
+        None
     Returns:
-        tuple: the coordinates (lat, lon) of the cluster center.
-    '''
-    x_coord = 0.0
-    y_coord = 0.0
-    z_coord = 0.0
-    for lat, lon in cluster:
-        lat = float(lat * math.pi/180.0)  # convert to radians
-        lon = float(lon * math.pi/180.0)  # convert to radians
-        x_coord += math.cos(lat) * math.cos(lon)
-        y_coord += math.cos(lat) * math.sin(lon)
-        z_coord += math.sin(lat)
-    x_coord = float(x_coord / len(cluster))
-    y_coord = float(y_coord / len(cluster))
-    z_coord = float(z_coord / len(cluster))
-    center_lat = math.atan2(z_coord,
-                            math.sqrt(x_coord * x_coord + y_coord * y_coord))
-    center_lon = math.atan2(y_coord, x_coord)
-    return (center_lat * 180.0/math.pi, center_lon * 180.0/math.pi)
+        dict: the meta information of the index, see photoindex.read_meta.
+    '''
+    import photoindex
+    with PHOTO_INDEX_LOCK:
+        return photoindex.update(PHOTO_INDEX_DIR)
+
+
+def update_cluster_index(epsilon, coords, index):
+    ''' Returns the cluster index for all photos.
+
+    The index of the last run is extended with the photos that were added
+    to the database since. If there is no usable index, or the photos that
+    are in it changed, DBSCAN runs on all photos instead.
+
+    Arguments:
+        float: the cluster radius in radians.
+        np.array: the coordinates in radians of all photos.
+        ClusterIndex: the index of the last run, see ClusterIndex.load, or
+                      None.
+    Returns:
+        ClusterIndex: the index holding the clusters of all photos.
+    '''
+    import numpy as np
+    from clusterindex import ClusterIndex
+    if index is not None and len(index) <= len(coords) and \
+            np.array_equal(coords[:len(index)], index.coords):
+        with DBSCAN_SECONDS.time(mode='incremental'):
+            index.add(coords[len(index):])
+        return index
+    # Set up the DBSCAN algorithm from scikit-learn. See
+    # http://scikit-learn.org/
+    # Set the mon_samples to 1: this is the minimum number of samples per
+    # cluster. In our case, one photo can be a cluster and should be displayed.
+    from sklearn.cluster import DBSCAN
+    with DBSCAN_SECONDS.time(mode='full'):
+        my_dbscan = DBSCAN(eps=epsilon, min_samples=1,
+                           algorithm='ball_tree',
+                           metric='haversine').fit(coords)
+    return ClusterIndex.from_labels(epsilon, coords, my_dbscan.labels_)
 
 
 def clustering(cluster_radius):
@@ -381,71 +956,127 @@ def clustering(cluster_radius):
     This will allow the bunching photos that have been taken close together.
     Inspired by the following blog post:
     http://geoffboeing.com/2014/08/clustering-to-reduce-spatial-data-set-size/
+    The coordinates come from the photo index, only the names and times of
+    the photos are read from the database.
     Arguments:
         float: cluster radius in meters.
     Returns:
         None
     '''
-    # Get the coordinates from the CSV file
-    my_df = pd.read_csv('/data/images.csv', header=None)
-    coords = my_df.as_matrix(columns=[2, 3])
-    image_info = my_df.as_matrix(columns=[1, 2, 3, 4, 5])
-    # Set up the DBSCAN algorithm from scikit-learn. See
-    # http://scikit-learn.org/
-    epsilon = cluster_radius / 6371008.8  # Denominator is m per Earth radian
-    # Set the mon_samples to 1: this is the minimum number of samples per
-    # cluster. In our case, one photo can be a cluster and should be displayed.
-    my_dbscan = DBSCAN(eps=epsilon, min_samples=1,
-                       algorithm='ball_tree',
-                       metric='haversine').fit(np.radians(coords))
+    epsilon = cluster_radius / EARTH_RADIUS
+    if storage.get_setting(CLUSTERS_SIGNATURE_SETTING) == '{0} {1}'.format(
+            cluster_radius, storage.get_version('images')) and \
+            os.path.exists(CLUSTERS_JSON) and \
+            os.path.exists(CLUSTER_INDEX_FILE):
+        return  # No new photos since the last run.
+    import numpy as np
+    import photoindex
+    from clusterindex import (ClusterIndex, get_cluster_centers,
+                              first_occurrences, group_by_cluster)
+    meta = update_photo_index()
+    if not meta['count']:
+        return
+    signature = str((meta['generation'], meta['last_id']))
+    columns = photoindex.read_columns(PHOTO_INDEX_DIR, meta)
+    coords = np.column_stack((columns['lat'], columns['lon']))
+    # Get the names and times from the database
+    rows = get_images_list(meta['count'])
+    if len(rows) != meta['count']:
+        raise RuntimeError('the images were rewritten while clustering')
+    image_info = np.array([row[1:6] for row in rows], dtype=object)
+    cluster_index = update_cluster_index(
+        epsilon, np.radians(coords),
+        ClusterIndex.load(CLUSTER_INDEX_FILE, epsilon))
     # Each photo is now labeled with a cluster-number.
-    cluster_labels = my_dbscan.labels_
-    num_clusters = len(set(cluster_labels))
-    clusters = pd.Series([coords[cluster_labels == n]
-                          for n in range(num_clusters)])
+    cluster_labels = cluster_index.labels()
     # Find the center of each cluster. This is where marker for the
     # photo cluster should be.
-    images = pd.Series([image_info[cluster_labels == n]
-                        for n in range(num_clusters)])
-    # Time to deal with duplicate images. Duplicate images can occur from
-    # testing and not cleaning up afterwards! Just brute-force for now.
-    images_list = []
-    for index, item in enumerate(images):
-        local_image_list = []
-        images_list.append([])
-        for _, sub_item in enumerate(item):
-            if sub_item[0] in local_image_list:
-                continue
-            images_list[index].append(sub_item.tolist())
-            local_image_list.append(sub_item[0])
-    with open(r'/data/image_clusters.csv', 'w') as outf:
-        for index, cluster in enumerate(clusters):
-            if index == 0:
-                continue  # These are all the images without coordinates
-            # index will also be the cluster number.
-            center = get_cluster_center(cluster)
-            cluster_info = index, list(center), images_list[index]
-            writer = csv.writer(outf)
+    centers = get_cluster_centers(coords, cluster_labels).tolist()
+    # Time to deal with duplicate images, only the first one with a name is
+    # kept in each cluster.
+    unique = first_occurrences(cluster_labels, image_info[:, 0])
+    cluster_infos = []
+    for index, members in enumerate(group_by_cluster(cluster_labels)):
+        if index == 0:
+            continue  # These are all the images without coordinates
+        # index will also be the cluster number.
+        cluster_infos.append((index, centers[index],
+                              image_info[members[unique[members]]].tolist()))
+    with open(CLUSTERS_CSV, 'w') as outf:
+        writer = csv.writer(outf)
+        for cluster_info in cluster_infos:
             writer.writerow(cluster_info)
+    write_clusters_json(cluster_infos, CLUSTERS_JSON)
+    CLUSTERS.set(len(cluster_infos))
+    CLUSTERED_PHOTOS.set(meta['count'])
+    # Tell the app the clusters changed, see /api/updates.
+    storage.bump_counter('clusters_version')
+    cluster_index.signature = signature
+    cluster_index.save(CLUSTER_INDEX_FILE)
+    storage.set_setting(CLUSTERS_SIGNATURE_SETTING,
+                        '{0} {1}'.format(cluster_radius, signature))
+
+
+def write_clusters_json(cluster_infos, filename):
+    ''' Writes the clusters as JSON lines, one cluster per line.
+
+    This is much faster to load than the stringified lists in the CSV file.
+    The file is written next to its final location and then renamed, so
+    readers never see a half-written file.
+
+    Arguments:
+        list: (cluster number, center, images) for each cluster.
+        string: name of the JSON lines file.
+    Returns:
+        None
+    '''
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as outf:
+        for cluster_info in cluster_infos:
+            # NumPy scalars are not JSON serializable, convert them first.
+            outf.write(json.dumps(cluster_info,
+                                  default=lambda value: value.item()))
+            outf.write('\n')
+    os.rename(temp_filename, filename)
+
+
+def get_service_factory():
+    ''' Returns the function creating the GD API service handlers: a fake
+    Google Drive of the jpgs in the folder FAKE_DRIVE points at, if set, see
+    fakedrive.py.
+    '''
+    if os.environ.get('FAKE_DRIVE'):
+        import fakedrive
+        return fakedrive.FakeDrive(os.environ['FAKE_DRIVE'])
+    return build_service
 
 
 def main():
-    ''' Check for new pictures on the Google Drive every hour and extract the
-    clustering.
+    ''' Run the stages of the service, see scheduler.py: check the Google
+    Drive for new pictures every DOWNLOAD_INTERVAL seconds, process the
+    full-sized jpgs copied into the image directory as soon as they appear,
+    and re-run the clustering once the downloads of new photos settled.
     '''
-    while True:
-        # First, check if there are any full-sized jpgs in the image directory.
-        # If so, make the png thumbnails and remove the full-sized images.
-        process_all_jpgs()
-        # Reprocess the old pngs, uncomment if needed
-        # process_all_png()
-        # Check the Google Drive for available pictures.
-        # If so, download, grab GPS info and make the thumbnail.
-        get_pictures()
-        # Re-run the clustering for the photos
-        clustering(100.0)  # The argument is the cluster radius.
-        # Wait one hour to check again.
-        sleep(3600)
+    storage.import_csv()
+    service_factory = get_service_factory()
+    stages = scheduler.Scheduler(STATUS_FILE, metrics_file=METRICS_FILE)
+    # Re-run the clustering for the photos. The argument is the cluster
+    # radius.
+    clusters = stages.add('clustering', lambda: clustering(100.0),
+                          CLUSTERING_INTERVAL, debounce=CLUSTERING_DEBOUNCE)
+    # Check the Google Drive for available pictures.
+    # If so, download, grab GPS info and make the thumbnail.
+    stages.add('download', lambda: get_pictures(service_factory),
+               DOWNLOAD_INTERVAL, downstream=[clusters],
+               backlog=lambda: len(storage.get_drive_files(pending_only=True)))
+    # Make the thumbnails of the full-sized jpgs in the image directory and
+    # remove the full-sized images.
+    thumbnails = stages.add('thumbnails', process_all_jpgs, THUMBNAIL_INTERVAL,
+                            backlog=lambda: len(full_sized_jpgs()))
+    # Reprocess the old pngs, uncomment if needed
+    # process_all_png()
+    stages.run([(scheduler.DirectoryWatcher(IMAGE_DIR, '*.jpg'),
+                 thumbnails)])
 
 
 if __name__ == '__main__':
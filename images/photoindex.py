@@ -0,0 +1,191 @@
+'''
+Utilities for:
+    - keeping the numbers of every photo in the database (id, latitude,
+      longitude, altitude and time) as columns, one .npy file per column
+    - memory-mapping those columns, so the clustering gets them as arrays
+      without reading and converting all image rows
+    - appending the photos that were added to the database since the last
+      update
+
+The files have room for more photos than they hold, their capacity doubles
+when they are full. meta.json holds the number of photos in them and the
+version of the images table they are up to date with. It is replaced after
+the columns are written, so readers never see photos that are not complete.
+'''
+
+import os
+import json
+import calendar
+import numpy as np
+import storage
+
+# The columns, with their NumPy types. A time is in seconds since the epoch,
+# NaN when the photo has none.
+COLUMNS = (('id', np.int64), ('lat', np.float64), ('lon', np.float64),
+           ('alt', np.float64), ('time', np.float64))
+# Number of photos the files have room for at first.
+INITIAL_CAPACITY = 1024
+META_FILE = 'meta.json'
+# The format of the times of the image rows.
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def to_number(value):
+    ''' Returns the value of a numeric column of an image row as a float,
+    NaN if it has none.
+    '''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def to_seconds(value):
+    ''' Returns the time of an image row in seconds since the epoch, NaN if
+    it has none. The fields are read at their place in TIME_FORMAT, which is
+    many times faster than datetime.strptime.
+    '''
+    text = str(value)
+    if len(text) != 19:
+        return float('nan')
+    try:
+        return float(calendar.timegm(
+            (int(text[0:4]), int(text[5:7]), int(text[8:10]),
+             int(text[11:13]), int(text[14:16]), int(text[17:19]))))
+    except ValueError:
+        return float('nan')
+
+
+def column_filename(directory, column):
+    ''' Returns the name of the .npy file of a column. '''
+    return os.path.join(directory, column + '.npy')
+
+
+def read_meta(directory):
+    ''' Returns the meta information of the index, that of an empty index if
+    there is none.
+
+    Arguments:
+        string: the directory of the index.
+    Returns:
+        dict: count (photos in the index), capacity (photos the files have
+              room for), and the generation and last_id of the images table
+              the index is up to date with, see storage.get_version.
+    '''
+    empty = {'count': 0, 'capacity': 0, 'generation': None, 'last_id': 0}
+    if not all(os.path.exists(column_filename(directory, column))
+               for column, _ in COLUMNS):
+        return empty
+    try:
+        with open(os.path.join(directory, META_FILE), 'r') as infile:
+            return json.load(infile)
+    except (EnvironmentError, ValueError):
+        return empty
+
+
+def write_meta(directory, meta):
+    ''' Replaces the meta information of the index atomically. '''
+    temp_filename = os.path.join(directory, META_FILE + '.tmp')
+    with open(temp_filename, 'w') as outf:
+        json.dump(meta, outf)
+    os.rename(temp_filename, os.path.join(directory, META_FILE))
+
+
+def grow(directory, meta, capacity):
+    ''' Replaces the column files by larger ones, keeping the photos that
+    are in them.
+
+    Arguments:
+        string: the directory of the index.
+        dict: the meta information, its capacity is updated.
+        int: the number of photos the new files have room for.
+    Returns:
+        None
+    '''
+    for column, dtype in COLUMNS:
+        filename = column_filename(directory, column)
+        temp_filename = filename + '.tmp'
+        grown = np.lib.format.open_memmap(temp_filename, mode='w+',
+                                          dtype=dtype, shape=(capacity,))
+        if meta['count']:
+            grown[:meta['count']] = np.load(
+                filename, mmap_mode='r')[:meta['count']]
+        grown.flush()
+        del grown
+        os.rename(temp_filename, filename)
+    meta['capacity'] = capacity
+
+
+def append(directory, meta, rows):
+    ''' Writes image rows after the photos in the index.
+
+    Arguments:
+        string: the directory of the index.
+        dict: the meta information, its count and last_id are updated. It
+              is not written.
+        list: (id, row) of the images, see storage.get_rows.
+    Returns:
+        None
+    '''
+    start = meta['count']
+    end = start + len(rows)
+    if end > meta['capacity']:
+        grow(directory, meta, max(end, 2 * meta['capacity'],
+                                  INITIAL_CAPACITY))
+    values = {'id': [row_id for row_id, _ in rows],
+              'lat': [to_number(row[2]) for _, row in rows],
+              'lon': [to_number(row[3]) for _, row in rows],
+              'alt': [to_number(row[4]) for _, row in rows],
+              'time': [to_seconds(row[5]) for _, row in rows]}
+    for column, _ in COLUMNS:
+        array = np.load(column_filename(directory, column), mmap_mode='r+')
+        array[start:end] = values[column]
+        array.flush()
+        del array
+    meta['count'] = end
+    meta['last_id'] = rows[-1][0]
+
+
+def update(directory):
+    ''' Brings the index up to date with the images table: the photos that
+    were added since the last update are appended, and if the rows were
+    rewritten the index starts over. Only one thread or process may update
+    an index at a time.
+
+    Arguments:
+        string: the directory of the index.
+    Returns:
+        dict: the meta information of the index, see read_meta.
+    '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    meta = read_meta(directory)
+    generation, last_id = storage.get_version('images')
+    if generation != meta['generation'] or last_id < meta['last_id']:
+        meta.update(count=0, generation=generation, last_id=0)
+    rows = storage.get_rows('images', meta['last_id']) \
+        if last_id > meta['last_id'] else []
+    if rows:
+        append(directory, meta, rows)
+    write_meta(directory, meta)
+    return meta
+
+
+def read_columns(directory, meta=None):
+    ''' Returns the columns of the photos in the index.
+
+    Arguments:
+        string: the directory of the index.
+        dict: the meta information of the index, read from the directory
+              if not given.
+    Returns:
+        dict: a read-only, memory-mapped array for every column.
+    '''
+    if meta is None:
+        meta = read_meta(directory)
+    if not meta['count']:
+        return dict((column, np.empty(0, dtype=dtype))
+                    for column, dtype in COLUMNS)
+    return dict((column, np.load(column_filename(directory, column),
+                                 mmap_mode='r')[:meta['count']])
+                for column, _ in COLUMNS)
@@ -0,0 +1,314 @@
+'''
+Utilities for:
+    - running the stages of the images service independently, each on its
+      own interval, with backoff after failures
+    - triggering a stage from a file system event or from the completion of
+      another stage, debounced so it only runs once things settled
+    - reporting the state of every stage in a status file, and their
+      metrics in a metrics file
+'''
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import glob
+import errno
+import select
+import struct
+import fnmatch
+import threading
+import traceback
+from datetime import datetime
+import metrics
+
+# inotify constants, see inotify(7).
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_EVENT = struct.Struct('iIII')
+# Seconds between two directory listings when inotify is not available.
+POLL_INTERVAL = 10.0
+
+STAGE_SECONDS = metrics.histogram('images_stage_seconds',
+                                  'Seconds a run of a stage took.',
+                                  ['stage'])
+STAGE_RUNS = metrics.counter('images_stage_runs_total',
+                             'Runs of a stage, by result.',
+                             ['stage', 'result'])
+STAGE_BACKLOG = metrics.gauge('images_stage_backlog',
+                              'Amount of work waiting for a stage.',
+                              ['stage'])
+
+
+class Stage(object):
+    ''' A stage of the images service, run by a thread of its own.
+
+    The stage runs every interval seconds, and as soon as possible after
+    trigger() was called, but not before debounce seconds passed without
+    another trigger. After a failure it runs again after backoff seconds,
+    doubling with every failure up to the interval.
+    '''
+
+    def __init__(self, name, function, interval, backoff=60.0, debounce=0.0,
+                 backlog=None, downstream=()):
+        ''' Arguments:
+            name       -- name of the stage in the status file.
+            function   -- runs the stage. Its result is truthy if it did
+                          something, which triggers the downstream stages.
+            interval   -- seconds between two runs without triggers.
+            backoff    -- seconds before the first retry after a failure.
+            debounce   -- seconds without triggers before a triggered run.
+            backlog    -- function returning the amount of work waiting,
+                          for the status file.
+            downstream -- the stages to trigger after this one did
+                          something.
+        '''
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.backoff = backoff
+        self.debounce = debounce
+        self.backlog = backlog
+        self.downstream = list(downstream)
+        self.condition = threading.Condition()
+        self.triggered = None
+        self.next_run = time.time()
+        self.running = False
+        self.state = {'runs': 0, 'failures': 0, 'consecutive_failures': 0,
+                      'triggers': 0, 'last_start': None,
+                      'last_duration': None, 'last_result': None,
+                      'last_error': None}
+
+    def trigger(self):
+        ''' Ask for a run, see the class documentation. '''
+        with self.condition:
+            self.triggered = time.time()
+            self.state['triggers'] += 1
+            self.condition.notify()
+
+    def wait(self):
+        ''' Wait until it is time to run. '''
+        with self.condition:
+            while True:
+                now = time.time()
+                due = self.next_run
+                if self.triggered is not None:
+                    due = min(due, self.triggered + self.debounce)
+                if now >= due:
+                    self.triggered = None
+                    return
+                self.condition.wait(due - now)
+
+    def run_once(self):
+        ''' Run the stage now, and plan the next run. Returns the result of
+        the function, None if it failed.
+        '''
+        started = time.time()
+        with self.condition:
+            self.running = True
+            self.state['last_start'] = started
+        result = None
+        try:
+            result = self.function()
+            error = None
+        except Exception as exception:  # pylint: disable=broad-except
+            error = '{0}: {1}'.format(type(exception).__name__, exception)
+            print('{0} !! stage {1} failed: {2}'.format(datetime.now(),
+                                                        self.name, error))
+            traceback.print_exc()
+        finished = time.time()
+        STAGE_SECONDS.observe(finished - started, stage=self.name)
+        STAGE_RUNS.inc(stage=self.name,
+                       result='success' if error is None else 'failure')
+        with self.condition:
+            self.running = False
+            self.state['runs'] += 1
+            self.state['last_duration'] = finished - started
+            self.state['last_error'] = error
+            if error is None:
+                self.state['consecutive_failures'] = 0
+                self.state['last_result'] = result
+                self.next_run = finished + self.interval
+            else:
+                self.state['failures'] += 1
+                self.state['consecutive_failures'] += 1
+                self.next_run = finished + min(
+                    self.interval, self.backoff *
+                    2 ** (self.state['consecutive_failures'] - 1))
+        if result:
+            for stage in self.downstream:
+                stage.trigger()
+        return result
+
+    def run_forever(self, on_done=None):
+        ''' Run the stage whenever it is time, forever.
+        Arguments:
+            on_done -- called with the stage after every run.
+        '''
+        while True:
+            self.wait()
+            self.run_once()
+            if on_done is not None:
+                on_done(self)
+
+    def status(self):
+        ''' Return the state of the stage as a dict. '''
+        with self.condition:
+            status = dict(self.state)
+            status['running'] = self.running
+            status['next_run'] = self.next_run
+            status['triggered'] = self.triggered
+        if self.backlog is not None:
+            try:
+                status['backlog'] = self.backlog()
+                STAGE_BACKLOG.set(status['backlog'], stage=self.name)
+            except Exception as exception:  # pylint: disable=broad-except
+                status['backlog'] = None
+                status['backlog_error'] = str(exception)
+        return status
+
+
+class DirectoryWatcher(object):
+    ''' Reports the files that were written to, or moved into, a directory.
+
+    Uses inotify where the C library has it, and compares directory
+    listings every POLL_INTERVAL seconds otherwise.
+    '''
+
+    def __init__(self, directory, pattern='*'):
+        ''' Arguments:
+            directory -- the directory to watch.
+            pattern   -- only report file names matching this pattern.
+        '''
+        self.directory = directory
+        self.pattern = pattern
+        self.inotify = None
+        self.known = None
+        try:
+            self.inotify = self.start_inotify()
+        except (OSError, AttributeError) as error:
+            print('{0} inotify not available ({1}), polling {2}'.format(
+                datetime.now(), error, directory))
+            self.known = self.listing()
+
+    def start_inotify(self):
+        ''' Return the inotify file descriptor watching the directory. '''
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        descriptor = libc.inotify_init()
+        if descriptor < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        path = self.directory.encode(sys.getfilesystemencoding())
+        if libc.inotify_add_watch(descriptor, path,
+                                  IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(descriptor)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+        return descriptor
+
+    def listing(self):
+        ''' Return the set of matching files in the directory. '''
+        return set(os.path.basename(name) for name in
+                   glob.glob(os.path.join(self.directory, self.pattern)))
+
+    def wait(self, timeout):
+        ''' Wait up to timeout seconds for files, and return their names
+        (possibly none).
+        '''
+        if self.inotify is None:
+            time.sleep(min(timeout, POLL_INTERVAL))
+            listing = self.listing()
+            new_names = listing - self.known
+            self.known = listing
+            return sorted(new_names)
+        try:
+            readable = select.select([self.inotify], [], [], timeout)[0]
+        except select.error as error:
+            if error.args[0] == errno.EINTR:
+                return []
+            raise
+        if not readable:
+            return []
+        data = os.read(self.inotify, 64 * 1024)
+        names = []
+        offset = 0
+        while offset + IN_EVENT.size <= len(data):
+            _, _, _, length = IN_EVENT.unpack_from(data, offset)
+            offset += IN_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\x00')
+            offset += length
+            name = name.decode(sys.getfilesystemencoding())
+            if fnmatch.fnmatch(name, self.pattern):
+                names.append(name)
+        return names
+
+
+class Scheduler(object):
+    ''' Runs the stages, each in a thread of its own, and keeps the status
+    and metrics files up to date.
+    '''
+
+    def __init__(self, status_file, status_interval=30.0, metrics_file=None):
+        ''' Arguments:
+            status_file     -- the JSON file to write the status to.
+            status_interval -- seconds between two status updates when
+                               nothing happens.
+            metrics_file    -- the file to write the metrics of the process
+                               to in the Prometheus text format, if any.
+        '''
+        self.status_file = status_file
+        self.metrics_file = metrics_file
+        self.status_interval = status_interval
+        self.stages = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def add(self, name, function, interval, **options):
+        ''' Add a stage, see Stage for the arguments, and return it. '''
+        stage = Stage(name, function, interval, **options)
+        self.stages.append(stage)
+        return stage
+
+    def write_status(self, _=None):
+        ''' Write the status of all stages to the status file, and the
+        metrics to the metrics file.
+        '''
+        status = {'updated': time.time(), 'started': self.started,
+                  'pid': os.getpid(),
+                  'stages': dict((stage.name, stage.status())
+                                 for stage in self.stages)}
+        with self.lock:
+            temp_filename = self.status_file + '.tmp'
+            with open(temp_filename, 'w') as outf:
+                json.dump(status, outf, sort_keys=True, indent=1,
+                          default=str)
+            os.rename(temp_filename, self.status_file)
+            if self.metrics_file is not None:
+                metrics.write_textfile(self.metrics_file)
+
+    def run(self, watches=()):
+        ''' Start all stages and run forever, triggering stages on file
+        system events.
+        Arguments:
+            watches -- (DirectoryWatcher, stage) pairs: the stage is
+                       triggered whenever the watcher reports files.
+        '''
+        for stage in self.stages:
+            thread = threading.Thread(target=stage.run_forever,
+                                      args=(self.write_status,),
+                                      name=stage.name)
+            thread.daemon = True
+            thread.start()
+        watches = list(watches)
+        while True:
+            if not watches:
+                time.sleep(self.status_interval)
+            deadline = time.time() + self.status_interval
+            for watcher, stage in watches:
+                # Share the status interval between the watchers.
+                remaining = max(0.0, deadline - time.time())
+                if watcher.wait(remaining / len(watches)):
+                    stage.trigger()
+            self.write_status()
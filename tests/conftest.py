@@ -0,0 +1,29 @@
+'''
+Configures the modules of both services for the tests: they are imported
+from app/, images/ and common/ like the services import them, and their
+data directory is a temporary one. Every test gets a database of its own.
+'''
+
+import os
+import sys
+import tempfile
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Read by the modules when they are imported.
+os.environ['DATA_DIR'] = tempfile.mkdtemp(prefix='whereispatrick-test-')
+os.environ['CSV_EXPORT'] = '0'
+os.makedirs(os.path.join(os.environ['DATA_DIR'], 'images'))
+for name in ('common', 'images', 'app'):
+    sys.path.insert(0, os.path.join(REPO_DIR, name))
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    ''' Points the storage module at an empty database in the test's
+    temporary directory, and makes that the working directory.
+    '''
+    import storage
+    monkeypatch.setattr(storage, 'DATABASE', str(tmp_path / 'test.db'))
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,118 @@
+'''
+Tests of the incremental clustering: clusterindex.ClusterIndex must give
+the photos the same cluster numbers as DBSCAN on all photos at once.
+'''
+
+import math
+import numpy as np
+import pytest
+from sklearn.cluster import DBSCAN
+from clusterindex import ClusterIndex
+import images
+
+RADIUS = 100.0  # meters
+EPSILON = RADIUS / images.EARTH_RADIUS
+# The length of a degree of latitude, in meters.
+DEGREE = math.pi / 180.0 * images.EARTH_RADIUS
+
+
+def random_points(rand, count):
+    ''' Returns random coordinates in degrees, uniform on the sphere. '''
+    return np.column_stack((
+        np.degrees(np.arcsin(rand.uniform(-1.0, 1.0, count))),
+        rand.uniform(-180.0, 180.0, count)))
+
+
+def bursts(rand, centers, count):
+    ''' Returns count photos taken within a few cluster radii around each of
+    the centers (degrees), so some bursts are one cluster and some are not.
+    '''
+    points = []
+    for lat, lon in centers:
+        spread = 3.0 * RADIUS / DEGREE
+        lats = np.clip(lat + rand.uniform(-spread, spread, count),
+                       -90.0, 90.0)
+        lons = lon + rand.uniform(-spread, spread, count) / \
+            max(math.cos(math.radians(lat)), 1e-3)
+        points.append(np.column_stack((lats, (lons + 180.0) % 360.0 -
+                                       180.0)))
+    return np.vstack(points)
+
+
+def chain(start, bearing, count):
+    ''' Returns count photos along a great circle from start (degrees), each
+    0.9 cluster radii from the previous one, so they are all one cluster
+    that spans many grid cells.
+    '''
+    lat, lon = np.radians(start)
+    bearing = math.radians(bearing)
+    distances = np.arange(count) * 0.9 * EPSILON
+    lats = np.arcsin(np.sin(lat) * np.cos(distances) +
+                     np.cos(lat) * np.sin(distances) * np.cos(bearing))
+    lons = lon + np.arctan2(
+        np.sin(bearing) * np.sin(distances) * np.cos(lat),
+        np.cos(distances) - np.sin(lat) * np.sin(lats))
+    return np.column_stack((np.degrees(lats),
+                            (np.degrees(lons) + 180.0) % 360.0 - 180.0))
+
+
+def photos(seed):
+    ''' Returns the coordinates (degrees) of the photos of a test, in a
+    random order: random photos, bursts around the antimeridian and the
+    poles, and chains crossing the antimeridian and a pole.
+    '''
+    rand = np.random.RandomState(seed)
+    points = np.vstack((
+        random_points(rand, 300),
+        bursts(rand, [(0.0, 180.0), (45.0, -179.9999), (-30.0, 179.9999),
+                      (89.9995, 0.0), (-89.9995, 120.0)], 40),
+        bursts(rand, random_points(rand, 20), 15),
+        chain((10.0, 179.995), 90.0, 60),
+        chain((89.995, 30.0), 0.0, 60),
+        chain((-45.0, 20.0), 33.0, 80)))
+    return points[rand.permutation(len(points))]
+
+
+def dbscan_labels(coords):
+    ''' Returns the labels of a full DBSCAN run, as images.py runs it. '''
+    return DBSCAN(eps=EPSILON, min_samples=1, algorithm='ball_tree',
+                  metric='haversine').fit(coords).labels_
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_incremental_labels_match_dbscan(seed):
+    coords = np.radians(photos(seed))
+    expected = dbscan_labels(coords)
+    # Photos that are far apart at first and merged by later ones.
+    assert len(np.unique(expected)) < len(coords)
+    index = ClusterIndex(EPSILON)
+    rand = np.random.RandomState(seed)
+    start = 0
+    while start < len(coords):
+        end = start + rand.randint(1, 80)
+        index.add(coords[start:end])
+        start = end
+    assert np.array_equal(index.labels(), expected)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_adding_to_a_full_run_matches_dbscan(seed, tmp_path):
+    coords = np.radians(photos(seed))
+    part = len(coords) * 2 // 3
+    index = images.update_cluster_index(EPSILON, coords[:part], None)
+    assert np.array_equal(index.labels(), dbscan_labels(coords[:part]))
+    # The way clustering() runs next time: from the saved index.
+    filename = str(tmp_path / 'index.npz')
+    index.save(filename)
+    index = images.update_cluster_index(
+        EPSILON, coords, ClusterIndex.load(filename, EPSILON))
+    assert np.array_equal(index.labels(), dbscan_labels(coords))
+
+
+def test_changed_photos_run_dbscan_again():
+    coords = np.radians(photos(0))
+    index = images.update_cluster_index(EPSILON, coords[:100], None)
+    moved = coords.copy()
+    moved[0] += 0.01
+    index = images.update_cluster_index(EPSILON, moved, index)
+    assert np.array_equal(index.labels(), dbscan_labels(moved))
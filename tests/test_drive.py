@@ -0,0 +1,174 @@
+'''
+Tests of finding and downloading the new photos on the Google Drive, with
+fakedrive.FakeDrive as the Drive.
+'''
+
+import os
+import errno
+import random
+import shutil
+import socket
+import pytest
+import piexif
+from PIL import Image
+import exif
+import fakedrive
+import images
+import storage
+
+
+@pytest.fixture
+def drive(database, monkeypatch):
+    ''' A fake Drive over an empty folder, with the images service storing
+    into the test's database and directories.
+    '''
+    image_dir = database / 'images'
+    image_dir.mkdir()
+    monkeypatch.setattr(images, 'IMAGE_DIR', str(image_dir))
+    monkeypatch.setattr(images, 'PHOTO_INDEX_DIR',
+                        str(database / 'photo_index'))
+    monkeypatch.setattr(images, 'update_thumbnail_manifest',
+                        lambda variants: None)
+    # Small chunks, so every photo takes several media requests, and no
+    # waiting between retries.
+    monkeypatch.setattr(images, 'DOWNLOAD_CHUNKSIZE', 256)
+    monkeypatch.setattr(exif, 'EXIF_READ_BYTES', 512)
+    monkeypatch.setattr(images, 'DOWNLOAD_BACKOFF', 0.0)
+    folder = database / 'drive'
+    folder.mkdir()
+    return fakedrive.FakeDrive(str(folder))
+
+
+def add_photo(folder, name, seed):
+    ''' Writes a geotagged photo of noise to the folder. '''
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    rand = random.Random(seed)
+    image = Image.new('RGB', (64, 48))
+    image.putdata([(rand.randrange(256), rand.randrange(256),
+                    rand.randrange(256)) for _ in range(64 * 48)])
+    gps = {piexif.GPSIFD.GPSLatitudeRef: 'S',
+           piexif.GPSIFD.GPSLatitude: ((11, 1), (52, 1), (2611, 100)),
+           piexif.GPSIFD.GPSLongitudeRef: 'W',
+           piexif.GPSIFD.GPSLongitude: ((75, 1), (17, 1), (3987, 100)),
+           piexif.GPSIFD.GPSAltitudeRef: 0,
+           piexif.GPSIFD.GPSAltitude: (3422, 1),
+           piexif.GPSIFD.GPSTimeStamp: ((15, 1), (29, 1), (10, 1)),
+           piexif.GPSIFD.GPSDateStamp: '2017:07:12'}
+    image.save(os.path.join(folder, name), 'JPEG',
+               exif=piexif.dump({'GPS': gps}))
+
+
+def drive_file(drive, name):
+    ''' Returns the GD file item of the file with the name. '''
+    items = drive.files().list().execute()['files']
+    return [item for item in items if item['name'] == name][0]
+
+
+def same_contents(drive, name):
+    ''' Returns True if the downloaded file is the one on the Drive. '''
+    with open(os.path.join(drive.folder, name), 'rb') as infile:
+        expected = infile.read()
+    with open(name, 'rb') as infile:
+        return infile.read() == expected
+
+
+def stored_names():
+    ''' Returns the sorted names of the stored photos. '''
+    return sorted(row[1] for _, row in storage.get_rows('images'))
+
+
+def test_downloads_new_photos_once(drive):
+    names = ['{0}.jpg'.format(number) for number in range(5)]
+    for seed, name in enumerate(names):
+        add_photo(drive.folder, name, seed)
+    assert images.get_pictures(drive, workers=2) == 5
+    assert stored_names() == names
+    # Nothing changed on the Drive.
+    assert images.get_pictures(drive, workers=2) == 0
+    assert drive.counters['list'] == 1
+
+
+def test_same_name_with_other_contents_is_downloaded(drive):
+    add_photo(drive.folder, 'a.jpg', seed=1)
+    add_photo(drive.folder, 'b.jpg', seed=2)
+    assert images.get_pictures(drive, workers=2) == 2
+    # Another phone, whose counter gives the same name to another photo.
+    add_photo(os.path.join(drive.folder, 'phone'), 'a.jpg', seed=3)
+    requests = drive.counters['get_media']
+    assert images.get_pictures(drive, workers=2) == 1
+    assert drive.counters['get_media'] == requests + 1
+    assert stored_names() == ['a.jpg', 'a.jpg', 'b.jpg']
+
+
+def test_copy_of_a_photo_is_not_downloaded(drive):
+    add_photo(drive.folder, 'a.jpg', seed=1)
+    assert images.get_pictures(drive, workers=2) == 1
+    shutil.copy(os.path.join(drive.folder, 'a.jpg'),
+                os.path.join(drive.folder, 'copy.jpg'))
+    requests = drive.counters['get_media']
+    assert images.get_pictures(drive, workers=2) == 0
+    assert drive.counters['get_media'] == requests
+
+
+def test_photos_stored_by_name_are_matched_in_the_first_listing(drive):
+    for seed, name in enumerate(['a.jpg', 'b.jpg', 'c.jpg']):
+        add_photo(drive.folder, name, seed)
+    # Stored before the Drive files were recorded, as the CSV import does.
+    storage.add_images([(1, 'a.jpg', 1.0, 2.0, 3.0, '2017-01-01 00:00:00')])
+    assert images.get_pictures(drive, workers=2) == 2
+    assert stored_names() == ['a.jpg', 'b.jpg', 'c.jpg']
+
+
+def test_download_resumes_after_network_errors(drive):
+    add_photo(drive.folder, 'a.jpg', seed=1)
+    size = os.path.getsize(os.path.join(drive.folder, 'a.jpg'))
+    assert size > 6 * 256
+    drive.inject_failure('a.jpg', 2, socket.error(errno.ECONNRESET,
+                                                  'Connection reset'))
+    drive.inject_failure('a.jpg', 5, socket.timeout('timed out'))
+    images.fetch_picture(drive, drive_file(drive, 'a.jpg'))
+    # Every byte was downloaded once, the retries resumed where the
+    # failed requests stopped.
+    assert drive.counters['bytes'] == size
+    assert same_contents(drive, 'a.jpg')
+    assert not os.path.exists('a.jpg.part')
+
+
+def test_local_errors_are_not_retried(drive):
+    add_photo(drive.folder, 'a.jpg', seed=1)
+    item = drive_file(drive, 'a.jpg')
+    drive.inject_failure('a.jpg', 1, OSError(errno.ENOSPC,
+                                             'No space left on device'))
+    with pytest.raises(OSError):
+        images.fetch_picture(drive, item)
+    assert drive.media_requests[item['id']] == 2
+    # Left for the next check, which resumes the partial download.
+    assert os.path.exists('a.jpg.part')
+    images.fetch_picture(drive, item)
+    assert drive.counters['bytes'] == \
+        os.path.getsize(os.path.join(drive.folder, 'a.jpg'))
+    assert same_contents(drive, 'a.jpg')
+
+
+def test_download_starts_over_when_the_partial_file_is_too_long(drive):
+    add_photo(drive.folder, 'a.jpg', seed=1)
+    # Left behind by a download of another version of the photo.
+    shutil.copy(os.path.join(drive.folder, 'a.jpg'), 'a.jpg.part')
+    with open('a.jpg.part', 'ab') as outf:
+        outf.write(b'x' * 10)
+    image_info = images.fetch_picture(drive, drive_file(drive, 'a.jpg'))
+    assert drive.counters['bytes'] == \
+        os.path.getsize(os.path.join(drive.folder, 'a.jpg'))
+    assert same_contents(drive, 'a.jpg')
+    assert image_info[0] == 1  # It has GPS.
+
+
+@pytest.mark.parametrize('error, transient', [
+    (socket.error(errno.ECONNRESET, 'Connection reset'), True),
+    (socket.timeout('timed out'), True),
+    (socket.gaierror(-3, 'Temporary failure in name resolution'), True),
+    (OSError(errno.ENOSPC, 'No space left on device'), False),
+    (IOError(errno.EACCES, 'Permission denied'), False)])
+def test_only_network_errors_are_transient(error, transient):
+    assert images.is_transient_error(error) is transient
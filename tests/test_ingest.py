@@ -0,0 +1,32 @@
+'''
+Tests of the queue that stores the coordinates of the webhook in the
+background.
+'''
+
+import ingest
+
+
+def test_batch_is_kept_whatever_the_error(monkeypatch):
+    monkeypatch.setattr(ingest, 'RETRY_INTERVAL', 0.01)
+    stored = []
+    failures = [RuntimeError('not a database error')]
+
+    def store(rows):
+        if failures:
+            raise failures.pop()
+        stored.extend(rows)
+        return len(rows)
+
+    def on_stored():
+        raise ValueError('the bundles are broken')
+
+    writer = ingest.WriteBehindQueue(store, on_stored)
+    writer.put([-0.2, -78.5, 2850, '2017-01-01 10:00:00'])
+    assert writer.wait(5)
+    assert stored == [[-0.2, -78.5, 2850, '2017-01-01 10:00:00']]
+    # The writer thread survived both errors.
+    writer.put([-0.3, -78.6, 2800, '2017-01-02 10:00:00'])
+    assert writer.wait(5)
+    status = writer.status()
+    assert status['running']
+    assert (status['stored'], status['errors']) == (2, 1)
@@ -0,0 +1,53 @@
+'''
+Tests of the metrics that the processes of a service share through
+snapshot files.
+'''
+
+import os
+import sys
+import json
+import subprocess
+import metrics
+
+
+def snapshot(requests, queue):
+    return {'test_requests_total': {
+                'kind': 'counter', 'documentation': 'Requests.',
+                'labels': [], 'values': [[[], requests]]},
+            'test_queue': {
+                'kind': 'gauge', 'documentation': 'Queued.',
+                'labels': [], 'values': [[[], queue]]}}
+
+
+def exited_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def write(directory, pid, data):
+    with open(os.path.join(directory, '{0}.json'.format(pid)), 'w') as outf:
+        json.dump(data, outf)
+
+
+def test_gauges_only_of_running_processes(tmp_path):
+    directory = str(tmp_path)
+    dead = exited_pid()
+    write(directory, os.getppid(), snapshot(3, 5))
+    write(directory, dead, snapshot(4, 7))
+    shared = metrics.SharedMetrics(directory)
+    text = shared.render()
+    assert 'test_requests_total 7\n' in text
+    assert 'test_queue 5\n' in text
+    # The snapshot of the exited process is folded into EXITED_FILE.
+    shared.remove_exited()
+    assert not os.path.exists(os.path.join(directory, '{0}.json'.format(
+        dead)))
+    text = shared.render()
+    assert 'test_requests_total 7\n' in text
+    assert 'test_queue 5\n' in text
+    write(directory, exited_pid(), snapshot(1, 9))
+    shared.remove_exited()
+    text = shared.render()
+    assert 'test_requests_total 8\n' in text
+    assert 'test_queue 5\n' in text
@@ -0,0 +1,24 @@
+'''
+Tests of the zoom levels that /api/points and the spatial index accept.
+'''
+
+import pytest
+import app
+import spatial
+
+BBOX = (-60.0, -90.0, 5.0, -60.0)
+
+
+@pytest.mark.parametrize('zoom', ['-1', '23', '2000', str(10 ** 9)])
+def test_points_refuses_zoom_levels_out_of_range(zoom):
+    response = app.app.test_client().get(
+        '/api/points?bbox=-60,-90,5,-60&zoom=' + zoom)
+    assert response.status_code == 400
+    assert 'zoom' in response.get_json()['error']
+
+
+def test_query_above_max_zoom_is_answered_at_max_zoom():
+    index = spatial.SpatialIndex()
+    for number in range(100):
+        index.add(-30.0 + number * 0.01, -70.0, number)
+    assert index.query(BBOX, 2000) == index.query(BBOX, spatial.MAX_ZOOM)
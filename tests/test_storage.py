@@ -0,0 +1,69 @@
+'''
+Tests of the database shared by the services, and of the app's readers of
+it.
+'''
+
+import parser
+import storage
+
+
+def write(filename, text):
+    with open(filename, 'w') as outf:
+        outf.write(text)
+
+
+def test_import_skips_bad_rows(database, monkeypatch, capsys):
+    coordinates_csv = str(database / 'coordinates.csv')
+    images_csv = str(database / 'images.csv')
+    monkeypatch.setattr(storage, 'COORDINATES_CSV', coordinates_csv)
+    monkeypatch.setattr(storage, 'IMAGES_CSV', images_csv)
+    write(coordinates_csv, '-0.2,-78.5,2850,2017-01-01 10:00:00\n'
+                           '-0.3,oops,2850,2017-01-02 10:00:00\n'
+                           '-0.4\n'
+                           '-0.5,-78.6,2800,2017-01-03 10:00:00\n')
+    write(images_csv, '1,a.jpg,-0.2,-78.5,2850.0,2017-01-01 10:00:00\n'
+                      'yes,b.jpg,-0.2,-78.5,2850.0,2017-01-01 11:00:00\n')
+    # Opening the database does not import anything.
+    assert storage.get_rows('coordinates') == []
+    assert storage.import_csv() == (2, 1)
+    assert 'Skipping row 2 of ' in capsys.readouterr().err
+    assert [row[3] for _, row in storage.get_rows('coordinates')] == [
+        '2017-01-01 10:00:00', '2017-01-03 10:00:00']
+    assert storage.get_image_names() == set(['a.jpg'])
+    # Only once.
+    assert storage.import_csv() is None
+    storage.add_coordinates([(-0.6, -78.7, 2700, '2017-01-04 10:00:00')],
+                            export=False)
+    assert len(storage.get_rows('coordinates')) == 3
+
+
+def test_time_of_the_last_change_is_stored(database, monkeypatch):
+    assert storage.get_modified('coordinates') is None
+    monkeypatch.setattr(storage.time, 'time', lambda: 1500000000.5)
+    storage.add_new_coordinates(
+        [(-0.2, -78.5, 2850, '2017-01-01 10:00:00')], export=False)
+    assert storage.get_modified('coordinates') == 1500000000
+    # A message delivered twice changes nothing.
+    monkeypatch.setattr(storage.time, 'time', lambda: 1600000000.0)
+    storage.add_new_coordinates(
+        [(-0.2, -78.5, 2850, '2017-01-01 10:00:00')], export=False)
+    assert storage.get_modified('coordinates') == 1500000000
+    assert storage.get_modified('images') is None
+
+
+def test_reader_returns_the_rows_up_to_the_version(database):
+    reader = parser.AppendOnlyTableReader('coordinates')
+    storage.add_coordinates([(-0.2, -78.5, 2850, '2017-01-01 10:00:00')],
+                            export=False)
+    version = storage.get_version('coordinates')
+    storage.add_coordinates([(-0.3, -78.6, 2800, '2017-01-02 10:00:00')],
+                            export=False)
+    rows = reader.read(version)
+    assert [row[3] for row in rows] == ['2017-01-01 10:00:00']
+    everything = reader.read()
+    assert len(everything) == 2
+    storage.add_coordinates([(-0.4, -78.7, 2700, '2017-01-03 10:00:00')],
+                            export=False)
+    assert len(reader.read()) == 3
+    # The lists that were returned before do not change.
+    assert len(rows) == 1 and len(everything) == 2
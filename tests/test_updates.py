@@ -0,0 +1,33 @@
+'''
+Tests of /api/updates: the long polls and event streams that wait for new
+data must leave request threads for everything else.
+'''
+
+import time
+import threading
+import app
+
+EVENT_STREAM = {'Accept': 'text/event-stream'}
+
+
+def test_waiting_requests_are_capped(database, monkeypatch):
+    monkeypatch.setattr(app, 'UPDATES_WAITING', threading.BoundedSemaphore(1))
+    client = app.app.test_client()
+    cursor = client.get('/api/updates').get_json()['cursor']
+    # An open event stream takes the only waiting thread.
+    stream = client.get('/api/updates', headers=EVENT_STREAM)
+    assert stream.status_code == 200
+    started = time.time()
+    response = client.get('/api/updates?wait=10&since=' + cursor)
+    assert time.time() - started < 5
+    assert response.get_json()['retry'] == app.UPDATES_RETRY_SECONDS
+    assert response.headers['Retry-After'] == str(app.UPDATES_RETRY_SECONDS)
+    response = client.get('/api/updates', headers=EVENT_STREAM)
+    assert response.status_code == 503
+    assert response.get_data() == b'retry: 30000\n\n'
+    # Once the stream is closed, long polls wait again.
+    stream.close()
+    started = time.time()
+    response = client.get('/api/updates?wait=1&since=' + cursor)
+    assert time.time() - started >= 0.9
+    assert 'retry' not in response.get_json()